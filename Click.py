@@ -1,6 +1,22 @@
+def anchor_from_dict(data):
+    """Anchor from its to_dict() form (anchors is only imported when needed)"""
+    if not data:
+        return None
+    from anchors import Anchor
+    return Anchor.from_dict(data)
+
+
+def condition_from_dict(data):
+    """WaitCondition from its to_dict() form (screen_wait is only imported when needed)"""
+    if not data:
+        return None
+    from screen_wait import WaitCondition
+    return WaitCondition.from_dict(data)
+
 
 class Click:
-    def __init__(self, x, y, button=None, delay=0, is_double_click=False, offset_x=0, offset_y=0, is_scroll=False, scroll_amount=0):
+    def __init__(self, x, y, button=None, delay=0, is_double_click=False, offset_x=0, offset_y=0, is_scroll=False, scroll_amount=0,
+                 is_move=False, is_mouse_down=False, is_mouse_up=False, anchor=None, condition=None, key=None):
         self.x = x
         self.y = y
         self.button = button
@@ -11,6 +27,19 @@ class Click:
         # Scroll action support
         self.is_scroll = is_scroll
         self.scroll_amount = scroll_amount
+        # Mouse path support: a move only moves the pointer, a drag is a
+        # mouse down, moves and a mouse up
+        self.is_move = is_move
+        self.is_mouse_down = is_mouse_down
+        self.is_mouse_up = is_mouse_up
+        # Optional anchors.Anchor: the step follows this screen patch around
+        self.anchor = anchor
+        # Optional screen_wait.WaitCondition: the step waits for the screen
+        # instead of acting
+        self.condition = condition
+        # Optional key (a character or keys.SPECIAL_KEYS name): the step
+        # types it instead of using the mouse
+        self.key = key
 
     def __repr__(self):
         return f"Click(x={self.x}, y={self.y}, delay={self.delay}, offset=({self.offset_x},{self.offset_y}), double={self.is_double_click}, scroll={self.is_scroll},{self.scroll_amount})"
@@ -19,7 +48,7 @@ class Click:
         return [self.x, self.y, self.button, self.delay, self.is_double_click, self.offset_x, self.offset_y]
 
     def to_dict(self):
-        return {
+        data = {
             'x': self.x,
             'y': self.y,
             'button': self.button,
@@ -28,8 +57,18 @@ class Click:
             'offset_x': self.offset_x,
             'offset_y': self.offset_y,
             'is_scroll': self.is_scroll,
-            'scroll_amount': self.scroll_amount
+            'scroll_amount': self.scroll_amount,
+            'is_move': self.is_move,
+            'is_mouse_down': self.is_mouse_down,
+            'is_mouse_up': self.is_mouse_up
         }
+        if self.anchor is not None:
+            data['anchor'] = self.anchor.to_dict()
+        if self.condition is not None:
+            data['wait'] = self.condition.to_dict()
+        if self.key is not None:
+            data['key'] = self.key
+        return data
 
     @classmethod
     def from_dict(cls, data):
@@ -42,5 +81,11 @@ class Click:
             offset_x=data.get('offset_x', 0),
             offset_y=data.get('offset_y', 0),
             is_scroll=data.get('is_scroll', False),
-            scroll_amount=data.get('scroll_amount', 0)
+            scroll_amount=data.get('scroll_amount', 0),
+            is_move=data.get('is_move', False),
+            is_mouse_down=data.get('is_mouse_down', False),
+            is_mouse_up=data.get('is_mouse_up', False),
+            anchor=anchor_from_dict(data.get('anchor')),
+            condition=condition_from_dict(data.get('wait')),
+            key=data.get('key')
         )
\ No newline at end of file
@@ -0,0 +1,524 @@
+import functools
+import threading
+from array import array
+
+from Click import Click, anchor_from_dict, condition_from_dict
+from keys import key_code, key_name
+
+
+# Bits of the per-step flags column
+FLAG_DOUBLE = 0x01
+FLAG_SCROLL = 0x02
+FLAG_MOVE = 0x04
+FLAG_MOUSE_DOWN = 0x08
+FLAG_MOUSE_UP = 0x10
+FLAG_WAIT = 0x20  # scroll_amount holds the id of the step's WaitCondition
+FLAG_KEY = 0x40  # scroll_amount holds the key code (see keys.py)
+
+# Button names are stored as a small code instead of a string per step
+BUTTON_NAMES = (None, 'left', 'right', 'middle')
+BUTTON_CODES = {name: code for code, name in enumerate(BUTTON_NAMES)}
+
+# Change notification kinds, see ClickStore.subscribe
+CHANGE_APPEND = 'append'
+CHANGE_UPDATE = 'update'
+CHANGE_DELETE = 'delete'
+CHANGE_INSERT = 'insert'
+CHANGE_RESET = 'reset'
+
+# Column name -> array typecode
+COLUMNS = (
+    ('x', 'i'),
+    ('y', 'i'),
+    ('delay', 'd'),
+    ('offset_x', 'i'),
+    ('offset_y', 'i'),
+    ('scroll_amount', 'i'),
+    ('flags', 'B'),
+    ('button', 'B'),
+    ('anchor', 'H'),  # id in ClickStore.anchors, 0 for unanchored steps
+)
+# Anchor ids are u16 (they fill the padding of binary macro records)
+MAX_ANCHORS = 0xFFFF
+MAX_CONDITIONS = 0x7FFFFFFF
+
+
+def _locked(method):
+    """Run a ClickStore method with the store's lock held"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _view_setter(setter):
+    """Run a ClickView property setter with its store's lock held"""
+    @functools.wraps(setter)
+    def wrapper(self, value):
+        with self._store.lock:
+            setter(self, value)
+    return wrapper
+
+
+def _column_property(name):
+    """Property that reads/writes one column of the owning store"""
+    def getter(self):
+        return getattr(self._store, name)[self._index]
+
+    @_view_setter
+    def setter(self, value):
+        getattr(self._store, name)[self._index] = value
+        self._store.notify(CHANGE_UPDATE, self._index)
+
+    return property(getter, setter)
+
+
+def _flag_property(bit):
+    """Property that reads/writes one bit of the flags column"""
+    def getter(self):
+        return bool(self._store.flags[self._index] & bit)
+
+    @_view_setter
+    def setter(self, value):
+        if value:
+            self._store.flags[self._index] |= bit
+        else:
+            self._store.flags[self._index] &= ~bit & 0xFF
+        self._store.notify(CHANGE_UPDATE, self._index)
+
+    return property(getter, setter)
+
+
+def step_flags(is_double_click=False, is_scroll=False, is_move=False, is_mouse_down=False, is_mouse_up=False):
+    """Pack the step type booleans into a flags value"""
+    return ((FLAG_DOUBLE if is_double_click else 0) |
+            (FLAG_SCROLL if is_scroll else 0) |
+            (FLAG_MOVE if is_move else 0) |
+            (FLAG_MOUSE_DOWN if is_mouse_down else 0) |
+            (FLAG_MOUSE_UP if is_mouse_up else 0))
+
+
+def click_flags(click):
+    """Flags value for a Click (or anything with the same attributes)"""
+    flags = step_flags(getattr(click, 'is_double_click', False), getattr(click, 'is_scroll', False),
+                       getattr(click, 'is_move', False), getattr(click, 'is_mouse_down', False),
+                       getattr(click, 'is_mouse_up', False))
+    if getattr(click, 'condition', None) is not None:
+        flags |= FLAG_WAIT
+    if getattr(click, 'key', None) is not None:
+        flags |= FLAG_KEY
+    return flags
+
+
+def _button_code(name):
+    """Map a button name to its stored code, unknown names fall back to left"""
+    return BUTTON_CODES.get(name, 1)
+
+
+class ClickView:
+    """
+    Click-compatible proxy for one row of a ClickStore.
+    A view is positional: it always refers to the row at its index.
+    """
+    __slots__ = ('_store', '_index')
+
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+
+    x = _column_property('x')
+    y = _column_property('y')
+    delay = _column_property('delay')
+    offset_x = _column_property('offset_x')
+    offset_y = _column_property('offset_y')
+    scroll_amount = _column_property('scroll_amount')
+    is_double_click = _flag_property(FLAG_DOUBLE)
+    is_scroll = _flag_property(FLAG_SCROLL)
+    is_move = _flag_property(FLAG_MOVE)
+    is_mouse_down = _flag_property(FLAG_MOUSE_DOWN)
+    is_mouse_up = _flag_property(FLAG_MOUSE_UP)
+
+    @property
+    def anchor(self):
+        """The step's Anchor (see anchors.py), or None"""
+        return self._store.anchors.get(self._store.anchor[self._index])
+
+    @anchor.setter
+    @_view_setter
+    def anchor(self, value):
+        self._store.anchor[self._index] = self._store.anchor_code(value)
+        self._store.notify(CHANGE_UPDATE, self._index)
+
+    @property
+    def condition(self):
+        """The wait step's WaitCondition (see screen_wait.py), or None"""
+        if not self._store.flags[self._index] & FLAG_WAIT:
+            return None
+        return self._store.conditions.get(self._store.scroll_amount[self._index])
+
+    @condition.setter
+    @_view_setter
+    def condition(self, value):
+        store, index = self._store, self._index
+        if value is None:
+            store.flags[index] &= ~FLAG_WAIT & 0xFF
+            store.scroll_amount[index] = 0
+        else:
+            store.flags[index] |= FLAG_WAIT
+            store.scroll_amount[index] = store.condition_code(value)
+        store.notify(CHANGE_UPDATE, index)
+
+    @property
+    def key(self):
+        """The key step's key (a character or keys.SPECIAL_KEYS name), or None"""
+        if not self._store.flags[self._index] & FLAG_KEY:
+            return None
+        return key_name(self._store.scroll_amount[self._index])
+
+    @key.setter
+    @_view_setter
+    def key(self, value):
+        store, index = self._store, self._index
+        if value is None:
+            store.flags[index] &= ~FLAG_KEY & 0xFF
+            store.scroll_amount[index] = 0
+        else:
+            store.scroll_amount[index] = key_code(value)
+            store.flags[index] |= FLAG_KEY
+        store.notify(CHANGE_UPDATE, index)
+
+    @property
+    def button(self):
+        return BUTTON_NAMES[self._store.button[self._index]]
+
+    @button.setter
+    @_view_setter
+    def button(self, value):
+        self._store.button[self._index] = _button_code(value)
+        self._store.notify(CHANGE_UPDATE, self._index)
+
+    def __repr__(self):
+        return f"Click(x={self.x}, y={self.y}, delay={self.delay}, offset=({self.offset_x},{self.offset_y}), double={self.is_double_click}, scroll={self.is_scroll},{self.scroll_amount})"
+
+    def to_array(self):
+        return [self.x, self.y, self.button, self.delay, self.is_double_click, self.offset_x, self.offset_y]
+
+    def to_dict(self):
+        return self._store.row_dict(self._index)
+
+    def to_click(self):
+        """Detach this row into a standalone Click object"""
+        return Click.from_dict(self.to_dict())
+
+
+class ClickStore:
+    """
+    Columnar storage for recorded steps.
+    Every field lives in its own typed array, so a step costs a few dozen bytes
+    instead of a full Click object. Indexing returns ClickView proxies, so code
+    written against a list of Click objects keeps working.
+
+    Changes made through the store or its views are reported to subscribers
+    as callback(kind, index), where kind is one of the CHANGE_* constants.
+    Callbacks run on whichever thread made the change, with `lock` held:
+    a reader that takes the lock sees either none of a change or the change
+    and its notification.
+    """
+
+    def __init__(self):
+        for name, typecode in COLUMNS:
+            setattr(self, name, array(typecode))
+        self.anchors = {}  # anchor id -> Anchor, shared by steps with the same patch
+        self._anchor_ids = {}  # Anchor -> id
+        self.conditions = {}  # condition id -> WaitCondition of wait steps
+        self._condition_ids = {}  # WaitCondition -> id
+        self.layout = None  # ScreenLayout the steps were recorded on, see screen_layout.py
+        self.lock = threading.RLock()  # held by every change and its notification
+        self._listeners = ()
+
+    # --- change notifications ---
+
+    def subscribe(self, callback):
+        self._listeners = self._listeners + (callback,)
+
+    def unsubscribe(self, callback):
+        self._listeners = tuple(c for c in self._listeners if c is not callback)
+
+    def notify(self, kind, index=None):
+        for callback in self._listeners:
+            callback(kind, index)
+
+    # --- construction ---
+
+    @classmethod
+    def from_clicks(cls, clicks):
+        """Build a store from Click objects (or anything with the same attributes)"""
+        store = cls()
+        store.extend(clicks)
+        return store
+
+    @classmethod
+    def from_dicts(cls, dicts):
+        """Build a store from Click.to_dict() style dictionaries"""
+        store = cls()
+        for data in dicts:
+            store.add(
+                data['x'],
+                data['y'],
+                button=data.get('button'),
+                delay=data.get('delay', 0),
+                is_double_click=data.get('is_double_click', False),
+                offset_x=data.get('offset_x', 0),
+                offset_y=data.get('offset_y', 0),
+                is_scroll=data.get('is_scroll', False),
+                scroll_amount=data.get('scroll_amount', 0),
+                is_move=data.get('is_move', False),
+                is_mouse_down=data.get('is_mouse_down', False),
+                is_mouse_up=data.get('is_mouse_up', False),
+                anchor=anchor_from_dict(data.get('anchor')),
+                condition=condition_from_dict(data.get('wait')),
+                key=data.get('key'),
+            )
+        return store
+
+    # --- anchors ---
+
+    def anchor_code(self, anchor):
+        """The id of an Anchor in this store, registering it if needed (0 for None)"""
+        if anchor is None:
+            return 0
+        code = self._anchor_ids.get(anchor)
+        if code is None:
+            code = max(self.anchors, default=0) + 1
+            if code > MAX_ANCHORS:
+                raise ValueError("too many anchors in one macro")
+            self.put_anchor(code, anchor)
+        return code
+
+    @_locked
+    def put_anchor(self, code, anchor):
+        """Register an Anchor under a known id (used by readers)"""
+        self.anchors[code] = anchor
+        self._anchor_ids[anchor] = code
+
+    # --- wait conditions ---
+
+    def condition_code(self, condition):
+        """The id of a WaitCondition in this store, registering it if needed"""
+        code = self._condition_ids.get(condition)
+        if code is None:
+            code = max(self.conditions, default=0) + 1
+            if code > MAX_CONDITIONS:
+                raise ValueError("too many wait conditions in one macro")
+            self.put_condition(code, condition)
+        return code
+
+    @_locked
+    def put_condition(self, code, condition):
+        """Register a WaitCondition under a known id (used by readers)"""
+        self.conditions[code] = condition
+        self._condition_ids[condition] = code
+
+    # --- mutation ---
+
+    def _row(self, x, y, button, delay, is_double_click, offset_x, offset_y, is_scroll, scroll_amount,
+             is_move, is_mouse_down, is_mouse_up, anchor, condition, key=None):
+        """Column values of one step, in COLUMNS order"""
+        flags = step_flags(is_double_click, is_scroll, is_move, is_mouse_down, is_mouse_up)
+        if condition is not None:
+            flags |= FLAG_WAIT
+            scroll_amount = self.condition_code(condition)
+        elif key is not None:
+            flags |= FLAG_KEY
+            scroll_amount = key_code(key)
+        return (int(x), int(y), float(delay), int(offset_x), int(offset_y), int(scroll_amount), flags,
+                _button_code(button), self.anchor_code(anchor))
+
+    def add(self, x, y, button=None, delay=0, is_double_click=False, offset_x=0, offset_y=0, is_scroll=False, scroll_amount=0,
+            is_move=False, is_mouse_down=False, is_mouse_up=False, anchor=None, condition=None, key=None):
+        """Append a step from plain values without creating a Click object"""
+        # The recording hot path: locked inline rather than through @_locked
+        with self.lock:
+            row = self._row(x, y, button, delay, is_double_click, offset_x, offset_y, is_scroll, scroll_amount,
+                            is_move, is_mouse_down, is_mouse_up, anchor, condition, key)
+            for (name, _), value in zip(COLUMNS, row):
+                getattr(self, name).append(value)
+            index = len(self.x) - 1
+            if self._listeners:
+                self.notify(CHANGE_APPEND, index)
+            return index
+
+    def _click_row(self, click):
+        return self._row(
+            click.x,
+            click.y,
+            getattr(click, 'button', None),
+            getattr(click, 'delay', 0),
+            getattr(click, 'is_double_click', False),
+            getattr(click, 'offset_x', 0),
+            getattr(click, 'offset_y', 0),
+            getattr(click, 'is_scroll', False),
+            getattr(click, 'scroll_amount', 0),
+            getattr(click, 'is_move', False),
+            getattr(click, 'is_mouse_down', False),
+            getattr(click, 'is_mouse_up', False),
+            getattr(click, 'anchor', None),
+            getattr(click, 'condition', None),
+            getattr(click, 'key', None),
+        )
+
+    def append(self, click):
+        """Append a Click (or ClickView) by copying its fields"""
+        with self.lock:
+            row = self._click_row(click)
+            for (name, _), value in zip(COLUMNS, row):
+                getattr(self, name).append(value)
+            if self._listeners:
+                self.notify(CHANGE_APPEND, len(self.x) - 1)
+
+    @_locked
+    def insert(self, index, click):
+        """Insert a Click (or ClickView) before index"""
+        length = len(self.x)
+        if index < 0:
+            index = max(0, index + length)
+        index = min(index, length)
+        row = self._click_row(click)
+        for (name, _), value in zip(COLUMNS, row):
+            getattr(self, name).insert(index, value)
+        self.notify(CHANGE_INSERT, index)
+        return index
+
+    def extend(self, clicks):
+        for click in clicks:
+            self.append(click)
+
+    @_locked
+    def clear(self):
+        for name, typecode in COLUMNS:
+            del getattr(self, name)[:]
+        self.anchors = {}
+        self._anchor_ids = {}
+        self.conditions = {}
+        self._condition_ids = {}
+        self.layout = None
+        self.notify(CHANGE_RESET)
+
+    def pop(self, index=-1):
+        """Remove a row and return it as a detached Click"""
+        click = self[index].to_click()
+        del self[index]
+        return click
+
+    # --- sequence protocol ---
+
+    def _normalize(self, index):
+        length = len(self.x)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("ClickStore index out of range")
+        return index
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ClickView(self, i) for i in range(*index.indices(len(self)))]
+        return ClickView(self, self._normalize(index))
+
+    @_locked
+    def __setitem__(self, index, click):
+        index = self._normalize(index)
+        for (name, _), value in zip(COLUMNS, self._click_row(click)):
+            getattr(self, name)[index] = value
+        self.notify(CHANGE_UPDATE, index)
+
+    @_locked
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            for name, _ in COLUMNS:
+                del getattr(self, name)[index]
+            self.notify(CHANGE_RESET)
+            return
+        index = self._normalize(index)
+        for name, _ in COLUMNS:
+            del getattr(self, name)[index]
+        self.notify(CHANGE_DELETE, index)
+
+    def __iter__(self):
+        for i in range(len(self.x)):
+            yield ClickView(self, i)
+
+    def columns(self):
+        """The step columns by name (the arrays themselves, not copies)"""
+        return {name: getattr(self, name) for name, _ in COLUMNS}
+
+    @_locked
+    def remap(self, layout):
+        """
+        Move every step from the layout it was recorded on to `layout`, in
+        place. Returns whether anything moved; steps without a recorded
+        layout are left alone.
+        """
+        from screen_layout import layout_transform
+        if self.layout is None or layout is None:
+            return False
+        transform = layout_transform(self.layout, layout)
+        self.layout = layout
+        if transform is None:
+            return False
+        for name, column in transform.columns(self.columns()).items():
+            setattr(self, name, column)
+        anchors = transform.anchors(self.anchors)
+        self.anchors, self._anchor_ids = {}, {}
+        for code, anchor in anchors.items():
+            self.put_anchor(code, anchor)
+        self.notify(CHANGE_RESET)
+        return True
+
+    def rows(self):
+        """Iterate raw (x, y, delay, offset_x, offset_y, scroll_amount, flags, button, anchor) tuples"""
+        return zip(self.x, self.y, self.delay, self.offset_x, self.offset_y, self.scroll_amount, self.flags,
+                   self.button, self.anchor)
+
+    def __repr__(self):
+        return f"ClickStore({len(self)} steps)"
+
+    # --- export ---
+
+    def row_dict(self, index):
+        """Return one row as a Click.to_dict() style dictionary"""
+        flags = self.flags[index]
+        data = {
+            'x': self.x[index],
+            'y': self.y[index],
+            'button': BUTTON_NAMES[self.button[index]],
+            'delay': self.delay[index],
+            'is_double_click': bool(flags & FLAG_DOUBLE),
+            'offset_x': self.offset_x[index],
+            'offset_y': self.offset_y[index],
+            'is_scroll': bool(flags & FLAG_SCROLL),
+            'scroll_amount': 0 if flags & (FLAG_WAIT | FLAG_KEY) else self.scroll_amount[index],
+            'is_move': bool(flags & FLAG_MOVE),
+            'is_mouse_down': bool(flags & FLAG_MOUSE_DOWN),
+            'is_mouse_up': bool(flags & FLAG_MOUSE_UP),
+        }
+        anchor = self.anchors.get(self.anchor[index])
+        if anchor is not None:
+            data['anchor'] = anchor.to_dict()
+        if flags & FLAG_WAIT:
+            data['wait'] = self.conditions[self.scroll_amount[index]].to_dict()
+        if flags & FLAG_KEY:
+            data['key'] = key_name(self.scroll_amount[index])
+        return data
+
+    @_locked
+    def to_dicts(self):
+        return [self.row_dict(i) for i in range(len(self))]
+
+    def nbytes(self):
+        """Bytes used by the column buffers"""
+        return sum(getattr(self, name).itemsize * len(getattr(self, name)) for name, _ in COLUMNS)
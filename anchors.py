@@ -0,0 +1,343 @@
+"""
+Template-matching anchors.
+
+An anchored step carries a small grayscale patch of the screen around its
+target (an Anchor). At replay time the patch is looked up on screen and
+the step's coordinates are shifted by how far the patch moved, so the step
+keeps hitting the same UI element after a window move or layout change.
+
+TemplateMatcher finds a patch with normalized cross-correlation (NCC). A
+lookup tries, cheapest first:
+  1. the patch's last known location, checked with a single NCC window
+  2. a region of interest around that location (or the recorded one)
+  3. the whole screen
+Searches run coarse-to-fine over image pyramids: the full correlation is
+only computed at the coarsest level, then each candidate is refined in a
+small neighbourhood one level at a time. Screenshots are only taken of the
+region being searched.
+
+Anchors themselves only need the standard library; matching needs NumPy.
+"""
+import base64
+import hashlib
+import struct
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, anchors then can't be matched
+    np = None
+
+
+ANCHOR_SIZE = 48  # side of the patch captured around a step, in pixels
+MATCH_THRESHOLD = 0.9  # minimum NCC score of a match
+ROI_MARGIN = 64  # pixels searched around the last hit before the full screen
+MIN_TEMPLATE = 8  # pyramid levels stop when the patch gets smaller than this
+CANDIDATES = 3  # coarse peaks refined at full resolution
+REFINE_RADIUS = 2  # search radius (at each level) while refining a peak
+CACHE_SIZE = 256  # recent match locations kept by a matcher
+MIN_CONTRAST = 4.0  # patches with less pixel std-dev than this can't be matched
+
+# Serialized form used by binary macros and the journal:
+# i32 ref_x, i32 ref_y, u16 width, u16 height, then width*height bytes
+ANCHOR_HEADER = struct.Struct('<iiHH')
+
+
+class Anchor:
+    """
+    Grayscale patch (width*height bytes, row-major) that was on screen with
+    its top-left corner at (ref_x, ref_y) when the step was anchored.
+    """
+    __slots__ = ('ref_x', 'ref_y', 'width', 'height', 'pixels', '_key')
+
+    def __init__(self, ref_x, ref_y, width, height, pixels):
+        if len(pixels) != width * height:
+            raise ValueError(f"anchor patch has {len(pixels)} bytes, expected {width * height}")
+        self.ref_x = int(ref_x)
+        self.ref_y = int(ref_y)
+        self.width = int(width)
+        self.height = int(height)
+        self.pixels = bytes(pixels)
+        self._key = None
+
+    @property
+    def key(self):
+        """Content hash, used to cache match locations"""
+        if self._key is None:
+            self._key = hashlib.blake2b(self.pixels, digest_size=8,
+                                        key=struct.pack('<HH', self.width, self.height)).hexdigest()
+        return self._key
+
+    def __eq__(self, other):
+        return (isinstance(other, Anchor) and self.key == other.key and
+                (self.ref_x, self.ref_y) == (other.ref_x, other.ref_y))
+
+    def __hash__(self):
+        return hash((self.key, self.ref_x, self.ref_y))
+
+    def __repr__(self):
+        return f"Anchor({self.width}x{self.height} at ({self.ref_x}, {self.ref_y}))"
+
+    def array(self):
+        """The patch as a float NumPy array"""
+        return np.frombuffer(self.pixels, dtype=np.uint8).reshape(self.height, self.width).astype(np.float64)
+
+    # --- serialization ---
+
+    def to_dict(self):
+        return {
+            'ref_x': self.ref_x,
+            'ref_y': self.ref_y,
+            'width': self.width,
+            'height': self.height,
+            'pixels': base64.b64encode(self.pixels).decode('ascii'),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['ref_x'], data['ref_y'], data['width'], data['height'],
+                   base64.b64decode(data['pixels']))
+
+    def pack(self):
+        return ANCHOR_HEADER.pack(self.ref_x, self.ref_y, self.width, self.height) + self.pixels
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        """Returns (anchor, offset after it); raises ValueError if truncated"""
+        if offset + ANCHOR_HEADER.size > len(buffer):
+            raise ValueError("truncated anchor")
+        ref_x, ref_y, width, height = ANCHOR_HEADER.unpack_from(buffer, offset)
+        start = offset + ANCHOR_HEADER.size
+        end = start + width * height
+        if end > len(buffer):
+            raise ValueError("truncated anchor")
+        return cls(ref_x, ref_y, width, height, bytes(buffer[start:end])), end
+
+
+def to_gray(image):
+    """Convert a PIL image or an (H, W[, 3|4]) array to a 2D float array"""
+    if hasattr(image, 'convert'):
+        image = image.convert('L')
+    image = np.asarray(image)
+    if image.ndim == 3:
+        image = image[..., :3] @ np.array([0.299, 0.587, 0.114])
+    return image.astype(np.float64, copy=False)
+
+
+def capture_anchor(screen, x, y, size=ANCHOR_SIZE, origin=(0, 0)):
+    """
+    Cut an Anchor centered on (x, y) out of a grayscale screenshot whose
+    top-left pixel is at screen position `origin`. Returns None if the
+    patch has too little contrast to be found again.
+    """
+    screen = to_gray(screen)
+    height, width = screen.shape
+    left = min(max(int(x) - origin[0] - size // 2, 0), max(width - size, 0))
+    top = min(max(int(y) - origin[1] - size // 2, 0), max(height - size, 0))
+    patch = screen[top:top + size, left:left + size]
+    if patch.size == 0 or patch.std() < MIN_CONTRAST:
+        return None
+    pixels = np.clip(np.rint(patch), 0, 255).astype(np.uint8)
+    return Anchor(left + origin[0], top + origin[1], patch.shape[1], patch.shape[0], pixels.tobytes())
+
+
+# --- correlation ---
+
+def _box_sums(integral, h, w):
+    """Sums of every h*w window, from a zero-padded integral image"""
+    return integral[h:, w:] - integral[:-h, w:] - integral[h:, :-w] + integral[:-h, :-w]
+
+
+def ncc_map(image, template):
+    """
+    NCC score of the template at every position where it fits in the image,
+    as an array of shape (H - h + 1, W - w + 1). Flat windows score 0.
+    """
+    h, w = template.shape
+    H, W = image.shape
+    if H < h or W < w:
+        return np.zeros((0, 0))
+    t = template - template.mean()
+    t_norm = np.sqrt((t * t).sum())
+    if t_norm == 0:
+        return np.zeros((H - h + 1, W - w + 1))
+
+    # Numerator: correlation with the zero-mean template (window mean cancels out)
+    shape = (H, W)
+    numerator = np.fft.irfft2(np.fft.rfft2(image, shape) * np.conj(np.fft.rfft2(t, shape)), shape)
+    numerator = numerator[:H - h + 1, :W - w + 1]
+
+    integral = np.zeros((H + 1, W + 1))
+    integral[1:, 1:] = image.cumsum(0).cumsum(1)
+    integral_sq = np.zeros((H + 1, W + 1))
+    integral_sq[1:, 1:] = (image * image).cumsum(0).cumsum(1)
+    sums = _box_sums(integral, h, w)
+    variance = _box_sums(integral_sq, h, w) - sums * sums / (h * w)
+    denominator = np.sqrt(np.maximum(variance, 0)) * t_norm
+
+    scores = np.zeros_like(numerator)
+    valid = denominator > 1e-6 * t_norm
+    scores[valid] = numerator[valid] / denominator[valid]
+    return scores
+
+
+def ncc_at(image, template, x, y):
+    """NCC score of the template with its top-left corner at (x, y)"""
+    h, w = template.shape
+    window = image[y:y + h, x:x + w]
+    if window.shape != template.shape:
+        return 0.0
+    t = template - template.mean()
+    v = window - window.mean()
+    denominator = np.sqrt((t * t).sum() * (v * v).sum())
+    return float((t * v).sum() / denominator) if denominator > 0 else 0.0
+
+
+def downsample(image):
+    """Halve an image by averaging 2x2 blocks"""
+    h, w = image.shape[0] // 2 * 2, image.shape[1] // 2 * 2
+    image = image[:h, :w]
+    return (image[0::2, 0::2] + image[1::2, 0::2] + image[0::2, 1::2] + image[1::2, 1::2]) * 0.25
+
+
+def _peaks(scores, count, radius):
+    """Positions (x, y) of the `count` best scores, at least `radius` apart"""
+    scores = scores.copy()
+    peaks = []
+    for _ in range(count):
+        index = int(scores.argmax())
+        y, x = divmod(index, scores.shape[1])
+        if scores[y, x] <= 0:
+            break
+        peaks.append((x, y))
+        scores[max(0, y - radius):y + radius + 1, max(0, x - radius):x + radius + 1] = -1
+    return peaks
+
+
+def pyramid_search(image, template, min_template=MIN_TEMPLATE, candidates=CANDIDATES):
+    """
+    Best match of the template in the image, coarse to fine.
+    Returns (x, y, score) of the template's top-left corner, or None.
+    """
+    images = [image]
+    templates = [template]
+    while (min(templates[-1].shape) // 2 >= min_template and
+           images[-1].shape[0] // 2 >= templates[-1].shape[0] // 2 and
+           images[-1].shape[1] // 2 >= templates[-1].shape[1] // 2):
+        images.append(downsample(images[-1]))
+        templates.append(downsample(templates[-1]))
+
+    top = len(images) - 1
+    coarse = ncc_map(images[top], templates[top])
+    if coarse.size == 0:
+        return None
+
+    best = None
+    for x, y in _peaks(coarse, candidates, max(1, min(templates[top].shape) // 2)):
+        score = coarse[y, x]
+        for level in range(top - 1, -1, -1):
+            level_image, level_template = images[level], templates[level]
+            h, w = level_template.shape
+            x0 = max(0, 2 * x - REFINE_RADIUS)
+            y0 = max(0, 2 * y - REFINE_RADIUS)
+            x1 = min(level_image.shape[1] - w, 2 * x + REFINE_RADIUS)
+            y1 = min(level_image.shape[0] - h, 2 * y + REFINE_RADIUS)
+            if x1 < x0 or y1 < y0:
+                break
+            scores = ncc_map(level_image[y0:y1 + h, x0:x1 + w], level_template)
+            index = int(scores.argmax())
+            dy, dx = divmod(index, scores.shape[1])
+            x, y, score = x0 + dx, y0 + dy, scores[dy, dx]
+        if best is None or score > best[2]:
+            best = (x, y, float(score))
+    return best
+
+
+class TemplateMatcher:
+    """
+    Locates anchors on screen, remembering where each one was last found.
+    `grab(left, top, width, height)` returns a grayscale screenshot of that
+    region; `screen_size` is (width, height).
+    """
+
+    def __init__(self, threshold=MATCH_THRESHOLD, roi_margin=ROI_MARGIN, cache_size=CACHE_SIZE):
+        if np is None:
+            raise RuntimeError("anchor matching needs NumPy")
+        self.threshold = threshold
+        self.roi_margin = roi_margin
+        self.cache_size = cache_size
+        self._last = OrderedDict()  # anchor key -> (x, y) of the last hit
+        self._templates = OrderedDict()  # anchor key -> float patch
+        # Lookups resolved by each stage, for tuning and benchmarks
+        self.stats = {'cache': 0, 'roi': 0, 'screen': 0, 'miss': 0}
+
+    def _template(self, anchor):
+        template = self._templates.get(anchor.key)
+        if template is None:
+            template = anchor.array()
+            self._templates[anchor.key] = template
+            if len(self._templates) > self.cache_size:
+                self._templates.popitem(last=False)
+        return template
+
+    def _remember(self, anchor, x, y):
+        self._last[anchor.key] = (x, y)
+        self._last.move_to_end(anchor.key)
+        if len(self._last) > self.cache_size:
+            self._last.popitem(last=False)
+
+    def forget(self, anchor=None):
+        """Drop the cached location of one anchor, or of all of them"""
+        if anchor is None:
+            self._last.clear()
+        else:
+            self._last.pop(anchor.key, None)
+
+    def _search(self, grab, template, left, top, width, height):
+        image = to_gray(grab(left, top, width, height))
+        found = pyramid_search(image, template)
+        if found is None or found[2] < self.threshold:
+            return None
+        x, y, score = found
+        return left + x, top + y, score
+
+    def locate(self, anchor, grab, screen_size):
+        """
+        Find the anchor's patch on screen.
+        Returns (x, y, score) of its top-left corner, or None if not found.
+        """
+        template = self._template(anchor)
+        h, w = template.shape
+        screen_w, screen_h = screen_size
+        last = self._last.get(anchor.key)
+
+        # 1. Still where it was last time?
+        if last is not None and 0 <= last[0] <= screen_w - w and 0 <= last[1] <= screen_h - h:
+            score = ncc_at(to_gray(grab(last[0], last[1], w, h)), template, 0, 0)
+            if score >= self.threshold:
+                self.stats['cache'] += 1
+                self._last.move_to_end(anchor.key)
+                return last[0], last[1], score
+
+        # 2. Nearby: around the last hit, or where it was recorded
+        cx, cy = last if last is not None else (anchor.ref_x, anchor.ref_y)
+        margin = self.roi_margin
+        left = max(0, cx - margin)
+        top = max(0, cy - margin)
+        right = min(screen_w, cx + w + margin)
+        bottom = min(screen_h, cy + h + margin)
+        if right - left >= w and bottom - top >= h:
+            found = self._search(grab, template, left, top, right - left, bottom - top)
+            if found is not None:
+                self.stats['roi'] += 1
+                self._remember(anchor, found[0], found[1])
+                return found
+
+        # 3. Anywhere on screen
+        found = self._search(grab, template, 0, 0, screen_w, screen_h)
+        if found is not None:
+            self.stats['screen'] += 1
+            self._remember(anchor, found[0], found[1])
+            return found
+        self.stats['miss'] += 1
+        return None
@@ -3,46 +3,88 @@
 import tkinter as tk
 from tkinter import ttk
 
-# The file where the keyboard and mouse events are handled
-import clickanput as can
+import sys
+import threading
+
+# The file where the keyboard and mouse events are handled. With
+# --engine-process it runs in a separate process (see engine_process.py)
+# and `can` is a proxy for it, so GUI stalls can't delay capture or replay
+ENGINE_PROCESS = '--engine-process' in sys.argv[1:]
+# With --control[=ADDRESS] a local control server takes replay jobs from
+# other processes (see control_server.py); it runs where clickanput runs
+CONTROL = None
+for arg in sys.argv[1:]:
+    if arg == '--control' or arg.startswith('--control='):
+        import control_server
+        CONTROL = arg.partition('=')[2] or control_server.default_address()
+if ENGINE_PROCESS:
+    import engine_process
+    can = engine_process.EngineProxy(control_address=CONTROL).start()
+else:
+    import clickanput as can
 
 # Handle cleanup on exit
 import atexit
 
-import json
+import macro_io
+import screen_wait
+import event_log
+from event_log import log
+
+# The engine process runs its own control server
+control = None
+if CONTROL and not ENGINE_PROCESS:
+    try:
+        control = control_server.ControlServer(can, CONTROL).start()
+    except (OSError, ValueError) as e:
+        log.error('control', "Control server not started: {error}", error=e)
 
 import tkinter.filedialog as filedialog
 from Click import Click
-import pyautogui
+from backends import BACKENDS, BackendPool
+from click_table import VirtualClickTable
 
 save_file_name = 'test.json'
+# Backends picked in the GUI other than the default, created once and reused
+backend_pool = BackendPool()
 
 # Callback for window close event
 def on_closing():
     """Called when the window is closed"""
-    print("Closing application...")
+    log.info('app', "Closing application...")
+    can.unsubscribe_state(request_redraw)
     can.stop_listeners()
+    can.close_journal()
+    if control is not None:
+        control.close()
+    if ENGINE_PROCESS:
+        can.close()
+    else:
+        can.stop_replay()
+        can.replay_engine.join()
+    backend_pool.close()
     root.destroy()
 
 # Start replay in a separate thread
 def start_replay():
-    """Start replay in a separate thread"""
-    # Avoid starting multiple replay threads
-    if getattr(can, 'replaying', False):
-        print("Replay already running")
-        return
-
-    can.replaying = True
-    import threading
-    replay_thread = threading.Thread(target=can.replay_clicks)
-    replay_thread.daemon = True
-    replay_thread.start()
+    """Start replay on the replay engine (ignored if one is already running)"""
+    global backend_var
+    name = backend_var.get()
+    # The default backend is reused, the others come from the pool
+    if name == can.get_input_backend().name:
+        can.start_replay()
+    else:
+        can.start_replay(backend_pool.get(name))
 
 # Stop the current replay
 def stop_replay():
     """Stop the current replay"""
-    can.replaying = False
-    print("Replay stopped")
+    can.stop_replay()
+
+# Pause or resume the current replay
+def pause_replay():
+    """Toggle pause on the current replay"""
+    can.toggle_pause_replay()
 
 # Callback for spinbox value changes
 def update_step_time():
@@ -50,11 +92,10 @@ def update_step_time():
     global step_time_var
     try:
         new_time = float(step_time_var.get())
-        can.replay_step_time = new_time  # Update the value in clickanput module
-        can.pyautogui.PAUSE = new_time  # Update the pause in pyautogui
+        can.replay_step_time = new_time  # Update the value in clickanput module (the replay scheduler applies it)
         #print(f"Step time updated to: {new_time} seconds")
     except ValueError:
-        print("Invalid step time value")
+        log.warning('app', "Invalid step time value")
 
 # Callback for spinbox value changes needed a different function
 def on_spinbox_change(*args):
@@ -64,21 +105,9 @@ def on_spinbox_change(*args):
 # Get the absolute screen position and size of a button
 def get_button_position(button_widget):
     """Get the absolute screen position and size of a button"""
-    global root
-    # Update the widget to ensure geometry is calculated
-    button_widget.update_idletasks()
-    
-    # Get button position relative to root window
-    x = button_widget.winfo_x()
-    y = button_widget.winfo_y()
-    
-    # Get root window position on screen
-    root_x = root.winfo_rootx()
-    root_y = root.winfo_rooty()
-    
-    # Calculate absolute screen position
-    abs_x = root_x + x
-    abs_y = root_y + y
+    # Root coordinates are absolute, so widgets nested in frames work too
+    abs_x = button_widget.winfo_rootx()
+    abs_y = button_widget.winfo_rooty()
     
     # Get button size
     width = button_widget.winfo_width()
@@ -86,57 +115,77 @@ def get_button_position(button_widget):
     
     return abs_x, abs_y, width, height
 
+# Widgets whose screen area is excluded from recording
+EXCLUDED_WIDGET_TYPES = (tk.Button, tk.Checkbutton, tk.Entry, tk.Spinbox, ttk.Combobox, ttk.Treeview, ttk.Scrollbar)
+
+def iter_excluded_widgets(widget):
+    """Yield every interactive widget below widget"""
+    for child in widget.winfo_children():
+        if isinstance(child, EXCLUDED_WIDGET_TYPES):
+            yield child
+        yield from iter_excluded_widgets(child)
+
 # Register button exclusions to avoid recording clicks on own gui buttons
 def register_button_exclusions():
-    """Register all buttons to be excluded from recording"""
-    global record_button, start_replay_button, stop_replay_button, clear_button
+    """Register all interactive widgets to be excluded from recording"""
+    global root, exclusion_update_pending
+    exclusion_update_pending = None
     try:
-        # Clear existing exclusions
-        can.clear_button_exclusions()
-        
-        # Get positions for all buttons that should be excluded
-        buttons_to_exclude = [record_button, start_replay_button, stop_replay_button, clear_button]
-        
-        for button in buttons_to_exclude:
-            if button.winfo_exists():
-                x, y, w, h = get_button_position(button)
-                can.add_button_exclusion(x, y, w, h)
+        # Update once so every widget's geometry is calculated
+        root.update_idletasks()
+
+        # Only rectangles that actually moved touch the exclusion index
+        seen = set()
+        for widget in iter_excluded_widgets(root):
+            key = str(widget)
+            seen.add(key)
+            if widget.winfo_ismapped():
+                can.set_exclusion(key, *get_button_position(widget))
+            else:
+                can.remove_exclusion(key)
+        for key in can.exclusion_keys():
+            if key not in seen and key.startswith('.'):
+                can.remove_exclusion(key)  # destroyed widget
     except Exception as e:
-        print(f"Error registering button exclusions: {e}")
+        log.error('app', "Error registering button exclusions: {error}", error=e)
+    request_redraw()  # the exclusion count is part of the status
+
+# Pending after() id of the coalesced exclusion update
+exclusion_update_pending = None
 
 def on_window_configure(event):
     """Called when window is moved or resized"""
-    global root
+    global root, exclusion_update_pending
     if event.widget == root:  # Only respond to root window events
-        # Small delay to ensure geometry is updated
-        root.after(100, register_button_exclusions)
+        # Coalesce a burst of <Configure> events into one update, run once
+        # the window has been still for a moment
+        if exclusion_update_pending is not None:
+            root.after_cancel(exclusion_update_pending)
+        exclusion_update_pending = root.after(100, register_button_exclusions)
 
-# Save recorded clicks to a JSON file
+# Save recorded clicks to a JSON (or binary .mvb) file
 def save_recorded_clicks():
-    """Save recorded clicks to a JSON file"""
+    """Save recorded clicks to a JSON file, or a binary macro if the name ends in .mvb"""
     global can, save_file_name
 
-    # Convert Click objects to dictionaries
-    click_data = [click_obj.to_dict() for click_obj in can.click_positions]
-   
-    with open(save_file_name, 'w+') as f:
-        json.dump(click_data, f, indent=2)
-    print(f"Recorded clicks saved to {save_file_name}")
+    macro_io.save(save_file_name, can.click_positions)
+    can.compact_journal(save_file_name)
+    log.info('app', "Recorded clicks saved to {path}", path=save_file_name)
 
 
-# Load recorded clicks from a JSON file
+# Load recorded clicks from a JSON or binary macro file
 def load_recorded_clicks():
-    """Load recorded clicks from a JSON file"""
+    """Load recorded clicks from a JSON or binary macro file"""
     global can, save_file_name
     save_file_name = filedialog.askopenfilename(defaultextension=".json", initialdir=".",
-                                                   filetypes=[("JSON files", "*.json"), ("All files", "*.*")])
+                                                   filetypes=[("JSON files", "*.json"),
+                                                              ("Binary macros", "*" + macro_io.BINARY_EXT),
+                                                              ("All files", "*.*")])
     
-    with open(save_file_name, 'r') as f:
-        click_data = json.load(f)
-    
-    # Convert dictionaries back to Click objects
-    can.click_positions = [Click.from_dict(data) for data in click_data]
-    print(f"Loaded {len(can.click_positions)} recorded clicks from {save_file_name}")
+    # Steps recorded on another screen layout are mapped to this one
+    can.set_click_positions(macro_io.load(save_file_name, layout=can.current_layout()))
+    can.compact_journal(save_file_name)
+    log.info('app', "Loaded {count} recorded clicks from {path}", count=len(can.click_positions), path=save_file_name)
     
 
 # Initialize the main application window
@@ -151,7 +200,19 @@ root.geometry("900x800+50+50")
 
 # Set up window close handler
 root.protocol("WM_DELETE_WINDOW", on_closing)
-atexit.register(can.stop_listeners)
+if ENGINE_PROCESS:
+    atexit.register(can.close)  # the engine stops its listeners and journal on the way out
+else:
+    atexit.register(can.stop_listeners)
+    atexit.register(can.close_journal)
+if control is not None:
+    atexit.register(control.close)
+
+# Recover clicks left over from a previous session and journal new ones
+try:
+    can.open_journal()
+except OSError as e:
+    log.error('app', "Could not open recording journal: {error}", error=e)
 
 # Bind window configure event to update button positions
 root.bind('<Configure>', on_window_configure)
@@ -163,7 +224,7 @@ root.after(500, register_button_exclusions)
 try:
     can.start_keyboard_listener()
 except Exception as e:
-    print(f"Could not start keyboard listener automatically: {e}")
+    log.error('app', "Could not start keyboard listener automatically: {error}", error=e)
 
 # Keyboard listener controls
 listener_frame = tk.Frame(root, bg="lightblue")
@@ -190,9 +251,23 @@ stop_listener_button = tk.Button(listener_buttons_frame, text="Stop Keyboard Lis
                                 command=stop_keyboard_listener, width=20)
 stop_listener_button.pack(side=tk.LEFT, padx=5)
 
+def hotkeys_text(bindings):
+    return " | ".join(f"'{chord}' = {action}" for chord, action in bindings)
+
+def reload_hotkeys():
+    """Reload the hotkey bindings from the hotkeys file"""
+    try:
+        hotkeys_label.config(text=hotkeys_text(can.load_hotkeys()))
+    except Exception as e:
+        log.error('app', "Could not reload hotkeys: {error}", error=e)
+
+reload_hotkeys_button = tk.Button(listener_buttons_frame, text="Reload Hotkeys", command=reload_hotkeys, width=14)
+reload_hotkeys_button.pack(side=tk.LEFT, padx=5)
+
 tk.Label(listener_frame, text="Hotkeys work only when keyboard listener is active:", bg="lightblue").pack(pady=2)
-tk.Label(listener_frame, text="'d' = toggle recording | 'y' = toggle replay | 'c' = clear | 'q' = stop recording | 'Q' = exit", 
-         bg="lightblue", font=("Arial", 8)).pack(pady=2)
+hotkeys_label = tk.Label(listener_frame, text=hotkeys_text(can.hotkey_bindings()),
+                         bg="lightblue", font=("Arial", 8))
+hotkeys_label.pack(pady=2)
 
 # GUI Elements
 tk.Label(root, text="Toggle recording clicks", bg="lightblue").pack(pady=5)
@@ -209,6 +284,25 @@ start_replay_button = tk.Button(replay_frame, text="Start Replay", command=start
 start_replay_button.pack(side=tk.LEFT, padx=2)
 stop_replay_button = tk.Button(replay_frame, text="Stop Replay", command=stop_replay, width=15)
 stop_replay_button.pack(side=tk.LEFT, padx=2)
+pause_replay_button = tk.Button(replay_frame, text="Pause/Resume", command=pause_replay, width=15)
+pause_replay_button.pack(side=tk.LEFT, padx=2)
+
+# Opt-in replay tracing (Chrome Trace Event JSON, see replay_trace.py)
+def on_trace_toggle():
+    can.trace_replay = trace_replay_var.get()
+
+def export_replay_trace():
+    """Save the trace of the last traced replay"""
+    path = filedialog.asksaveasfilename(defaultextension=".json", initialdir=".", initialfile="replay_trace.json",
+                                        filetypes=[("Trace files", "*.json"), ("All files", "*.*")])
+    if path:
+        can.export_trace(path)
+
+trace_replay_var = tk.BooleanVar(value=can.trace_replay)
+tk.Checkbutton(replay_frame, text="Trace", variable=trace_replay_var, command=on_trace_toggle,
+               bg="lightblue").pack(side=tk.LEFT, padx=2)
+export_trace_button = tk.Button(replay_frame, text="Export Trace", command=export_replay_trace, width=12)
+export_trace_button.pack(side=tk.LEFT, padx=2)
 
 # Step time controls
 step_time_frame = tk.Frame(root, bg="lightblue")
@@ -229,9 +323,49 @@ step_time_spinbox.bind('<FocusOut>', lambda event: on_spinbox_change())
 step_time_spinbox.bind('<Return>', lambda event: on_spinbox_change())
 step_time_spinbox.pack(side=tk.LEFT, padx=2)
 
+# Input backend used for the next replay ('headless'/'null' are dry runs)
+tk.Label(step_time_frame, text="Backend:", bg="lightblue").pack(side=tk.LEFT, padx=2)
+backend_var = tk.StringVar(value='pyautogui')
+backend_combo = ttk.Combobox(step_time_frame, textvariable=backend_var, values=list(BACKENDS), state='readonly', width=10)
+backend_combo.pack(side=tk.LEFT, padx=2)
+
+# Console log level; DEBUG also logs every replayed action
+def on_log_level_change(*args):
+    can.set_log_level(log_level_var.get())
+
+tk.Label(step_time_frame, text="Log:", bg="lightblue").pack(side=tk.LEFT, padx=2)
+log_level_var = tk.StringVar(value=event_log.LEVEL_NAMES[event_log.log.level])
+log_level_var.trace_add('write', on_log_level_change)
+ttk.Combobox(step_time_frame, textvariable=log_level_var, values=list(event_log.LEVELS), state='readonly',
+             width=8).pack(side=tk.LEFT, padx=2)
+
 # Initialize the step time in clickanput module
 can.replay_step_time = 0.1
 
+# Mouse path recording (moves and drags), applied when recording starts
+path_frame = tk.Frame(root, bg="lightblue")
+path_frame.pack(pady=5)
+
+def on_record_moves_change(*args):
+    """Update the mouse path recording options in clickanput"""
+    can.record_moves = record_moves_var.get()
+    can.record_keys = record_keys_var.get()
+    try:
+        can.move_tolerance = float(move_tolerance_var.get())
+    except ValueError:
+        log.warning('app', "Invalid path tolerance value")
+
+record_moves_var = tk.BooleanVar(value=False)
+tk.Checkbutton(path_frame, text="Record mouse moves and drags", variable=record_moves_var,
+               command=on_record_moves_change, bg="lightblue").pack(side=tk.LEFT, padx=2)
+record_keys_var = tk.BooleanVar(value=False)
+tk.Checkbutton(path_frame, text="Record keys", variable=record_keys_var,
+               command=on_record_moves_change, bg="lightblue").pack(side=tk.LEFT, padx=2)
+tk.Label(path_frame, text="Path tolerance (px):", bg="lightblue").pack(side=tk.LEFT, padx=2)
+move_tolerance_var = tk.StringVar(value=str(can.move_tolerance))
+move_tolerance_var.trace_add('write', on_record_moves_change)
+tk.Spinbox(path_frame, from_=0.5, to=50.0, increment=0.5, textvariable=move_tolerance_var, width=6).pack(side=tk.LEFT, padx=2)
+
 # Click editing table
 click_table_frame = tk.Frame(root, bg="lightblue")
 click_table_frame.pack(pady=10, fill=tk.BOTH, expand=True)
@@ -239,9 +373,10 @@ click_table_frame.pack(pady=10, fill=tk.BOTH, expand=True)
 tk.Label(click_table_frame, text="Click Editor - Edit individual clicks:", bg="lightblue", font=("Arial", 10, "bold")).pack(pady=5)
 
 
-# Create Treeview for click editing (added per-row Scroll column)
-columns = ('index', 'x', 'y', 'delay', 'offset_x', 'offset_y', 'scroll', 'double_click')
-click_tree = ttk.Treeview(click_table_frame, columns=columns, show='headings', height=6)
+# Create Treeview for click editing (added per-row Scroll column).
+# Only the visible rows exist as Treeview items, see click_table.py
+click_table = VirtualClickTable(click_table_frame, height=6)
+click_tree = click_table.tree
 
 # Define column headings
 click_tree.heading('index', text='#')
@@ -263,34 +398,14 @@ click_tree.column('offset_y', width=80, anchor='center')
 click_tree.column('scroll', width=80, anchor='center')
 click_tree.column('double_click', width=100, anchor='center')
 
+# Scrollbar first, so it keeps its space when the window shrinks
+click_table.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
 click_tree.pack(fill=tk.BOTH, expand=True)
 
-# Scrollbar for the treeview
-scrollbar = ttk.Scrollbar(click_table_frame, orient=tk.VERTICAL, command=click_tree.yview)
-click_tree.configure(yscroll=scrollbar.set)
-scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-
 # Function to refresh the click table
 def refresh_click_table():
-    """Refresh the click table with current click positions"""
-    # Clear existing items
-    for item in click_tree.get_children():
-        click_tree.delete(item)
-    
-    # Add current clicks
-    for i, click_obj in enumerate(can.click_positions):
-        # Show scroll amount in its own column; double-click column shows Yes/No
-        scroll_val = click_obj.scroll_amount if getattr(click_obj, 'is_scroll', False) else 0
-        click_tree.insert('', tk.END, values=(
-            i+1,
-            click_obj.x,
-            click_obj.y,
-            click_obj.delay,
-            click_obj.offset_x,
-            click_obj.offset_y,
-            scroll_val,
-            'Yes' if click_obj.is_double_click else 'No'
-        ))
+    """Show the current click list; later changes are applied as row updates"""
+    click_table.bind(can.click_positions)
 
 # Function to handle cell editing
 def on_tree_double_click(event):
@@ -304,9 +419,21 @@ def on_tree_double_click(event):
     
     if not row or not column:
         return
+    # Empty slots below the last click aren't editable
+    click_index = click_table.index_of(row)
+    if click_index is None:
+        return
     
     # Get column index
     col_index = int(column[1:]) - 1  # ttk columns are 1-indexed
+    # A wait step's scroll field holds its condition id, so it has no scroll or click type
+    if col_index in (6, 7) and can.click_positions[click_index].condition is not None:
+        log.warning('app', "Step {step} is a wait step; delete it to go back to the fixed delay", step=click_index + 1)
+        return
+    # Likewise a key step's scroll field holds its key code
+    if col_index in (6, 7) and can.click_positions[click_index].key is not None:
+        log.warning('app', "Step {step} is a key step", step=click_index + 1)
+        return
     
     # Get current value
     item = click_tree.item(row)
@@ -345,7 +472,8 @@ def on_tree_double_click(event):
                 new_value = float(new_value)
             elif col_index == 7:  # Double click - boolean
                 nv = str(new_value).strip()
-                new_value_bool = nv.lower() in ('yes', 'true', '1', 'y')
+                # Ignore the ' (anchored)' note the table adds
+                new_value_bool = nv.split(' (')[0].lower() in ('yes', 'true', '1', 'y')
                 new_value = 'Yes' if new_value_bool else 'No'
             
             # Update the values list
@@ -353,8 +481,8 @@ def on_tree_double_click(event):
             values[col_index] = new_value
             click_tree.item(row, values=values)
             
-            # Update the actual Click object
-            click_index = int(values[0]) - 1
+            # Update the actual Click object (the slot may show another row by now,
+            # so use the index captured when editing started)
             if 0 <= click_index < len(can.click_positions):
                 click_obj = can.click_positions[click_index]
                 if col_index == 1:  # X
@@ -373,11 +501,12 @@ def on_tree_double_click(event):
                 elif col_index == 7:  # Double click
                     click_obj.is_scroll = False
                     click_obj.is_double_click = (new_value == 'Yes')
+                can.step_edited(click_index)
             
-            print(f"Updated click {click_index + 1}: {values}")
+            log.info('app', "Updated click {step}: {values}", step=click_index + 1, values=values)
             
         except ValueError as e:
-            print(f"Invalid value: {e}")
+            log.warning('app', "Invalid value: {error}", error=e)
         
         entry.destroy()
     
@@ -396,6 +525,62 @@ click_tree.bind('<Double-1>', on_tree_double_click)
 refresh_table_button = tk.Button(click_table_frame, text="Refresh Table", command=refresh_click_table, width=15)
 refresh_table_button.pack(pady=5)
 
+def optimize_clicks():
+    """Shrink the click list: merge scrolls, fold double clicks, drop redundant moves"""
+    report = can.optimize_clicks()
+    if report is not None:
+        log.info('app', "Removed {removed} steps, about {saved:.3f}s saved per cycle",
+                 removed=report.removed, saved=report.saved_s)
+
+optimize_button = tk.Button(click_table_frame, text="Optimize", command=optimize_clicks, width=15)
+optimize_button.pack(pady=2)
+
+# Anchor the selected steps to what is on screen around them now
+def anchor_selected_steps():
+    """Anchor the selected steps to the screen patch around their position"""
+    indexes = [click_table.index_of(item) for item in click_tree.selection()]
+    indexes = [i for i in indexes if i is not None]
+    if not indexes:
+        log.warning('app', "Select the steps to anchor first")
+        return
+    backend = backend_pool.get(backend_var.get()) if backend_var.get() != can.get_input_backend().name else None
+    for index in indexes:
+        try:
+            can.anchor_step(index, backend)
+        except Exception as e:
+            log.error('app', "Could not anchor step {step}: {error}", step=index + 1, error=e)
+
+anchor_button = tk.Button(click_table_frame, text="Anchor Selected Steps", command=anchor_selected_steps, width=20)
+anchor_button.pack(pady=2)
+
+# Wait-step controls: condition kind + insert button
+wait_control_frame = tk.Frame(click_table_frame, bg="lightblue")
+wait_control_frame.pack(pady=4)
+
+tk.Label(wait_control_frame, text="Wait for screen:", bg="lightblue").pack(side=tk.LEFT, padx=2)
+wait_kind_var = tk.StringVar(value=screen_wait.CHANGE)
+wait_kind_combo = ttk.Combobox(wait_control_frame, textvariable=wait_kind_var, values=list(screen_wait.KINDS),
+                               state='readonly', width=8)
+wait_kind_combo.pack(side=tk.LEFT, padx=2)
+
+def wait_before_selected_steps():
+    """Replace the delay before each selected step with a wait for the screen around it"""
+    indexes = [click_table.index_of(item) for item in click_tree.selection()]
+    indexes = [i for i in indexes if i is not None]
+    if not indexes:
+        log.warning('app', "Select the steps to wait for first")
+        return
+    backend = backend_pool.get(backend_var.get()) if backend_var.get() != can.get_input_backend().name else None
+    # Highest first, so inserting a wait doesn't shift the steps still to do
+    for index in sorted(indexes, reverse=True):
+        try:
+            can.add_wait_step(index, wait_kind_var.get(), backend)
+        except Exception as e:
+            log.error('app', "Could not add a wait before step {step}: {error}", step=index + 1, error=e)
+
+wait_button = tk.Button(wait_control_frame, text="Wait Before Selected", command=wait_before_selected_steps)
+wait_button.pack(side=tk.LEFT, padx=6)
+
 # Scroll-action controls: amount + add button
 scroll_control_frame = tk.Frame(click_table_frame, bg="lightblue")
 scroll_control_frame.pack(pady=4)
@@ -410,19 +595,18 @@ def add_scroll_at_cursor():
     try:
         amount = int(scroll_amount_var.get())
     except ValueError:
-        print("Invalid scroll amount")
+        log.warning('app', "Invalid scroll amount")
         return
 
     try:
-        mx, my = pyautogui.position()
+        mx, my = can.get_input_backend().position()
     except Exception as e:
-        print(f"Could not get mouse position: {e}")
+        log.error('app', "Could not get mouse position: {error}", error=e)
         return
 
     scroll_click = Click(x=mx, y=my, delay=0, is_double_click=False, offset_x=0, offset_y=0, is_scroll=True, scroll_amount=amount)
-    can.click_positions.append(scroll_click)
-    print(f"Added scroll action at ({mx},{my}) amount={amount}")
-    refresh_click_table()
+    can.add_step(scroll_click)
+    log.info('app', "Added scroll action at ({x},{y}) amount={amount}", x=mx, y=my, amount=amount)
 
 add_scroll_button = tk.Button(scroll_control_frame, text="Add Scroll at Cursor", command=add_scroll_at_cursor)
 add_scroll_button.pack(side=tk.LEFT, padx=6)
@@ -431,54 +615,137 @@ add_scroll_button.pack(side=tk.LEFT, padx=6)
 tk.Label(root, text="Clear recorded clicks", bg="lightblue").pack(pady=5)
 clear_button = tk.Button(root, text="Clear clickpoints", command=can.clear_clicks, width=20)
 clear_button.pack(pady=2)
+undo_clear_button = tk.Button(root, text="Undo clear", command=can.restore_cleared_clicks, width=20)
+undo_clear_button.pack(pady=2)
 
 # Status display
 status_frame = tk.Frame(root, bg="lightblue")
 status_frame.pack(pady=10)
 tk.Label(status_frame, text="Status:", bg="lightblue", font=("Arial", 10, "bold")).pack()
 
+# Redraws are driven by clickanput state events. Those come from the
+# listener, replay and engine threads, which must not touch Tk: they only set
+# a flag, and the Tk thread checks it once per frame, so a burst of events
+# costs one redraw
+FRAME_MS = 16
+# Default rate (Hz) of the opt-in mouse position display
+CURSOR_TRACK_HZ = 10
+
+status_label = tk.Label(status_frame, text="", bg="lightblue", font=("Arial", 9))
+status_label.pack()
+# Replay metrics, refreshed when a cycle ends
+metrics_label = tk.Label(status_frame, text="", bg="lightblue", font=("Arial", 9))
+metrics_label.pack()
+
+status_dirty = threading.Event()
+cursor_text = ""  # Mouse position part of the status, empty while not tracking
+
+def request_redraw(kind=None):
+    """Ask for a status redraw on the next frame; safe to call from any thread"""
+    status_dirty.set()
+
+def poll_status():
+    """Redraw the status if it was asked for since the last frame (Tk thread)"""
+    if status_dirty.is_set():
+        update_status()
+    root.after(FRAME_MS, poll_status)
+
+def format_replay_metrics(snapshot):
+    """One status line from event_log.metrics: actions, backend latency, lateness"""
+    counters, histograms = snapshot['counters'], snapshot['histograms']
+    if not counters.get('actions'):
+        return ""
+    text = f"Actions: {counters['actions']} in {counters.get('cycles', 0)} cycles"
+    clicks = histograms.get('action.click')
+    if clicks:
+        text += f" | Click call p50 {clicks['p50_ms']:.2f}ms p99 {clicks['p99_ms']:.2f}ms"
+    lateness = histograms.get('lateness')
+    if lateness:
+        text += f" | Late p99 {lateness['p99_ms']:.2f}ms max {lateness['max_ms']:.2f}ms"
+    return text
+
 # Function to update status display at bottom
 def update_status():
-    """Update status display"""
+    """Redraw the status display and apply pending click table changes"""
+    status_dirty.clear()  # before reading the state, so later changes redraw again
+
     # Check if listeners are running
     kb_running = can.key_listener and can.key_listener.running
     mouse_running = can.mouse_listener and can.mouse_listener.running
     
-    # Get current mouse position
-    try:
-        mouse_x, mouse_y = pyautogui.position()
-        mouse_pos_text = f" | Mouse: ({mouse_x}, {mouse_y})"
-    except Exception as e:
-        mouse_pos_text = " | Mouse: N/A"
-    
     status_text = f"Recording: {'ON' if can.recording else 'OFF'} | "
-    status_text += f"Replaying: {'ON' if can.replaying else 'OFF'} | "
+    replay_state = 'PAUSED' if can.replay_engine.is_paused else ('ON' if can.replay_engine.is_running else 'OFF')
+    status_text += f"Replaying: {replay_state} | "
     status_text += f"Clicks recorded: {len(can.click_positions)} | "
     status_text += f"Button exclusions: {len(can.button_exclusions)} | "
     status_text += f"Keyboard Listener: {'ON' if kb_running else 'OFF'} | "
     status_text += f"Mouse Listener: {'ON' if mouse_running else 'OFF'}"
-    status_text += mouse_pos_text
+    status_text += cursor_text
     
-    if hasattr(update_status, 'status_label'):
-        update_status.status_label.config(text=status_text)
-    else:
-        update_status.status_label = tk.Label(status_frame, text=status_text, bg="lightblue", font=("Arial", 9))
-        update_status.status_label.pack()
+    if status_label.cget('text') != status_text:
+        status_label.config(text=status_text)
+
+    metrics_text = format_replay_metrics(can.metrics_snapshot())
+    if metrics_label.cget('text') != metrics_text:
+        metrics_label.config(text=metrics_text)
     
-    # Auto-refresh click table when clicks change
-    if hasattr(update_status, 'last_click_count'):
-        if update_status.last_click_count != len(can.click_positions):
-            refresh_click_table()
-    else:
+    # Apply click list changes to the table; a cleared or loaded list is a new store
+    if click_table.store is not can.click_positions:
         refresh_click_table()
-    
-    update_status.last_click_count = len(can.click_positions)
-    
-    # Schedule next update (ms)
-    root.after(100, update_status)  # Faster update for mouse position
+    else:
+        click_table.apply_changes()
+
+# Mouse position tracking polls the pointer, so it only runs when switched on
+cursor_track_pending = None
 
-# Start status updates
+def track_cursor():
+    """Poll the mouse position at the configured rate while tracking is on"""
+    global cursor_track_pending, cursor_text
+    cursor_track_pending = None
+    if not track_cursor_var.get():
+        return
+    try:
+        mouse_x, mouse_y = can.get_input_backend().position()
+        text = f" | Mouse: ({mouse_x}, {mouse_y})"
+    except Exception as e:
+        text = " | Mouse: N/A"
+    if text != cursor_text:
+        cursor_text = text
+        request_redraw()
+
+    try:
+        rate = float(cursor_rate_var.get())
+    except ValueError:
+        rate = CURSOR_TRACK_HZ
+    interval = max(FRAME_MS, int(1000 / max(rate, 0.1)))
+    cursor_track_pending = root.after(interval, track_cursor)
+
+def on_track_cursor_toggle():
+    """Start or stop mouse position tracking"""
+    global cursor_track_pending, cursor_text
+    if cursor_track_pending is not None:
+        root.after_cancel(cursor_track_pending)
+        cursor_track_pending = None
+    if track_cursor_var.get():
+        track_cursor()
+    else:
+        cursor_text = ""
+        request_redraw()
+
+cursor_frame = tk.Frame(status_frame, bg="lightblue")
+cursor_frame.pack()
+track_cursor_var = tk.BooleanVar(value=False)
+tk.Checkbutton(cursor_frame, text="Show mouse position", variable=track_cursor_var,
+               command=on_track_cursor_toggle, bg="lightblue").pack(side=tk.LEFT, padx=5)
+tk.Label(cursor_frame, text="Rate (Hz):", bg="lightblue").pack(side=tk.LEFT)
+cursor_rate_var = tk.StringVar(value=str(CURSOR_TRACK_HZ))
+cursor_rate_spinbox = tk.Spinbox(cursor_frame, from_=1, to=60, increment=1, width=4, textvariable=cursor_rate_var)
+cursor_rate_spinbox.pack(side=tk.LEFT, padx=5)
+
+# Redraw on every state change reported by clickanput, and once now
+can.subscribe_state(request_redraw)
 update_status()
+root.after(FRAME_MS, poll_status)
 
 save_n_load_frame = tk.Frame(root, bg="lightblue")
 save_n_load_frame.pack(pady=10)
@@ -493,7 +760,7 @@ def on_file_name_change():
     save_file_name = file_name_entry_var.get().strip()
     if len(save_file_name) > 20:
         return
-    if not save_file_name.endswith('.json'):
+    if not save_file_name.endswith(('.json', macro_io.BINARY_EXT)):
         save_file_name += '.json'
     if save_file_name_label:
         save_file_name_label.config(text=save_file_name)
@@ -0,0 +1,474 @@
+"""
+Input backends used by replay.
+
+Replay talks to an InputBackend instead of calling pyautogui directly, so a
+run can target the real desktop (PyAutoGuiBackend, or XTestBackend straight
+to an X server), an in-memory recorder (HeadlessBackend) or nothing at all
+(NullBackend). The last two make it possible to measure the engine without
+a display or OS input latency.
+
+Batching backends (batches = True) may hold actions back until flush().
+Replay flushes before it waits for a deadline that hasn't passed yet, so
+every action still goes out on time, and actions that are due at once (or
+late) go out together.
+"""
+import functools
+import threading
+import time
+from collections import deque
+
+
+class FailSafeError(RuntimeError):
+    """The pointer was in a screen corner, the emergency stop for replay"""
+
+
+class InputBackend:
+    """Interface every backend implements"""
+
+    name = 'base'
+    batches = False  # actions may be queued until flush()
+
+    def begin_run(self):
+        """Called on the replay thread before the first action of a run"""
+
+    def end_run(self):
+        """Called on the replay thread after the last action of a run"""
+
+    def flush(self):
+        """Send queued actions; only batching backends queue them"""
+
+    def close(self):
+        """Release what the backend holds (e.g. its X connection)"""
+
+    def move(self, x, y):
+        raise NotImplementedError
+
+    def click(self, x, y):
+        raise NotImplementedError
+
+    def double_click(self, x, y):
+        raise NotImplementedError
+
+    def scroll(self, amount):
+        raise NotImplementedError
+
+    def mouse_down(self, x, y):
+        """Press the left button at (x, y), the start of a drag"""
+        raise NotImplementedError
+
+    def mouse_up(self, x, y):
+        """Release the left button at (x, y), the end of a drag"""
+        raise NotImplementedError
+
+    def press_key(self, key):
+        """Press and release a key: a character or a keys.SPECIAL_KEYS name"""
+        raise NotImplementedError
+
+    def type_text(self, text):
+        """Type a run of printable characters in one call"""
+        raise NotImplementedError
+
+    def position(self):
+        raise NotImplementedError
+
+    def screen_size(self):
+        """(width, height) of the screen, used to locate anchors"""
+        raise NotImplementedError
+
+    def screenshot(self, left, top, width, height, color=False):
+        """
+        Grayscale (PIL image or 2D array) of a screen region, used to locate
+        anchors and by wait steps; RGB with color=True
+        """
+        raise NotImplementedError
+
+
+def _failsafe(method):
+    """Raise pyautogui's FailSafeException as FailSafeError, which replay stops on"""
+    @functools.wraps(method)
+    def action(self, *args):
+        try:
+            return method(self, *args)
+        except self.pyautogui.FailSafeException as e:
+            raise FailSafeError(str(e)) from e
+    return action
+
+
+class PyAutoGuiBackend(InputBackend):
+    """
+    Real mouse input through pyautogui.
+    With failsafe off, pyautogui's corner check is disabled during runs.
+    """
+
+    name = 'pyautogui'
+
+    def __init__(self, failsafe=True):
+        import pyautogui
+        self.pyautogui = pyautogui
+        self.failsafe = failsafe
+        self._saved = None
+
+    def begin_run(self):
+        # The replay scheduler owns all waiting, so pyautogui must not sleep on its own
+        self._saved = self.pyautogui.PAUSE, self.pyautogui.FAILSAFE
+        self.pyautogui.PAUSE = 0
+        self.pyautogui.FAILSAFE = self.failsafe
+
+    def end_run(self):
+        if self._saved is not None:
+            self.pyautogui.PAUSE, self.pyautogui.FAILSAFE = self._saved
+            self._saved = None
+
+    @_failsafe
+    def move(self, x, y):
+        self.pyautogui.moveTo(x, y)
+
+    @_failsafe
+    def click(self, x, y):
+        self.pyautogui.click(x, y)
+
+    @_failsafe
+    def double_click(self, x, y):
+        self.pyautogui.doubleClick(x, y)
+
+    @_failsafe
+    def scroll(self, amount):
+        self.pyautogui.scroll(int(amount))
+
+    @_failsafe
+    def mouse_down(self, x, y):
+        self.pyautogui.mouseDown(x, y)
+
+    @_failsafe
+    def mouse_up(self, x, y):
+        self.pyautogui.mouseUp(x, y)
+
+    @_failsafe
+    def press_key(self, key):
+        self.pyautogui.press(key)
+
+    @_failsafe
+    def type_text(self, text):
+        self.pyautogui.write(text)
+
+    def position(self):
+        x, y = self.pyautogui.position()
+        return x, y
+
+    def screen_size(self):
+        width, height = self.pyautogui.size()
+        return width, height
+
+    def screenshot(self, left, top, width, height, color=False):
+        image = self.pyautogui.screenshot(region=(left, top, width, height))
+        return image.convert('RGB' if color else 'L')
+
+
+class XTestBackend(InputBackend):
+    """
+    X11 input through the XTEST extension (python-xlib), without pyautogui's
+    per-call checks and sleeps.
+
+    fake_input() only queues a request on the X connection. flush() writes
+    the queue to the server in one go, so a run of actions costs one write
+    instead of a round-trip each; more than MAX_BATCH queued events are
+    flushed right away.
+
+    With failsafe on, an action raises FailSafeError when the pointer is in
+    a screen corner, like pyautogui's FAILSAFE. The pointer is queried once
+    before each batch instead of before every action.
+
+    Keys are sent as keycodes of the server's keymap, with Shift held for
+    characters on the shifted level; type_text() queues a whole run of
+    characters as one batch.
+    """
+
+    name = 'xtest'
+    batches = True
+    MAX_BATCH = 512
+    BUTTON_LEFT = 1
+    BUTTON_SCROLL_UP = 4
+    BUTTON_SCROLL_DOWN = 5
+    # keys.SPECIAL_KEYS names -> X keysym names
+    KEYSYM_NAMES = {
+        'enter': 'Return', 'tab': 'Tab', 'backspace': 'BackSpace', 'delete': 'Delete', 'esc': 'Escape',
+        'insert': 'Insert', 'up': 'Up', 'down': 'Down', 'left': 'Left', 'right': 'Right', 'home': 'Home',
+        'end': 'End', 'pageup': 'Prior', 'pagedown': 'Next',
+        **{f'f{n}': f'F{n}' for n in range(1, 13)},
+    }
+
+    def __init__(self, display=None, failsafe=True):
+        from Xlib import X, XK
+        from Xlib import display as xdisplay
+        from Xlib.ext import xtest
+        self._X = X
+        self._XK = XK
+        self._fake_input = xtest.fake_input
+        self.display = xdisplay.Display(display)
+        if not self.display.has_extension('XTEST'):
+            self.display.close()
+            raise RuntimeError("X server has no XTEST extension")
+        screen = self.display.screen()
+        self.root = screen.root
+        self.width = screen.width_in_pixels
+        self.height = screen.height_in_pixels
+        self.failsafe = failsafe
+        self.pending = 0  # events queued since the last flush
+        self.flushes = 0
+        self._keycodes = {}  # key -> (keycode, shifted), looked up once per key
+        self._shift = self.display.keysym_to_keycode(XK.string_to_keysym('Shift_L'))
+
+    def _check_failsafe(self):
+        pointer = self.root.query_pointer()
+        x, y = pointer.root_x, pointer.root_y
+        if x in (0, self.width - 1) and y in (0, self.height - 1):
+            raise FailSafeError(f"pointer in screen corner ({x}, {y})")
+
+    def _queue(self, event_type, detail=0, x=None, y=None):
+        if not self.pending and self.failsafe:
+            self._check_failsafe()
+        if x is None:
+            self._fake_input(self.display, event_type, detail)
+        else:
+            self._fake_input(self.display, event_type, detail, x=x, y=y)
+        self.pending += 1
+        if self.pending >= self.MAX_BATCH:
+            self.flush()
+
+    def _press_release(self, button, times=1):
+        for _ in range(times):
+            self._queue(self._X.ButtonPress, button)
+            self._queue(self._X.ButtonRelease, button)
+
+    def flush(self):
+        if self.pending:
+            self.display.flush()
+            self.pending = 0
+            self.flushes += 1
+
+    def end_run(self):
+        self.flush()
+
+    def move(self, x, y):
+        self._queue(self._X.MotionNotify, x=int(x), y=int(y))
+
+    def click(self, x, y):
+        self.move(x, y)
+        self._press_release(self.BUTTON_LEFT)
+
+    def double_click(self, x, y):
+        self.move(x, y)
+        self._press_release(self.BUTTON_LEFT, 2)
+
+    def scroll(self, amount):
+        # Positive amounts scroll up, as with pyautogui
+        amount = int(amount)
+        self._press_release(self.BUTTON_SCROLL_UP if amount > 0 else self.BUTTON_SCROLL_DOWN, abs(amount))
+
+    def mouse_down(self, x, y):
+        self.move(x, y)
+        self._queue(self._X.ButtonPress, self.BUTTON_LEFT)
+
+    def mouse_up(self, x, y):
+        self.move(x, y)
+        self._queue(self._X.ButtonRelease, self.BUTTON_LEFT)
+
+    def _keycode(self, key):
+        found = self._keycodes.get(key)
+        if found is None:
+            if len(key) == 1:
+                # Latin-1 keysyms are the code point, the rest are offset by 0x01000000
+                keysym = ord(key) if ord(key) < 0x100 else 0x01000000 | ord(key)
+            else:
+                keysym = self._XK.string_to_keysym(self.KEYSYM_NAMES.get(key, key))
+            keycode = self.display.keysym_to_keycode(keysym) if keysym else 0
+            if not keycode:
+                raise ValueError(f"no keycode for key {key!r}")
+            found = keycode, self.display.keycode_to_keysym(keycode, 0) != keysym
+            self._keycodes[key] = found
+        return found
+
+    def press_key(self, key):
+        keycode, shifted = self._keycode(key)
+        if shifted:
+            self._queue(self._X.KeyPress, self._shift)
+        self._queue(self._X.KeyPress, keycode)
+        self._queue(self._X.KeyRelease, keycode)
+        if shifted:
+            self._queue(self._X.KeyRelease, self._shift)
+
+    def type_text(self, text):
+        for char in text:
+            self.press_key(char)
+
+    def position(self):
+        self.flush()
+        pointer = self.root.query_pointer()
+        return pointer.root_x, pointer.root_y
+
+    def screen_size(self):
+        return self.width, self.height
+
+    def screenshot(self, left, top, width, height, color=False):
+        from PIL import Image
+        self.flush()
+        raw = self.root.get_image(left, top, width, height, self._X.ZPixmap, 0xFFFFFFFF)
+        image = Image.frombytes('RGB', (width, height), raw.data, 'raw', 'BGRX')
+        return image if color else image.convert('L')
+
+    def close(self):
+        self.flush()
+        self.display.close()
+
+
+class HeadlessBackend(InputBackend):
+    """
+    Records every action as (monotonic_ns, action, x, y, amount) in memory.
+    With max_actions set, only the most recent actions are kept.
+    `screen` is a 2D array that stands in for the screen when anchors are
+    located, e.g. a synthetic screenshot in a test.
+    """
+
+    name = 'headless'
+
+    def __init__(self, max_actions=None, start_position=(0, 0), screen=None):
+        self.actions = deque(maxlen=max_actions)
+        self._x, self._y = start_position
+        self.screen = screen
+
+    def _record(self, action, x, y, amount=0):
+        self.actions.append((time.monotonic_ns(), action, x, y, amount))
+
+    def move(self, x, y):
+        self._x, self._y = x, y
+        self._record('move', x, y)
+
+    def click(self, x, y):
+        self._x, self._y = x, y
+        self._record('click', x, y)
+
+    def double_click(self, x, y):
+        self._x, self._y = x, y
+        self._record('double_click', x, y)
+
+    def scroll(self, amount):
+        self._record('scroll', self._x, self._y, amount)
+
+    def mouse_down(self, x, y):
+        self._x, self._y = x, y
+        self._record('mouse_down', x, y)
+
+    def mouse_up(self, x, y):
+        self._x, self._y = x, y
+        self._record('mouse_up', x, y)
+
+    def press_key(self, key):
+        self._record('key', self._x, self._y, key)
+
+    def type_text(self, text):
+        self._record('type', self._x, self._y, text)
+
+    def position(self):
+        return self._x, self._y
+
+    def screen_size(self):
+        if self.screen is None:
+            return 0, 0
+        height, width = self.screen.shape[:2]
+        return width, height
+
+    def screenshot(self, left, top, width, height, color=False):
+        if self.screen is None:
+            raise RuntimeError("headless backend has no screen")
+        return self.screen[top:top + height, left:left + width]
+
+    def clear(self):
+        self.actions.clear()
+
+
+class NullBackend(InputBackend):
+    """Discards every action; measures pure engine overhead"""
+
+    name = 'null'
+
+    def move(self, x, y):
+        pass
+
+    def click(self, x, y):
+        pass
+
+    def double_click(self, x, y):
+        pass
+
+    def scroll(self, amount):
+        pass
+
+    def mouse_down(self, x, y):
+        pass
+
+    def mouse_up(self, x, y):
+        pass
+
+    def press_key(self, key):
+        pass
+
+    def type_text(self, text):
+        pass
+
+    def position(self):
+        return 0, 0
+
+    def screen_size(self):
+        return 0, 0
+
+    def screenshot(self, left, top, width, height, color=False):
+        raise RuntimeError("null backend has no screen")
+
+
+BACKENDS = {
+    PyAutoGuiBackend.name: PyAutoGuiBackend,
+    XTestBackend.name: XTestBackend,
+    HeadlessBackend.name: HeadlessBackend,
+    NullBackend.name: NullBackend,
+}
+
+
+def create_backend(name, **options):
+    """
+    Create a backend by name ('pyautogui', 'xtest', 'headless' or 'null');
+    options go to its constructor (e.g. failsafe=False)
+    """
+    try:
+        backend_class = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown input backend: {name}") from None
+    return backend_class(**options)
+
+
+class BackendPool:
+    """
+    Backends created on first use and then shared by name, so repeated runs
+    don't each open a connection to the display. `options` maps backend
+    names to constructor options. close() closes every backend created.
+    """
+
+    def __init__(self, options=None):
+        self.options = options or {}
+        self._backends = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """The backend called `name` (None for None)"""
+        if name is None:
+            return None
+        with self._lock:
+            backend = self._backends.get(name)
+            if backend is None:
+                backend = self._backends[name] = create_backend(name, **self.options.get(name, {}))
+            return backend
+
+    def close(self):
+        with self._lock:
+            backends, self._backends = list(self._backends.values()), {}
+        for backend in backends:
+            backend.close()
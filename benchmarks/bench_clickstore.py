@@ -0,0 +1,115 @@
+"""
+Memory and iteration benchmark: list of Click objects vs ClickStore.
+
+Run from the repository root:
+    python -m benchmarks.bench_clickstore [steps ...]
+"""
+import sys
+import time
+import tracemalloc
+
+from Click import Click
+from ClickStore import ClickStore, FLAG_DOUBLE, FLAG_SCROLL
+
+
+def make_dicts(n):
+    """Generate n synthetic steps in the saved-macro format"""
+    return [{
+        'x': 100 + i % 1800,
+        'y': 100 + i % 900,
+        'button': 'left',
+        'delay': 0.05,
+        'is_double_click': i % 7 == 0,
+        'offset_x': 0,
+        'offset_y': i % 3,
+        'is_scroll': i % 11 == 0,
+        'scroll_amount': -120 if i % 11 == 0 else 0,
+    } for i in range(n)]
+
+
+def measure_memory(build, data):
+    """Return (result, bytes allocated while building it)"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build(data)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def measure_load(build, data, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        build(data)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def measure_iteration(steps, repeat=3):
+    """Time one replay-style pass that reads every field the replay loop uses"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        total = 0
+        for click_obj in steps:
+            total += click_obj.x + click_obj.offset_x + click_obj.y + click_obj.offset_y
+            if click_obj.is_scroll:
+                total += click_obj.scroll_amount
+            elif click_obj.is_double_click:
+                total += 1
+            total += click_obj.delay
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def measure_rows(store, repeat=3):
+    """Same pass as measure_iteration but over the raw column tuples"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        total = 0
+        for x, y, delay, offset_x, offset_y, scroll_amount, flags, button, anchor in store.rows():
+            total += x + offset_x + y + offset_y
+            if flags & FLAG_SCROLL:
+                total += scroll_amount
+            elif flags & FLAG_DOUBLE:
+                total += 1
+            total += delay
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def build_list(data):
+    return [Click.from_dict(d) for d in data]
+
+
+def run(n):
+    data = make_dicts(n)
+    clicks, list_bytes = measure_memory(build_list, data)
+    store, store_bytes = measure_memory(ClickStore.from_dicts, data)
+    return {
+        'steps': n,
+        'list_bytes': list_bytes,
+        'store_bytes': store_bytes,
+        'store_column_bytes': store.nbytes(),
+        'list_load_s': measure_load(build_list, data),
+        'store_load_s': measure_load(ClickStore.from_dicts, data),
+        'list_iter_s': measure_iteration(clicks),
+        'store_iter_s': measure_iteration(store),
+        'store_rows_s': measure_rows(store),
+    }
+
+
+def main(argv):
+    sizes = [int(a) for a in argv] or [1000, 10000, 100000]
+    print(f"{'steps':>8} {'list MB':>9} {'store MB':>9} {'list load':>10} {'store load':>10} {'list iter':>10} {'store iter':>10} {'store rows':>10}")
+    for n in sizes:
+        r = run(n)
+        print(f"{r['steps']:>8} {r['list_bytes'] / 1e6:>9.2f} {r['store_bytes'] / 1e6:>9.2f} "
+              f"{r['list_load_s']:>10.4f} {r['store_load_s']:>10.4f} "
+              f"{r['list_iter_s']:>10.4f} {r['store_iter_s']:>10.4f} {r['store_rows_s']:>10.4f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,70 @@
+"""
+Per-step interpreter overhead: the old getattr-per-step replay loop vs the
+compiled replay plan. Actions are no-ops, so only the loop itself is timed.
+
+Run from the repository root:
+    python -m benchmarks.bench_replay_plan [steps] [cycles]
+"""
+import sys
+import time
+
+from ClickStore import ClickStore
+from replay_plan import compile_plan
+from benchmarks.bench_clickstore import make_dicts
+
+
+def _noop(x, y, amount=0):
+    pass
+
+
+def legacy_loop(steps, cycles):
+    """The replay loop as it was before the compile stage"""
+    for cycle_count in range(1, cycles + 1):
+        for i, click_obj in enumerate(steps):
+            current_x = click_obj.x + (click_obj.offset_x * (cycle_count - 1))
+            current_y = click_obj.y + (click_obj.offset_y * (cycle_count - 1))
+            if getattr(click_obj, 'is_scroll', False):
+                _noop(current_x, current_y, int(click_obj.scroll_amount))
+            elif click_obj.is_double_click:
+                _noop(current_x, current_y)
+            else:
+                _noop(current_x, current_y)
+            if getattr(click_obj, 'delay', 0) > 0:
+                pass
+
+
+def plan_loop(steps, cycles):
+    """The compiled replay loop, including the compile itself"""
+    plan = compile_plan(steps)
+    actions = [_noop, _noop, _noop]
+    for cycle_count, rows in plan.iter_cycles():
+        if cycle_count > cycles:
+            break
+        for op, x, y, amount, delay in rows:
+            actions[op](x, y, amount)
+            if delay > 0:
+                pass
+
+
+def per_step_ns(loop, steps, cycles, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        loop(steps, cycles)
+        best = min(best, time.perf_counter_ns() - start)
+    return best / (len(steps) * cycles)
+
+
+def main(argv):
+    n = int(argv[0]) if argv else 10000
+    cycles = int(argv[1]) if len(argv) > 1 else 20
+    store = ClickStore.from_dicts(make_dicts(n))
+    legacy = per_step_ns(legacy_loop, store, cycles)
+    planned = per_step_ns(plan_loop, store, cycles)
+    print(f"steps={n} cycles={cycles}")
+    print(f"legacy loop: {legacy:8.1f} ns/step")
+    print(f"plan loop:   {planned:8.1f} ns/step ({legacy / planned:.1f}x)")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
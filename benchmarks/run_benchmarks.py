@@ -0,0 +1,531 @@
+"""
+Replay performance benchmark suite.
+
+Runs clickanput.replay_clicks against the headless/null input backends and
+reports:
+  - throughput (steps/sec) vs macro length
+  - per-step engine overhead with per-action events filtered out and logged
+  - timing accuracy vs requested delays
+  - stop latency
+  - JSON and binary macro load/save time
+  - anchor lookup time per matcher stage, on a synthetic screenshot
+  - wait step reaction time and captures per wait, on a synthetic screen
+  - command line runner cold start against its import time budgets
+  - control server: macro load/compile, and start and full-run round trips
+    of a cached macro through a ControlClient, end to end over the socket
+  - with --x11, pointer move throughput of the pyautogui and xtest backends
+    on the X display in $DISPLAY (run it under Xvfb, the pointer moves)
+
+Results are written as JSON so runs from different versions can be compared.
+
+Run from the repository root:
+    python -m benchmarks.run_benchmarks [--quick] [--x11] [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import anchors
+import clickanput as can
+import control_server
+import event_log
+import screen_wait
+import macro_io
+from backends import HeadlessBackend, NullBackend
+from ClickStore import ClickStore
+from replay_plan import compile_plan
+from scheduler import percentile
+from benchmarks.bench_clickstore import make_dicts
+
+
+# Regressions larger than this fraction are flagged by --compare
+REGRESSION_THRESHOLD = 0.10
+# Timed sections report the best of this many runs
+REPEAT = 3
+
+
+def make_store(n, delay=0.0):
+    """n click steps without offsets or scrolls, all with the same delay"""
+    store = ClickStore()
+    for i in range(n):
+        store.add(100 + i % 1800, 100 + i % 900, button='left', delay=delay)
+    return store
+
+
+class quiet_log:
+    """Log at `level` into a discarded buffer instead of the terminal"""
+
+    def __init__(self, level=event_log.WARNING):
+        self.level = level
+
+    def __enter__(self):
+        log = event_log.log
+        self._saved = log.level, log.stream
+        log.flush()
+        log.level, log.stream = self.level, io.StringIO()
+
+    def __exit__(self, *exc):
+        log = event_log.log
+        log.flush()
+        log.level, log.stream = self._saved
+
+
+def replay(store, backend, cycles=1, step_time=0.0, log_actions=False):
+    """
+    Run replay_clicks synchronously through the engine and return elapsed seconds.
+    With log_actions, per-action DEBUG events are logged (to a buffer, so the
+    terminal isn't measured).
+    """
+    can.click_positions = store
+    can.replay_step_time = step_time
+    with quiet_log(event_log.DEBUG if log_actions else event_log.WARNING):
+        start = time.perf_counter()
+        if not can.replay_engine.start(can.replay_clicks, backend, cycles):
+            raise RuntimeError("replay engine busy")
+        can.replay_engine.join()
+        elapsed = time.perf_counter() - start
+    return elapsed
+
+
+def bench_throughput(sizes):
+    results = []
+    for n in sizes:
+        store = make_store(n)
+        elapsed = min(replay(store, NullBackend()) for _ in range(REPEAT))
+        results.append({'steps': n, 'seconds': elapsed, 'steps_per_sec': n / elapsed})
+    return results
+
+
+def bench_overhead(n):
+    """ns per step of pure engine work, with per-action events filtered out and logged"""
+    store = make_store(n)
+    quiet = min(replay(store, NullBackend()) for _ in range(REPEAT))
+    loud = min(replay(store, NullBackend(), log_actions=True) for _ in range(REPEAT))
+    return {
+        'steps': n,
+        'ns_per_step_silent': quiet / n * 1e9,
+        'ns_per_step_logged': loud / n * 1e9,
+    }
+
+
+def bench_accuracy(delays_ms, steps_per_delay):
+    """Compare intervals between recorded actions with the requested delays"""
+    results = []
+    for delay_ms in delays_ms:
+        backend = HeadlessBackend()
+        replay(make_store(steps_per_delay, delay=delay_ms / 1000), backend)
+        stamps = [action[0] for action in backend.actions]
+        errors = sorted(abs((b - a) - delay_ms * 1e6) for a, b in zip(stamps, stamps[1:]))
+        # Drift: where the last action landed vs where the schedule put it
+        drift = (stamps[-1] - stamps[0]) - (len(stamps) - 1) * delay_ms * 1e6
+        results.append({
+            'delay_ms': delay_ms,
+            'intervals': len(errors),
+            'abs_error_p50_ms': percentile(errors, 0.50) / 1e6,
+            'abs_error_p99_ms': percentile(errors, 0.99) / 1e6,
+            'abs_error_max_ms': (errors[-1] if errors else 0) / 1e6,
+            'total_drift_ms': drift / 1e6,
+        })
+    return results
+
+
+def bench_stop_latency(trials):
+    """Time from stop() until the replay thread has exited, stopping mid-delay"""
+    store = make_store(3, delay=1.5)
+    latencies = []
+    with quiet_log():
+        for _ in range(trials):
+            can.click_positions = store
+            can.replay_step_time = 0.0
+            can.replay_engine.start(can.replay_clicks, NullBackend())
+            time.sleep(random.uniform(0.005, 0.05))
+            start = time.perf_counter()
+            can.replay_engine.stop()
+            can.replay_engine.join()
+            latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        'trials': trials,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+
+
+def bench_json_io(sizes):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'macro.json')
+        for n in sizes:
+            store = ClickStore.from_dicts(make_dicts(n))
+            save_s = load_s = float('inf')
+            for _ in range(REPEAT):
+                start = time.perf_counter()
+                macro_io.save_json(path, store)
+                save_s = min(save_s, time.perf_counter() - start)
+                start = time.perf_counter()
+                loaded = macro_io.load_json(path)
+                load_s = min(load_s, time.perf_counter() - start)
+            assert len(loaded) == n
+            results.append({'steps': n, 'save_s': save_s, 'load_s': load_s, 'bytes': os.path.getsize(path)})
+    return results
+
+
+def bench_binary_io(sizes):
+    """Binary save, full load, and map + compile (the time until replay can start)"""
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'macro' + macro_io.BINARY_EXT)
+        for n in sizes:
+            store = ClickStore.from_dicts(make_dicts(n))
+            save_s = load_s = map_s = float('inf')
+            for _ in range(REPEAT):
+                start = time.perf_counter()
+                macro_io.save_binary(path, store)
+                save_s = min(save_s, time.perf_counter() - start)
+                start = time.perf_counter()
+                loaded = macro_io.load_binary(path)
+                load_s = min(load_s, time.perf_counter() - start)
+                start = time.perf_counter()
+                with macro_io.MappedMacro(path) as macro:
+                    compile_plan(macro)
+                map_s = min(map_s, time.perf_counter() - start)
+            assert len(loaded) == n
+            results.append({'steps': n, 'save_s': save_s, 'load_s': load_s, 'map_compile_s': map_s,
+                            'bytes': os.path.getsize(path)})
+    return results
+
+
+def _synthetic_screen(width, height, seed=1):
+    """Blocky random 'UI' with a little noise, so every patch is distinctive"""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    blocks = rng.random((height // 8 + 1, width // 8 + 1)) * 255
+    screen = np.kron(blocks, np.ones((8, 8)))[:height, :width]
+    return screen + rng.normal(0, 2, screen.shape)
+
+
+def bench_anchors(trials, size=(1920, 1080)):
+    """
+    Time to locate an anchor after its UI element moved: far (full screen
+    search), near (region of interest) and not at all (cached location)
+    """
+    import numpy as np
+    width, height = size
+    screen = _synthetic_screen(width, height)
+    anchor = anchors.capture_anchor(screen, width // 3, height // 3)
+    results = {}
+    for stage, shift in (('screen', (-53, 311)), ('roi', (9, -17)), ('cache', (0, 0))):
+        times = []
+        for i in range(trials):
+            matcher = anchors.TemplateMatcher()
+            moved = np.roll(screen, shift, axis=(0, 1))
+            grab = lambda left, top, w, h: moved[top:top + h, left:left + w]
+            if stage == 'cache':
+                matcher.locate(anchor, grab, size)
+            elif stage == 'roi':
+                # Prime the cache with the recorded location, then move a little
+                matcher.locate(anchor, lambda left, top, w, h: screen[top:top + h, left:left + w], size)
+            start = time.perf_counter()
+            found = matcher.locate(anchor, grab, size)
+            times.append((time.perf_counter() - start) * 1000)
+            assert found is not None and matcher.stats[stage] >= 1, (stage, found, matcher.stats)
+        times.sort()
+        results[f'{stage}_p50_ms'] = percentile(times, 0.50)
+        results[f'{stage}_max_ms'] = max(times)
+    return results
+
+
+def bench_waits(trials, ready_s=0.2):
+    """
+    How long after the screen becomes ready (ready_s into the wait) a change
+    wait notices, and how many region captures that took. The waiter is
+    shared across trials, as in a looping replay, so later waits use the
+    learned wait time.
+    """
+    import numpy as np
+    screen = np.zeros((64, 64), dtype=np.uint8)
+    condition = screen_wait.WaitCondition(screen_wait.CHANGE, timeout=5.0, replaced_delay=1.5)
+    waiter = screen_wait.ScreenWaiter()
+    grab = lambda left, top, w, h, color: screen[top:top + h, left:left + w]
+    sleep = lambda deadline_ns: time.sleep(max(0, deadline_ns - time.monotonic_ns()) / 1e9) or True
+    reactions, polls = [], []
+    for i in range(min(trials, 10)):
+        screen[:] = 0
+        ready_ns = time.monotonic_ns() + int(ready_s * 1e9)
+
+        def timed_grab(left, top, w, h, color):
+            if time.monotonic_ns() >= ready_ns:
+                screen[:] = 255
+            return grab(left, top, w, h, color)
+
+        before = waiter.polls
+        met, waited_ns = waiter.wait(condition, 8, 8, timed_grab, sleep)
+        assert met, waited_ns
+        reactions.append((waited_ns / 1e6) - ready_s * 1000)
+        polls.append(waiter.polls - before)
+    reactions.sort()
+    return {
+        'reaction_p50_ms': percentile(reactions, 0.50),
+        'reaction_max_ms': max(reactions),
+        'polls_first': polls[0],
+        'polls_p50': sorted(polls)[len(polls) // 2],
+        'saved_per_wait_s': condition.replaced_delay - ready_s - percentile(reactions, 0.50) / 1000,
+    }
+
+
+def bench_x11_backends(n):
+    """
+    Steps/sec of a zero-delay pointer path through the real X11 backends.
+    Backends that can't start (no display, library missing) report an error.
+    """
+    from backends import create_backend
+    store = ClickStore()
+    for i in range(n):
+        store.add(100 + i % 500, 100 + (i // 500) % 500, is_move=True)
+    results = {}
+    for name in ('pyautogui', 'xtest'):
+        try:
+            backend = create_backend(name, failsafe=False)
+        except Exception as e:
+            results[name] = {'error': f"{type(e).__name__}: {e}"}
+            continue
+        elapsed = min(replay(store, backend) for _ in range(REPEAT))
+        results[name] = {'steps': n, 'seconds': elapsed, 'steps_per_sec': n / elapsed}
+        if name == 'xtest':
+            results[name]['flushes'] = backend.flushes
+            backend.close()
+    rates = [r.get('steps_per_sec') for r in results.values()]
+    if all(rates):
+        results['xtest_speedup'] = rates[1] / rates[0]
+    return results
+
+
+def _run_cli(*args):
+    """Run macro_cli in a fresh interpreter, returning (seconds, stdout, stderr)"""
+    root = os.path.dirname(os.path.abspath(can.__file__))
+    start = time.perf_counter()
+    done = subprocess.run([sys.executable, *args], capture_output=True, text=True, cwd=root, check=True)
+    return time.perf_counter() - start, done.stdout, done.stderr
+
+
+def _cli_timings(stdout):
+    """The --timings record from macro_cli's JSON log output"""
+    for line in stdout.splitlines():
+        if line.startswith('{'):
+            record = json.loads(line)
+            if record.get('event') == 'timings':
+                return record
+    raise ValueError("no timings record in macro_cli output")
+
+
+def bench_cli(trials):
+    """
+    Cold start of the command line runner: `import macro_cli` (from
+    python -X importtime), and import time, wall time and heavy modules
+    loaded by inspect and a headless replay of a small macro.
+    """
+    import macro_cli
+    trials = max(1, min(trials, 5))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'macro.json')
+        macro_io.save_json(path, make_store(100))
+        module_ms = []
+        for _ in range(trials):
+            _, _, stderr = _run_cli('-X', 'importtime', '-c', 'import macro_cli')
+            line = next(line for line in stderr.splitlines() if line.rstrip().endswith('| macro_cli'))
+            module_ms.append(int(line.split('|')[1]) / 1000)
+        results = {'module_import_ms': min(module_ms), 'module_budget_ms': macro_cli.IMPORT_BUDGET * 1000}
+        over = []
+        if results['module_import_ms'] > results['module_budget_ms']:
+            over.append('module')
+        commands = {
+            'inspect': ('inspect', path),
+            'replay': ('replay', path, '--backend', 'headless', '--step-time', '0'),
+        }
+        for command, args in commands.items():
+            runs = [_run_cli('-m', 'macro_cli', '--json-log', '--timings', *args) for _ in range(trials)]
+            wall, stdout, _ = min(runs)
+            timings = _cli_timings(stdout)
+            results[f'{command}_wall_ms'] = wall * 1000
+            results[f'{command}_import_ms'] = timings['import_s'] * 1000
+            results[f'{command}_budget_ms'] = timings['budget_s'] * 1000
+            results[f'{command}_heavy_modules'] = timings['heavy']
+            if timings['import_s'] > timings['budget_s'] or timings['heavy']:
+                over.append(command)
+    results['over_budget'] = over
+    return results
+
+
+def bench_control(trials, steps=1000):
+    """
+    A control server in this process, driven by a ControlClient over a real
+    socket: compiling a macro into the cache, then the round trip of a
+    start command for the cached macro, and a whole 1-cycle job (start,
+    progress events, finish) with no step time.
+    """
+    trials = max(1, min(trials, 20))
+    with tempfile.TemporaryDirectory() as tmp, quiet_log():
+        path = os.path.join(tmp, 'macro.mvb')
+        macro_io.save_binary(path, make_store(steps))
+        if hasattr(socket, 'AF_UNIX'):
+            address = os.path.join(tmp, 'control.sock')
+        else:
+            address = f"127.0.0.1:{control_server.DEFAULT_PORT}"
+        server = control_server.ControlServer(can, address).start()
+        try:
+            with control_server.ControlClient(address) as client:
+                load = client.load(path)
+                starts, runs = [], []
+                for _ in range(trials):
+                    start = time.perf_counter()
+                    client.start(path, cycles=1, backend='null', step_time=0.0)
+                    starts.append(time.perf_counter() - start)
+                    can.replay_engine.join()
+                for _ in range(trials):
+                    start = time.perf_counter()
+                    client.run(path, cycles=1, backend='null', step_time=0.0)
+                    runs.append(time.perf_counter() - start)
+        finally:
+            server.close()
+    return {
+        'steps': steps,
+        'load_ms': load['load_ms'],
+        'start_p50_ms': percentile(sorted(starts), 0.50) * 1000,
+        'run_p50_ms': percentile(sorted(runs), 0.50) * 1000,
+        'run_max_ms': max(runs) * 1000,
+    }
+
+
+def environment():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(can.__file__))).stdout.strip()
+    except OSError:
+        revision = ''
+    return {
+        'revision': revision,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def run_all(quick=False, x11=False):
+    if quick:
+        sizes, io_sizes, accuracy_steps, trials = [100, 1000, 10000], [1000, 10000], 50, 10
+    else:
+        sizes, io_sizes, accuracy_steps, trials = [100, 1000, 10000, 100000], [1000, 10000, 100000, 1000000], 200, 50
+    results = {
+        'environment': environment(),
+        'throughput': bench_throughput(sizes),
+        'overhead': bench_overhead(sizes[-1]),
+        'accuracy': bench_accuracy([1, 5, 20], accuracy_steps),
+        'stop_latency': bench_stop_latency(trials),
+        'json_io': bench_json_io(io_sizes),
+        'binary_io': bench_binary_io(io_sizes),
+        'anchors': bench_anchors(trials),
+        'waits': bench_waits(trials),
+        'cli': bench_cli(trials),
+        'control': bench_control(trials),
+    }
+    if x11:
+        results['x11_backends'] = bench_x11_backends(1000 if quick else 10000)
+    return results
+
+
+# Metrics where a larger value is worse, by section: (row key, [(metric, absolute tolerance)])
+# Differences within the absolute tolerance are treated as noise by --compare
+COMPARED_METRICS = {
+    'throughput': ('steps', [('seconds', 0.001)]),
+    'json_io': ('steps', [('save_s', 0.005), ('load_s', 0.005)]),
+    'binary_io': ('steps', [('save_s', 0.005), ('load_s', 0.005), ('map_compile_s', 0.005)]),
+    'accuracy': ('delay_ms', [('abs_error_p50_ms', 0.1)]),
+}
+
+
+def _regressed(old, new, tolerance):
+    return new > old * (1 + REGRESSION_THRESHOLD) and new - old > tolerance
+
+
+def compare(baseline, current):
+    """Return a list of human readable regression lines"""
+    regressions = []
+    for section, (key, metrics) in COMPARED_METRICS.items():
+        old_rows = {row[key]: row for row in baseline.get(section, [])}
+        for row in current.get(section, []):
+            old = old_rows.get(row[key])
+            if old is None:
+                continue
+            for metric, tolerance in metrics:
+                if _regressed(old[metric], row[metric], tolerance):
+                    regressions.append(f"{section}[{key}={row[key]}].{metric}: {old[metric]:.6g} -> {row[metric]:.6g}")
+    for metric in ('ns_per_step_silent', 'ns_per_step_logged'):
+        old = baseline.get('overhead', {}).get(metric)
+        new = current['overhead'].get(metric)
+        if old and _regressed(old, new, 50):
+            regressions.append(f"overhead.{metric}: {old:.6g} -> {new:.6g}")
+    for metric in ('screen_p50_ms', 'roi_p50_ms', 'cache_p50_ms'):
+        old = baseline.get('anchors', {}).get(metric)
+        new = current.get('anchors', {}).get(metric)
+        if old and new and _regressed(old, new, 1.0):
+            regressions.append(f"anchors.{metric}: {old:.6g} -> {new:.6g}")
+    for metric, tolerance in (('reaction_p50_ms', 5.0), ('polls_p50', 2)):
+        old = baseline.get('waits', {}).get(metric)
+        new = current.get('waits', {}).get(metric)
+        if old and new and _regressed(old, new, tolerance):
+            regressions.append(f"waits.{metric}: {old:.6g} -> {new:.6g}")
+    for metric in ('module_import_ms', 'inspect_import_ms', 'replay_import_ms'):
+        old = baseline.get('cli', {}).get(metric)
+        new = current.get('cli', {}).get(metric)
+        if old and new and _regressed(old, new, 5.0):
+            regressions.append(f"cli.{metric}: {old:.6g} -> {new:.6g}")
+    for metric in ('start_p50_ms', 'run_p50_ms'):
+        old = baseline.get('control', {}).get(metric)
+        new = current.get('control', {}).get(metric)
+        if old and new and _regressed(old, new, 1.0):
+            regressions.append(f"control.{metric}: {old:.6g} -> {new:.6g}")
+    for name in current.get('cli', {}).get('over_budget', []):
+        regressions.append(f"cli.{name}: over its import time budget or loaded heavy modules")
+    old = baseline.get('stop_latency', {}).get('p99_ms')
+    if old and _regressed(old, current['stop_latency']['p99_ms'], 0.5):
+        regressions.append(f"stop_latency.p99_ms: {old:.6g} -> {current['stop_latency']['p99_ms']:.6g}")
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Replay performance benchmarks")
+    parser.add_argument('--quick', action='store_true', help="smaller sizes for a fast run")
+    parser.add_argument('--output', help="write results JSON to this file (default: stdout)")
+    parser.add_argument('--compare', help="baseline results JSON to check for regressions")
+    parser.add_argument('--x11', action='store_true', help="also benchmark the X11 backends (moves the pointer)")
+    args = parser.parse_args(argv)
+
+    results = run_all(quick=args.quick, x11=args.x11)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,137 @@
+"""
+Capture queue between the pynput listener thread and the rest of the app.
+
+The listener callback only timestamps a raw event and pushes it into a
+CaptureRing; it never takes a lock or touches the click list, so the OS
+input hook is never held up. A CaptureConsumer thread drains the ring and
+turns the events into steps, which makes it the only thread writing the
+click list while recording.
+
+The ring has exactly one producer (the listener thread) and one consumer.
+Each side only ever advances its own index, and the producer publishes a
+slot by advancing the head after writing it, so no locking is needed.
+When the ring is full new events are dropped (and counted by the producer)
+rather than blocking it; the consumer side only reads the count, it never
+resets it. The mouse and keyboard listeners run on separate threads, so
+each gets its own ring; the consumer merges them by time.
+"""
+import heapq
+import threading
+import time
+
+from event_log import log
+
+
+# Raw event kinds
+EV_CLICK = 1  # left press, when paths aren't recorded
+EV_MOVE = 2
+EV_PRESS = 3
+EV_RELEASE = 4
+EV_KEY = 5  # amount is the key code, see keys.py
+
+DEFAULT_CAPACITY = 4096
+# How often the consumer drains the ring while capturing
+DRAIN_INTERVAL = 0.01
+
+
+class CaptureRing:
+    """
+    Fixed-size single-producer/single-consumer ring of raw input events.
+    Events are tuples (t_ns, kind, x, y, button, amount) with t_ns from
+    time.monotonic_ns().
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self.capacity = size
+        self._mask = size - 1
+        self._slots = [None] * size
+        self._head = 0  # next slot to write, only advanced by the producer
+        self._tail = 0  # next slot to read, only advanced by the consumer
+        self.dropped = 0  # events lost because the ring was full, only written by the producer
+        self._reported = 0  # drops already taken by new_drops(), only written by the consumer
+
+    def __len__(self):
+        return self._head - self._tail
+
+    def push(self, kind, x, y, button=None, amount=0, t_ns=None):
+        """
+        Queue a raw event; called from the producer thread only.
+        Returns False (and counts a drop) if the ring is full.
+        """
+        if t_ns is None:
+            t_ns = time.monotonic_ns()
+        head = self._head
+        if head - self._tail > self._mask:
+            self.dropped += 1
+            return False
+        self._slots[head & self._mask] = (t_ns, kind, x, y, button, amount)
+        self._head = head + 1  # publish only after the slot is written
+        return True
+
+    def new_drops(self):
+        """Events dropped since the last call; called from the consumer side only"""
+        dropped = self.dropped
+        new, self._reported = dropped - self._reported, dropped
+        return new
+
+    def drain(self, limit=None):
+        """Return the queued events, oldest first; called from the consumer thread only"""
+        tail = self._tail
+        head = self._head
+        if limit is not None:
+            head = min(head, tail + limit)
+        slots, mask = self._slots, self._mask
+        events = [slots[i & mask] for i in range(tail, head)]
+        for i in range(tail, head):
+            slots[i & mask] = None
+        self._tail = head
+        return events
+
+
+class CaptureConsumer:
+    """
+    Thread that drains a CaptureRing (or a tuple of them) every `interval`
+    seconds and passes the events to handler(events), in time order.
+    stop() drains whatever is left.
+    """
+
+    def __init__(self, ring, handler, interval=DRAIN_INTERVAL):
+        self.rings = tuple(ring) if isinstance(ring, (tuple, list)) else (ring,)
+        self.handler = handler
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='capture-consumer')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._drain()
+        self._drain()
+
+    def _drain(self):
+        batches = [events for events in (ring.drain() for ring in self.rings) if events]
+        if len(batches) > 1:
+            events = list(heapq.merge(*batches, key=lambda event: event[0]))
+        else:
+            events = batches[0] if batches else None
+        if events:
+            try:
+                self.handler(events)
+            except Exception as e:
+                log.error('capture', "Capture handler failed: {error}", error=e)
+
+    def stop(self):
+        """Stop the thread after a final drain; returns once it is done"""
+        self._stop.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
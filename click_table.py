@@ -0,0 +1,195 @@
+"""
+Virtualized click editor table.
+
+The Treeview only ever holds as many items as fit on screen; they show the
+rows top..top+visible of the click list and are refilled when the view
+scrolls. Changes to the click list arrive as ClickStore notifications and
+are applied as single-row updates, so a recorded click costs one item
+update instead of rebuilding the whole table.
+"""
+import tkinter as tk
+from collections import deque
+from tkinter import ttk
+
+from ClickStore import CHANGE_APPEND, CHANGE_UPDATE
+
+
+COLUMNS = ('index', 'x', 'y', 'delay', 'offset_x', 'offset_y', 'scroll', 'double_click')
+# Fallbacks when the Treeview style doesn't say
+ROW_HEIGHT = 20
+HEADER_HEIGHT = 24
+
+
+def row_values(index, click_obj):
+    """Values shown for one click; the index column is 1-based"""
+    # Show scroll amount in its own column; double-click column shows Yes/No
+    scroll_val = click_obj.scroll_amount if getattr(click_obj, 'is_scroll', False) else 0
+    return (
+        index + 1,
+        click_obj.x,
+        click_obj.y,
+        click_obj.delay,
+        click_obj.offset_x,
+        click_obj.offset_y,
+        scroll_val,
+        _step_kind(click_obj) + (' (anchored)' if getattr(click_obj, 'anchor', None) is not None else '')
+    )
+
+
+def _step_kind(click_obj):
+    """Double-click column text; recorded path steps say what they are instead"""
+    condition = getattr(click_obj, 'condition', None)
+    if condition is not None:
+        return condition.label()
+    key = getattr(click_obj, 'key', None)
+    if key is not None:
+        return f"Key: {key!r}" if len(key) == 1 else f"Key: {key}"
+    if getattr(click_obj, 'is_move', False):
+        return 'Move'
+    if getattr(click_obj, 'is_mouse_down', False):
+        return 'Drag start'
+    if getattr(click_obj, 'is_mouse_up', False):
+        return 'Drag end'
+    return 'Yes' if click_obj.is_double_click else 'No'
+
+
+class VirtualClickTable:
+    """Treeview + scrollbar that only materializes the visible rows of a click list"""
+
+    def __init__(self, parent, height=6):
+        self.tree = ttk.Treeview(parent, columns=COLUMNS, show='headings', height=height)
+        self.scrollbar = ttk.Scrollbar(parent, orient=tk.VERTICAL, command=self.on_scrollbar)
+        self.store = None
+        self.top = 0
+        self.visible = height
+        self._slots = []  # item ids, one per visible row
+        self._changes = deque()  # (kind, index) from any thread, drained on the Tk thread
+        self._follow_tail = True
+
+        self.tree.bind('<Configure>', self.on_resize)
+        self.tree.bind('<MouseWheel>', self.on_mousewheel)
+        self.tree.bind('<Button-4>', lambda event: self.scroll_by(-3))
+        self.tree.bind('<Button-5>', lambda event: self.scroll_by(3))
+
+    # --- data binding ---
+
+    def bind(self, store):
+        """Show a (new) click list and start following its changes"""
+        if store is not self.store:
+            if self.store is not None:
+                self.store.unsubscribe(self._on_change)
+            self.store = store
+            store.subscribe(self._on_change)
+        self._changes.clear()
+        self.top = max(0, min(self.top, len(store) - self.visible))
+        self.render()
+
+    def _on_change(self, kind, index):
+        # May run on the pynput or replay thread: only queue it here
+        self._changes.append((kind, index))
+
+    def apply_changes(self):
+        """Apply queued change notifications; call from the Tk thread"""
+        if not self._changes:
+            return
+        full_render = False
+        changes = self._changes
+        while changes:
+            kind, index = changes.popleft()
+            if kind == CHANGE_UPDATE:
+                self.render_row(index)
+            elif kind == CHANGE_APPEND:
+                if self._follow_tail:
+                    new_top = max(0, len(self.store) - self.visible)
+                    if new_top != self.top:
+                        self.top = new_top
+                        full_render = True
+                        continue
+                self.render_row(index)
+            else:
+                # Deletes and resets shift rows, re-read the visible window
+                full_render = True
+        if full_render:
+            self.render()
+        else:
+            self.update_scrollbar()
+
+    # --- rendering ---
+
+    def _ensure_slots(self):
+        while len(self._slots) < self.visible:
+            self._slots.append(self.tree.insert('', tk.END, values=()))
+        while len(self._slots) > self.visible:
+            self.tree.delete(self._slots.pop())
+
+    def render(self):
+        """Refill every visible row from the click list"""
+        self._ensure_slots()
+        for offset in range(self.visible):
+            self._fill_slot(offset)
+        self.update_scrollbar()
+
+    def render_row(self, index):
+        """Refresh a single row if it is on screen"""
+        offset = index - self.top
+        if 0 <= offset < self.visible:
+            self._fill_slot(offset)
+
+    def _fill_slot(self, offset):
+        index = self.top + offset
+        item = self._slots[offset]
+        store = self.store
+        if store is not None and index < len(store):
+            self.tree.item(item, values=row_values(index, store[index]))
+        else:
+            self.tree.item(item, values=())
+
+    def update_scrollbar(self):
+        total = len(self.store) if self.store is not None else 0
+        if total <= self.visible:
+            self.scrollbar.set(0.0, 1.0)
+        else:
+            self.scrollbar.set(self.top / total, min(1.0, (self.top + self.visible) / total))
+
+    # --- scrolling ---
+
+    def scroll_to(self, top):
+        total = len(self.store) if self.store is not None else 0
+        top = max(0, min(int(top), total - self.visible))
+        self._follow_tail = top >= total - self.visible
+        if top != self.top:
+            self.top = top
+            self.render()
+
+    def scroll_by(self, rows):
+        self.scroll_to(self.top + rows)
+
+    def on_scrollbar(self, *args):
+        total = len(self.store) if self.store is not None else 0
+        if args[0] == 'moveto':
+            self.scroll_to(float(args[1]) * total)
+        elif args[0] == 'scroll':
+            step = int(args[1]) * (self.visible if args[2] == 'pages' else 1)
+            self.scroll_by(step)
+
+    def on_mousewheel(self, event):
+        self.scroll_by(-3 if event.delta > 0 else 3)
+
+    def on_resize(self, event):
+        style = ttk.Style()
+        row_height = int(style.lookup('Treeview', 'rowheight') or ROW_HEIGHT)
+        visible = max(1, (event.height - HEADER_HEIGHT) // row_height + 1)
+        if visible != self.visible:
+            self.visible = visible
+            if self.store is not None:
+                self.top = max(0, min(self.top, len(self.store) - self.visible))
+                self.render()
+
+    # --- helpers for inline editing ---
+
+    def index_of(self, item):
+        """Click list index shown by a tree item, or None for an empty slot"""
+        values = self.tree.item(item, 'values')
+        if not values:
+            return None
+        return int(values[0]) - 1
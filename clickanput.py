@@ -1,136 +1,440 @@
-import pynput.mouse as mouse
-import pynput.keyboard as keyboard
-import pyautogui
 import time
-import threading
 from Click import Click
+from ClickStore import ClickStore
+from replay_plan import (ReplayPlan, compile_plan, OP_CLICK, OP_DOUBLE_CLICK, OP_SCROLL, OP_MOVE, OP_MOUSE_DOWN,
+                         OP_MOUSE_UP, OP_PATH_MOVE, OP_LOCATE, OP_WAIT, OP_KEY, OP_TYPE, OP_ANCHORED, OP_NAMES,
+                         UNTIMED_OPS)
+from scheduler import DeadlineScheduler, seconds_to_ns
+from replay_engine import ReplayEngine
+from backends import PyAutoGuiBackend, FailSafeError, create_backend
+import journal as journal_module
+from exclusions import ExclusionIndex
+from capture import CaptureRing, CaptureConsumer, EV_CLICK, EV_MOVE, EV_PRESS, EV_RELEASE, EV_KEY
+import keys
+import hotkeys as hotkeys_module
+from hotkeys import HotkeyRegistry, HotkeyDispatcher
+from mouse_path import PathSimplifier, MOVE_TOLERANCE
+import anchors as anchors_module
+import screen_wait
+from screen_layout import detect_layout
+import macro_optimizer
+from event_log import log, metrics, parse_level
+from replay_trace import ReplayTracer, StepSpans
 
 
 recording = False
-replaying = False
-click_positions = []  # Store click positions as a dictionary
+replay_engine = ReplayEngine()  # Owns the replay thread; only one run at a time
+click_positions = ClickStore()  # Recorded steps, stored column-wise
 
+# pynput modules, imported when the first listener starts (see _load_pynput)
+# so replaying from the command line never loads them
+mouse = None
+keyboard = None
 key_listener = None
 mouse_listener = None
-button_exclusions = []  # Store button positions to exclude from recording
+hotkeys = None  # HotkeyRegistry the keyboard listener looks keys up in, see load_hotkeys()
+_hotkey_dispatcher = None  # Runs hotkey actions off the listener thread
+button_exclusions = ExclusionIndex()  # Screen areas (GUI widgets etc.) excluded from recording
+_next_exclusion_id = 0  # Keys for areas added without one
 replay_step_time = 0.1  # Configurable step time for replay
+input_backend = None  # Default replay backend, created on first use
+journal = None  # RecordingJournal, opened by open_journal()
+capture_ring = CaptureRing()  # Raw events from the mouse listener, see capture.py
+key_ring = CaptureRing()  # Raw key events from the keyboard listener (its own thread, so its own ring)
+_capture_consumer = None  # Turns captured events into steps while recording
+_recording_started_ns = 0  # When recording was last switched on
+_last_step_ns = None  # Capture time of the last recorded step, for its measured delay
+record_moves = False  # Also record mouse paths and drags (applies when recording starts)
+move_tolerance = MOVE_TOLERANCE  # Max distance (px) of the simplified path from the real one
+_capture_moves = False  # record_moves as it was when the current recording started
+record_keys = False  # Also record key presses, except the control hotkeys (applies when recording starts)
+_capture_keys = False  # record_keys as it was when the current recording started
+reference_window = None  # (x, y) of the window steps are recorded against, or None (see screen_layout.py)
+_path = PathSimplifier()  # Simplifies the mouse path between clicks
+_press = None  # (t_ns, x, y, button) of a press waiting for its release
+_dragging = False  # The pending press has turned into a drag
+anchor_matcher = None  # TemplateMatcher shared by replays, keeps recent anchor locations
+screen_waiter = None  # ScreenWaiter shared by replays, learns how long each wait takes
+wait_report = screen_wait.WaitReport()  # Wait steps of the current/last replay vs the delays they replaced
+trace_replay = False  # Trace the phases of every step of the next replays (see replay_trace.py)
+last_trace = None  # ReplayTracer of the last traced replay
+
+# State change events, passed to subscribe_state() callbacks
+STATE_RECORDING = 'recording'  # recording switched on/off
+STATE_REPLAY = 'replay'  # replay started, paused, resumed, stopping or finished
+STATE_CLICKS = 'clicks'  # click list changed or was replaced
+STATE_LISTENERS = 'listeners'  # keyboard/mouse listener started or stopped
+STATE_CYCLE = 'cycle'  # a replay cycle finished, replay metrics were updated
+_state_listeners = ()  # callbacks taking the event kind
+
+
+def subscribe_state(callback):
+    """
+    Calls callback(kind) whenever recording, replay, click list or listener
+    state changes. Callbacks may run on the pynput or replay thread.
+    """
+    global _state_listeners
+    _state_listeners = _state_listeners + (callback,)
+
+def unsubscribe_state(callback):
+    global _state_listeners
+    _state_listeners = tuple(c for c in _state_listeners if c != callback)
+
+def notify_state(kind):
+    for callback in _state_listeners:
+        callback(kind)
+
+def _on_clicks_changed(kind, index):
+    notify_state(STATE_CLICKS)
+
+def set_click_positions(steps):
+    """
+    Replaces the click list (e.g. with a loaded macro) and reports the change.
+    """
+    global click_positions, _last_step_ns
+    _last_step_ns = None
+    click_positions.unsubscribe(_on_clicks_changed)
+    click_positions = steps
+    click_positions.subscribe(_on_clicks_changed)
+    notify_state(STATE_CLICKS)
+
+click_positions.subscribe(_on_clicks_changed)
+replay_engine.subscribe(lambda state: notify_state(STATE_REPLAY))
+
+
+def _load_pynput():
+    global mouse, keyboard
+    if mouse is None:
+        import pynput.mouse
+        import pynput.keyboard
+        mouse = pynput.mouse
+        keyboard = pynput.keyboard
+
+
+def metrics_snapshot():
+    """
+    Counters and histograms of the current or last replay (event_log.metrics).
+    """
+    return metrics.snapshot()
+
+def set_log_level(level):
+    """
+    Sets the event log level, by name or number.
+    """
+    log.level = parse_level(level)
+
+
+def get_input_backend():
+    """
+    Returns the default input backend, creating the pyautogui one on first use.
+    """
+    global input_backend
+    if input_backend is None:
+        input_backend = PyAutoGuiBackend()
+    return input_backend
+
+def set_input_backend(backend):
+    """
+    Sets the default input backend (an InputBackend or a backend name).
+    """
+    global input_backend
+    input_backend = create_backend(backend) if isinstance(backend, str) else backend
+
+
+def current_layout(backend=None):
+    """
+    The ScreenLayout of the desktop (with reference_window), or None if it
+    can't be found out; macros are recorded with it and mapped to it on load.
+    The backend (default: the default backend) is only asked for its screen
+    size when there is no X server to ask.
+    """
+    return detect_layout(lambda: (backend or get_input_backend()).screen_size(), reference_window)
 
 
 def on_click(x, y, button, pressed):
-    global recording, replaying, click_positions, button_exclusions
-    if button == mouse.Button.left and pressed and recording:
-        # Check if click is within any excluded button area
-        if is_click_on_button(x, y):
-            return
+    # Runs on the pynput listener thread: only timestamp and queue the event,
+    # the capture consumer turns it into a step
+    t_ns = time.monotonic_ns()
+    if button == mouse.Button.left and recording:
+        if _capture_moves:
+            capture_ring.push(EV_PRESS if pressed else EV_RELEASE, x, y, button.name, t_ns=t_ns)
+        elif pressed:
+            capture_ring.push(EV_CLICK, x, y, button.name, t_ns=t_ns)
 
-        # Check for double click (rapid clicks at same position)
-        double_click = False
-        if (click_positions and
-            x == click_positions[-1].x and
-            y == click_positions[-1].y and
-            not click_positions[-1].is_double_click):
-            # Convert last click to double click
-            click_positions[-1].is_double_click = True
-            return
+def on_move(x, y):
+    # Runs on the pynput listener thread for every reported mouse position
+    if recording:
+        capture_ring.push(EV_MOVE, x, y)
 
-        # Create new click
-        click = Click(x, y, button=button.name, delay=0, is_double_click=double_click)
-        click_positions.append(click)
-        print(f"Recorded click at: ({x}, {y})")
-        
+def record_events(events):
+    """
+    Turns captured raw events into steps; runs on the capture consumer thread.
+    A step's delay is the measured time until the next recorded step.
+    """
+    for t_ns, kind, x, y, button, amount in events:
+        if kind == EV_MOVE:
+            _record_move(t_ns, x, y)
+        elif kind == EV_CLICK:
+            _record_click(t_ns, x, y, button)
+        elif kind == EV_PRESS:
+            _record_press(t_ns, x, y, button)
+        elif kind == EV_RELEASE:
+            _record_release(t_ns, x, y, button)
+        elif kind == EV_KEY:
+            _record_key(t_ns, amount)
+
+def _append_step(t_ns, x, y, button=None, **step_type):
+    """Appends a step captured at t_ns and sets the previous step's delay"""
+    global _last_step_ns
+    # The previous step waits until this one, unless recording was off in between
+    if click_positions and _last_step_ns is not None and _last_step_ns >= _recording_started_ns:
+        click_positions[-1].delay = round((t_ns - _last_step_ns) / 1e9, 3)
+        if journal:
+            journal.set_step(click_positions, -1)
+    click_positions.add(x, y, button=button, delay=0, **step_type)
+    if journal:
+        journal.append_step(click_positions)
+    _last_step_ns = t_ns
+
+def _record_click(t_ns, x, y, button):
+    global _last_step_ns
+    # Check if click is within any excluded button area
+    if is_click_on_button(x, y):
+        return
+
+    # Check for double click (rapid clicks at same position)
+    if (click_positions and
+        x == click_positions[-1].x and
+        y == click_positions[-1].y and
+        not click_positions[-1].is_double_click):
+        # Convert last click to double click
+        click_positions[-1].is_double_click = True
+        if journal:
+            journal.mark_double_last()
+        _last_step_ns = t_ns
+        return
+
+    # Create new click
+    _append_step(t_ns, x, y, button)
+    log.info('record_click', "Recorded click at: ({x}, {y})", x=x, y=y)
+
+def _record_key(t_ns, code):
+    # The path up to the key press is final
+    _record_path(_path.flush())
+    key = keys.key_name(code)
+    _append_step(t_ns, 0, 0, key=key)
+    log.info('record_key', "Recorded key: {key!r}", key=key)
+
+def _record_path(points):
+    for t_ns, x, y in points:
+        _append_step(t_ns, x, y, is_move=True)
+
+def _record_move(t_ns, x, y):
+    global _dragging
+    if _press is not None and not _dragging:
+        press_ns, press_x, press_y, press_button = _press
+        if abs(x - press_x) <= move_tolerance and abs(y - press_y) <= move_tolerance:
+            return  # jitter while clicking
+        # The button is held and the mouse moved away: this press starts a drag
+        _dragging = True
+        _append_step(press_ns, press_x, press_y, press_button, is_mouse_down=True)
+        _path.reset((press_ns, press_x, press_y))
+        log.info('record_drag_start', "Recording drag from: ({x}, {y})", x=press_x, y=press_y)
+    _record_path(_path.add(t_ns, x, y))
+
+def _record_press(t_ns, x, y, button):
+    global _press, _dragging
+    _dragging = False
+    if is_click_on_button(x, y):
+        _press = None
+        return
+    # The path up to the press is final
+    _record_path(_path.flush())
+    _press = (t_ns, x, y, button)
+
+def _record_release(t_ns, x, y, button):
+    global _press, _dragging
+    if _press is None:
+        return  # excluded, or pressed before recording started
+    if _dragging:
+        _record_path(_path.flush())
+        _append_step(t_ns, x, y, button, is_mouse_up=True)
+        _path.reset((t_ns, x, y))
+        log.info('record_drag_end', "Recorded drag to: ({x}, {y})", x=x, y=y)
+    else:
+        press_ns, press_x, press_y, press_button = _press
+        _record_click(press_ns, press_x, press_y, press_button)
+        _path.reset((press_ns, press_x, press_y))
+    _press = None
+    _dragging = False
+
+def _start_capture():
+    global _capture_consumer, _recording_started_ns, _capture_moves, _capture_keys, _press, _dragging
+    _recording_started_ns = time.monotonic_ns()
+    _capture_moves = record_moves
+    _capture_keys = record_keys
+    _path.tolerance = move_tolerance
+    _path.reset()
+    _press = None
+    _dragging = False
+    if _capture_consumer is None or not _capture_consumer.running:
+        _capture_consumer = CaptureConsumer((capture_ring, key_ring), record_events)
+        _capture_consumer.start()
+
+def _stop_capture():
+    """
+    Stops the capture consumer once it has recorded every queued event.
+    Path points still buffered (the way to the GUI's stop button) are dropped.
+    """
+    global _capture_consumer
+    if _capture_consumer is not None:
+        _capture_consumer.stop()
+        _capture_consumer = None
+    _path.reset()
+    # The listeners may still be pushing, so the counts are only read here
+    dropped = capture_ring.new_drops() + key_ring.new_drops()
+    if dropped:
+        log.warning('capture_overflow', "Capture queue overflowed, {dropped} events were dropped",
+                    dropped=dropped)
+        metrics.incr('capture_dropped', dropped)
 
 def is_click_on_button(x, y):
     """Check if the click coordinates are within any excluded button area"""
-    global button_exclusions
-    for button_info in button_exclusions:
-        bx, by, bw, bh = button_info
-        if bx <= x <= bx + bw and by <= y <= by + bh:
-            return True
-    return False
+    return button_exclusions.hit(x, y) is not None
+
+def set_exclusion(key, x, y, width, height):
+    """Add or move the excluded area registered under key; returns True if it changed"""
+    return button_exclusions.set(key, x, y, width, height)
+
+def remove_exclusion(key):
+    button_exclusions.remove(key)
+
+def exclusion_keys():
+    return button_exclusions.keys()
 
 def add_button_exclusion(x, y, width, height):
     """Add a button area to exclude from recording"""
-    global button_exclusions
-    button_exclusions.append((x, y, width, height))
+    global _next_exclusion_id
+    _next_exclusion_id += 1
+    key = f"area-{_next_exclusion_id}"
+    button_exclusions.set(key, x, y, width, height)
     #print(f"Added button exclusion: x={x}, y={y}, w={width}, h={height}")
+    return key
 
 def clear_button_exclusions():
     """Clear all button exclusions"""
-    global button_exclusions
-    button_exclusions = []
+    button_exclusions.clear()
     #print("Recalculated all button exclusions")
 
 def on_press(key):
-    global recording, replaying, click_positions
-    try:
-        if key == keyboard.KeyCode.from_char('q') and recording:
-            print("Stopped recording...")
-            recording = False
-            # Stop mouse listener when recording stops via keyboard
-            global mouse_listener
-            if mouse_listener and mouse_listener.running:
-                mouse_listener.stop()
-                print("Mouse listener stopped")
-        
-        elif key == keyboard.KeyCode.from_char('Q'):
-            print("Exiting listeners.")
-            stop_listeners()
-            return False  # Stop the listener
-        elif key == keyboard.KeyCode.from_char('d'):
-            recording_switch()
-        elif key == keyboard.KeyCode.from_char('y'):
-            replaying = not replaying
-            print(f"{'Started' if replaying else 'Stopped'} replay...")
-            if replaying:
-                recording = False  # Stop recording if replaying starts
-                # Also stop mouse listener if it was running
-                if mouse_listener and mouse_listener.running:
-                    mouse_listener.stop()
-                    print("Mouse listener stopped for replay")
-                replay_thread = threading.Thread(target=replay_clicks)
-                replay_thread.daemon = True
-                replay_thread.start()
-        elif key == keyboard.KeyCode.from_char('c'):
-            clear_clicks()
-    except AttributeError:
-        # Handle special keys that don't have char representation
-        pass
-    
+    # Runs on the pynput listener thread for every key pressed anywhere:
+    # bound hotkeys go to the dispatch thread, other keys may be recorded
+    action = hotkeys.on_press(key)
+    if action is not None:
+        _hotkey_dispatcher.submit(action)
+    elif recording and _capture_keys:
+        # Not a control hotkey: queue it like on_click does
+        code = keys.from_pynput(key)
+        if code is not None:
+            key_ring.push(EV_KEY, 0, 0, amount=code)
+
+def on_release(key):
+    hotkeys.on_release(key)
+
+def _stop_recording():
+    if recording:
+        recording_switch()
+
+def _exit_listeners():
+    log.info('listener', "Exiting listeners.")
+    stop_listeners()
+
+def _hotkey_actions():
+    """hotkeys.ACTIONS names -> the functions they run"""
+    return {
+        'toggle_recording': recording_switch,
+        'stop_recording': _stop_recording,
+        'toggle_replay': toggle_replay,
+        'pause_replay': toggle_pause_replay,
+        'clear': clear_clicks,
+        'exit': _exit_listeners,
+    }
+
+def load_hotkeys(path=hotkeys_module.HOTKEYS_FILE):
+    """
+    Loads the hotkey bindings from path (the defaults if there is no such
+    file) and returns them as hotkey_bindings() does.
+    Raises ValueError for invalid bindings, keeping the current ones.
+    """
+    global hotkeys
+    bindings = hotkeys_module.load_bindings(path)
+    if hotkeys is None:
+        hotkeys = HotkeyRegistry(bindings)
+    else:
+        hotkeys.bind_all(bindings)
+    log.info('hotkeys', "Loaded {count} hotkeys", count=len(bindings))
+    return hotkey_bindings()
+
+def hotkey_bindings():
+    """(chord, action description) pairs of the active hotkeys"""
+    registry = hotkeys or HotkeyRegistry()
+    return [(chord, hotkeys_module.ACTIONS[action]) for chord, action in registry.bindings()]
+
 
 def recording_switch():
     """
     Starts recording mouse clicks.
     """
-    global recording, replaying, mouse_listener
+    global recording, mouse_listener
     recording = not recording
 
     if recording:
-        replaying = False  # Stop replay if recording is started
+        replay_engine.stop()  # Stop replay if recording is started
+        if click_positions.layout is None and not len(click_positions):
+            click_positions.layout = current_layout()
+            if journal:
+                journal.set_layout(click_positions.layout)
+        _start_capture()
         # Start mouse listener when recording starts
         if mouse_listener is None or not mouse_listener.running:
-            mouse_listener = mouse.Listener(on_click=on_click)
+            _load_pynput()
+            mouse_listener = mouse.Listener(on_click=on_click, on_move=on_move if _capture_moves else None)
             mouse_listener.daemon = True
             mouse_listener.start()
-            print("Mouse listener started for recording")
+            log.info('listener', "Mouse listener started for recording", listener='mouse', running=True)
+            notify_state(STATE_LISTENERS)
     else:
+        _stop_capture()
         # Stop mouse listener when recording stops
         if mouse_listener and mouse_listener.running:
             mouse_listener.stop()
-            print("Mouse listener stopped")
+            log.info('listener', "Mouse listener stopped", listener='mouse', running=False)
+            notify_state(STATE_LISTENERS)
     
-    print(f"Recording {'started' if recording else 'stopped'}")
+    log.info('recording', "Recording {state}", state='started' if recording else 'stopped', recording=recording)
+    notify_state(STATE_RECORDING)
 
 def start_listeners():
     """
     Starts only the keyboard listener.
     """
-    global key_listener
+    global key_listener, hotkeys, _hotkey_dispatcher
     
     if key_listener is None or not key_listener.running:
-        key_listener = keyboard.Listener(on_press=on_press)
+        _load_pynput()
+        if hotkeys is None:
+            try:
+                load_hotkeys()
+            except (OSError, ValueError) as e:
+                log.error('hotkeys', "Could not load hotkeys, using the defaults: {error}", error=e)
+                hotkeys = HotkeyRegistry()
+        if _hotkey_dispatcher is None:
+            _hotkey_dispatcher = HotkeyDispatcher(_hotkey_actions())
+        key_listener = keyboard.Listener(on_press=on_press, on_release=on_release)
         key_listener.daemon = True
         key_listener.start()
-        print("Keyboard listener started")
+        log.info('listener', "Keyboard listener started", listener='keyboard', running=True)
+        notify_state(STATE_LISTENERS)
 
 def start_keyboard_listener():
     """
@@ -146,111 +450,561 @@ def stop_keyboard_listener():
     
     if key_listener and key_listener.running:
         key_listener.stop()
-        print("Keyboard listener stopped")
+        log.info('listener', "Keyboard listener stopped", listener='keyboard', running=False)
+        notify_state(STATE_LISTENERS)
 
 def stop_listeners():
     """
     Stops both keyboard and mouse listeners.
     """
-    global key_listener, mouse_listener, replaying
+    global key_listener, mouse_listener
     
-    replaying = False
+    replay_engine.stop()
+    _stop_capture()
     
     if key_listener and key_listener.running:
         key_listener.stop()
-        print("Keyboard listener stopped")
+        log.info('listener', "Keyboard listener stopped", listener='keyboard', running=False)
     
     if mouse_listener and mouse_listener.running:
         mouse_listener.stop()
-        print("Mouse listener stopped")
+        log.info('listener', "Mouse listener stopped", listener='mouse', running=False)
+    notify_state(STATE_LISTENERS)
+
+def add_step(click):
+    """
+    Appends a step (Click or ClickView) to the click list and the journal.
+    """
+    click_positions.append(click)
+    if journal:
+        journal.append_step(click_positions)
+
+def insert_step(index, click):
+    """
+    Inserts a step (Click or ClickView) before click_positions[index] and
+    records it in the journal. Returns the index it ended up at.
+    """
+    index = click_positions.insert(index, click)
+    if journal:
+        journal.insert_step(click_positions, index)
+    return index
+
+def step_edited(index):
+    """
+    Records an in-place edit of click_positions[index] in the journal.
+    """
+    if journal:
+        journal.set_step(click_positions, index)
 
 def clear_clicks():
     """
     Clears the recorded click positions.
+    The journal is moved aside so restore_cleared_clicks() can undo this.
     """
-    global click_positions
-    click_positions = []
-    print("Click positions cleared.")
+    set_click_positions(ClickStore())
+    if journal:
+        journal.rotate()
+    log.info('clicks', "Click positions cleared.")
+
+def restore_cleared_clicks():
+    """
+    Restores the click list from before the last clear_clicks().
+    """
+    restored = journal_module.restore_previous(journal.path if journal else journal_module.JOURNAL_FILE)
+    if not restored:
+        log.info('clicks', "Nothing to restore")
+        return
+    set_click_positions(restored)
+    if journal:
+        # Start the live journal over from the restored list
+        journal.reset()
+        journal.set_layout(click_positions.layout)
+        for i in range(len(click_positions)):
+            journal.append_step(click_positions, i)
+    log.info('clicks', "Restored {count} cleared clicks", count=len(click_positions))
+
+def optimize_clicks(**options):
+    """
+    Replaces click_positions with an optimized copy (see macro_optimizer.py)
+    and restarts the journal from it. Options go to macro_optimizer.optimize;
+    the step time defaults to the replay step time.
+    Returns the OptimizeReport, or None while recording or replaying.
+    """
+    if recording or replay_engine.is_running:
+        log.warning('optimize', "Stop recording and replay before optimizing")
+        return None
+    options.setdefault('step_time', replay_step_time)
+    optimized, report = macro_optimizer.optimize(click_positions, **options)
+    if report.changed:
+        set_click_positions(optimized)
+        if journal:
+            journal.reset()
+            journal.set_layout(click_positions.layout)
+            for i in range(len(click_positions)):
+                journal.append_step(click_positions, i)
+    log.info('optimize', "Optimized: {report}", report=report, **report.summary())
+    return report
+
+def open_journal(path=journal_module.JOURNAL_FILE):
+    """
+    Recovers steps left in the journal by an earlier session (e.g. a crash),
+    then keeps journaling every change to the click list.
+    """
+    global journal
+    recovered = journal_module.recover(path)
+    if recovered:
+        set_click_positions(recovered)
+        log.info('journal', "Recovered {count} clicks from journal {path}", count=len(recovered), path=path)
+    journal = journal_module.RecordingJournal(path)
+
+def compact_journal(saved_path):
+    """
+    Called after the click list was saved to (or loaded from) saved_path:
+    the journal restarts from that file instead of growing forever.
+    """
+    if journal:
+        journal.reset(saved_path, click_positions.layout)
+
+def close_journal():
+    global journal
+    if journal:
+        journal.close()
+        journal = None
+
+def start_replay(backend=None, cycles=None, steps=None):
+    """
+    Starts replaying on the replay engine's thread.
+    `backend` selects the input backend for this run only,
+    `cycles` limits the number of cycles (default: until stopped),
+    `steps` replays a macro other than click_positions.
+    Returns False if a replay is already running.
+    """
+    global recording, mouse_listener
+    if replay_engine.is_running:
+        log.warning('replay', "Replay already running")
+        return False
 
-def replay_clicks():
+    if recording:
+        recording = False  # Stop recording if replaying starts
+        _stop_capture()
+        notify_state(STATE_RECORDING)
+    # Also stop mouse listener if it was running
+    if mouse_listener and mouse_listener.running:
+        mouse_listener.stop()
+        log.info('listener', "Mouse listener stopped for replay", listener='mouse', running=False)
+        notify_state(STATE_LISTENERS)
+
+    if not replay_engine.start(replay_clicks, backend, cycles, steps):
+        log.warning('replay', "Replay already running")
+        return False
+    log.info('replay', "Started replay...", state='started')
+    return True
+
+def stop_replay():
+    """
+    Stops the running replay, interrupting any wait in progress.
+    """
+    replay_engine.stop()
+    log.info('replay', "Stopped replay...", state='stopping')
+
+def toggle_replay():
+    if replay_engine.is_running:
+        stop_replay()
+    else:
+        start_replay()
+
+def toggle_pause_replay():
+    """
+    Pauses a running replay or resumes a paused one.
+    """
+    if replay_engine.is_paused:
+        replay_engine.resume()
+        log.info('replay', "Replay resumed", state='resumed')
+    elif replay_engine.is_running:
+        replay_engine.pause()
+        log.info('replay', "Replay paused", state='paused')
+
+# Pause between two cycles of the replay loop
+CYCLE_PAUSE = 0.1
+
+def get_anchor_matcher():
+    global anchor_matcher
+    if anchor_matcher is None:
+        anchor_matcher = anchors_module.TemplateMatcher()
+    return anchor_matcher
+
+def anchor_step(index, backend=None, size=anchors_module.ANCHOR_SIZE):
+    """
+    Anchors click_positions[index] to the screen patch currently around it,
+    so replay finds that UI element again even if it moved.
+    Returns the Anchor, or None if the patch has too little detail.
+    """
+    backend = backend or get_input_backend()
+    step = click_positions[index]
+    screen_w, screen_h = backend.screen_size()
+    left = min(max(step.x - size, 0), max(screen_w - 2 * size, 0))
+    top = min(max(step.y - size, 0), max(screen_h - 2 * size, 0))
+    region = backend.screenshot(left, top, min(2 * size, screen_w), min(2 * size, screen_h))
+    anchor = anchors_module.capture_anchor(region, step.x, step.y, size, origin=(left, top))
+    if anchor is None:
+        log.warning('anchor', "Step {step}: not enough detail around ({x}, {y}) to anchor",
+                    step=index + 1, x=step.x, y=step.y)
+        return None
+    step.anchor = anchor
+    step_edited(index)
+    log.info('anchor', "Anchored step {step} to {anchor}", step=index + 1, anchor=anchor)
+    return anchor
+
+def get_screen_waiter():
+    global screen_waiter
+    if screen_waiter is None:
+        screen_waiter = screen_wait.ScreenWaiter()
+    return screen_waiter
+
+def add_wait_step(index, kind=screen_wait.CHANGE, backend=None, size=screen_wait.WAIT_REGION,
+                  timeout=screen_wait.WAIT_TIMEOUT):
+    """
+    Inserts a wait step before click_positions[index], watching a size x size
+    region centered on that step. The fixed delay of the step before it is
+    moved into the wait (as the delay it replaces), so replay goes on as soon
+    as the screen is ready instead of always sleeping.
+    Color and hash conditions take their target from the screen as it is now.
+    Returns the index of the wait step.
+    """
+    backend = backend or get_input_backend()
+    step = click_positions[index]
+    left = max(step.x - size // 2, 0)
+    top = max(step.y - size // 2, 0)
+    region = backend.screenshot(left, top, size, size, kind == screen_wait.COLOR)
+    replaced = 0.0
+    if index > 0:
+        previous = click_positions[index - 1]
+        replaced = previous.delay
+        previous.delay = 0.0
+        step_edited(index - 1)
+    condition = screen_wait.make_condition(kind, region, timeout=timeout, replaced_delay=replaced)
+    index = insert_step(index, Click(left, top, condition=condition))
+    log.info('wait_step', "Added {kind} wait before step {step} (replaces {replaced}s delay)",
+             kind=kind, step=index + 2, replaced=replaced)
+    return index
+
+def _replay_actions(backend, anchors=None, conditions=None, scheduler=None, waits=None, texts=None):
+    """
+    Build the replay dispatch table (indexed by replay_plan opcode) for a backend.
+    `anchors` (anchor id -> Anchor) are the anchors OP_LOCATE refers to,
+    `conditions` (condition id -> WaitCondition) the ones OP_WAIT waits for,
+    `texts` the merged key runs OP_TYPE types.
+    A wait re-bases `scheduler`, so the time it took isn't counted as
+    lateness, and is recorded in the `waits` WaitReport.
+    """
+    def replay_click(x, y, amount):
+        backend.click(x, y)
+        log.debug('click', "Clicked at: ({x}, {y})", x=x, y=y)
+
+    def replay_double_click(x, y, amount):
+        backend.double_click(x, y)
+        log.debug('double_click', "Double-clicked at: ({x}, {y})", x=x, y=y)
+
+    def replay_move(x, y, amount):
+        try:
+            backend.move(x, y)
+        except FailSafeError:
+            raise
+        except Exception as e:
+            log.error('move', "Move failed: {error}", error=e)
+
+    def replay_scroll(x, y, amount):
+        try:
+            backend.scroll(amount)
+            log.debug('scroll', "Scrolled {amount} at: ({x}, {y})", amount=amount, x=x, y=y)
+        except FailSafeError:
+            raise
+        except Exception as e:
+            log.error('scroll', "Scroll failed: {error}", error=e)
+
+    def replay_mouse_down(x, y, amount):
+        backend.mouse_down(x, y)
+        log.debug('mouse_down', "Started drag at: ({x}, {y})", x=x, y=y)
+
+    def replay_mouse_up(x, y, amount):
+        backend.mouse_up(x, y)
+        log.debug('mouse_up', "Dropped at: ({x}, {y})", x=x, y=y)
+
+    def replay_key(x, y, code):
+        key = keys.key_name(code)
+        backend.press_key(key)
+        log.debug('key', "Pressed key: {key!r}", key=key)
+
+    def replay_type(x, y, index):
+        text = texts[index]
+        backend.type_text(text)
+        log.debug('type', "Typed {count} characters", count=len(text))
+
+    actions = {
+        OP_CLICK: replay_click,
+        OP_DOUBLE_CLICK: replay_double_click,
+        OP_SCROLL: replay_scroll,
+        OP_MOVE: replay_move,
+        OP_MOUSE_DOWN: replay_mouse_down,
+        OP_MOUSE_UP: replay_mouse_up,
+        OP_PATH_MOVE: replay_move,  # no print: paths have many points
+        OP_KEY: replay_key,
+        OP_TYPE: replay_type,
+    }
+
+    def replay_wait(x, y, code):
+        condition = (conditions or {}).get(code)
+        if condition is None:
+            log.warning('wait', "Wait step at ({x}, {y}) has no condition, skipping", x=x, y=y)
+            return
+
+        def sleep(deadline_ns):
+            return replay_engine.wait_until(deadline_ns) is not None
+
+        try:
+            met, waited_ns = get_screen_waiter().wait(condition, x, y, backend.screenshot, sleep)
+        except Exception as e:
+            log.error('wait', "Wait failed: {error}", error=e)
+            return
+        if met is None:  # Replay was stopped
+            return
+        if waits is not None:
+            waits.record(condition, met, waited_ns)
+        if scheduler is not None:
+            scheduler.rebase()
+        if met:
+            log.debug('wait', "Screen {kind} at ({x}, {y}) after {waited:.3f}s", kind=condition.kind, x=x, y=y,
+                      waited=waited_ns / 1e9)
+        else:
+            log.warning('wait', "Wait for screen {kind} at ({x}, {y}) timed out after {timeout}s",
+                        kind=condition.kind, x=x, y=y, timeout=condition.timeout)
+
+    def replay_unused(x, y, amount):
+        pass
+
+    actions[OP_WAIT] = replay_wait
+
+    # Anchored steps: OP_LOCATE finds the anchor, the step's instructions
+    # (opcode + OP_ANCHORED) are shifted by how far it moved
+    shift = [0, 0]
+    located = [False]
+
+    def replay_locate(x, y, code):
+        anchor = (anchors or {}).get(code)
+        found = None
+        if anchor is not None:
+            try:
+                found = get_anchor_matcher().locate(anchor, backend.screenshot, backend.screen_size())
+            except Exception as e:
+                log.error('locate', "Locating anchor failed: {error}", error=e)
+        located[0] = found is not None
+        if found is None:
+            log.warning('locate', "Anchor for ({x}, {y}) not found, skipping step", x=x, y=y)
+            return
+        shift[0] = found[0] - anchor.ref_x
+        shift[1] = found[1] - anchor.ref_y
+
+    def anchored(action):
+        def replay_anchored(x, y, amount):
+            if located[0]:
+                action(x + shift[0], y + shift[1], amount)
+        return replay_anchored
+
+    actions[OP_LOCATE] = replay_locate
+    table = [actions.get(op, replay_unused) for op in range(OP_ANCHORED)]
+    table += [anchored(action) for action in table]
+    return table
+
+def _flushing_waiter(backend, waiter):
+    """
+    Wraps the scheduler's waiter for a batching backend: queued actions are
+    sent before waiting for a deadline that is still ahead, so they go out
+    on time, while actions that are already due keep queuing.
+    """
+    flush = backend.flush
+    now_ns = time.monotonic_ns
+
+    def wait(deadline_ns):
+        if deadline_ns > now_ns():
+            flush()
+        return waiter(deadline_ns)
+    return wait
+
+def replay_clicks(backend=None, cycles=None, steps=None):
     """
     Replays the recorded clicks at the stored positions with individual delays and offsets.
+    Actions go to `backend`, or to the module's input backend when not given.
+    Runs until stopped, or for `cycles` cycles when given.
+    `steps` replays something other than click_positions, e.g. a memory-mapped macro file
+    or a ReplayPlan compiled earlier (as the control server caches them).
+    Every action is scheduled against an absolute deadline: step time plus the
+    step's own delay after each action, and CYCLE_PAUSE between cycles.
+    Recorded mouse paths keep their recorded timing, without the step time.
+    Wait steps hold replay until their screen condition holds; the time saved
+    against the delays they replaced is reported per cycle (see wait_report).
+    Runs on the replay engine's thread; waits end as soon as the engine is stopped.
+    Per-action events are logged at DEBUG; counters and latency histograms
+    of the run go to event_log.metrics (reset when the run starts).
+    With trace_replay set, the run is also traced into last_trace.
     """
-    global click_positions, replaying
+    global last_trace
+    global click_positions
+    if steps is None:
+        steps = click_positions
 
-    if not click_positions:
-        print("No clicks recorded to replay")
+    if not len(steps):
+        log.warning('replay', "No clicks recorded to replay")
         return
 
-    cycle_count = 0
-    while replaying:
-        cycle_count += 1
-        print(f"Starting replay cycle #{cycle_count}")
+    # Compile once; per-cycle coordinates are computed in blocks by the plan
+    plan = steps if isinstance(steps, ReplayPlan) else compile_plan(steps)
+    backend = backend or get_input_backend()
+    waiter = replay_engine.wait_until
+    if backend.batches:
+        waiter = _flushing_waiter(backend, waiter)
+    scheduler = DeadlineScheduler(waiter=waiter)
+    waits = screen_wait.WaitReport()  # this cycle's wait steps
+    actions = _replay_actions(backend, plan.anchors, plan.conditions, scheduler, waits, plan.texts)
+    wait_report.reset()
+
+    # Per-opcode histograms of how long the backend call took, and lateness
+    metrics.reset()
+    action_latency = [metrics.histogram(f"action.{OP_NAMES[op % OP_ANCHORED]}").record
+                      if op % OP_ANCHORED < len(OP_NAMES) else metrics.histogram('action.unused').record
+                      for op in range(len(actions))]
+    record_lateness = metrics.histogram('lateness').record
+    perf_ns = time.perf_counter_ns
 
-        for i, click_obj in enumerate(click_positions):
-            if not replaying:  # Check if we should stop
+    tracer = None
+    if trace_replay:
+        tracer = last_trace = ReplayTracer()
+        tracer.metadata.update(backend=backend.name, steps=len(steps), instructions=len(plan),
+                               step_time_s=replay_step_time, cycles=cycles)
+        pyautogui_module = getattr(backend, 'pyautogui', None)
+        if pyautogui_module is not None:
+            tracer.metadata['pyautogui_pause_s'] = pyautogui_module.PAUSE
+        step_of = plan.steps.tolist() if hasattr(plan.steps, 'tolist') else list(plan.steps)
+        op_names = [OP_NAMES[op % OP_ANCHORED] if op % OP_ANCHORED < len(OP_NAMES) else 'unused'
+                    for op in range(len(actions))]
+
+    backend.begin_run()
+    scheduler.start()
+    try:
+        for cycle_count, rows in plan.iter_cycles():
+            if replay_engine.stop_requested or (cycles is not None and cycle_count > cycles):
                 break
-            # Calculate position with offset for this cycle
-            current_x = click_obj.x + (click_obj.offset_x * (cycle_count - 1))
-            current_y = click_obj.y + (click_obj.offset_y * (cycle_count - 1))
-
-            # If this item is a scroll action, perform scroll instead of click
-            if getattr(click_obj, 'is_scroll', False):
-                try:
-                    # Ensure mouse is at the intended coordinates before scrolling.
-                    # Some platforms/drivers ignore x/y in scroll, so move first then scroll.
-                    pyautogui.moveTo(current_x, current_y)
-                    # tiny pause to ensure OS updates pointer location
-                    time.sleep(0.02)
-                    pyautogui.scroll(int(click_obj.scroll_amount))
-                    print(f"Scrolled {click_obj.scroll_amount} at: ({current_x}, {current_y})")
-                except Exception as e:
-                    print(f"Scroll failed: {e}")
+            log.info('cycle_start', "Starting replay cycle #{cycle}", cycle=cycle_count)
+            # Read every cycle so spinbox changes apply to a running replay
+            step_ns = seconds_to_ns(replay_step_time)
+            step_times = [0 if op % OP_ANCHORED in UNTIMED_OPS else step_ns for op in range(len(actions))]
+
+            executed = 0
+            if tracer is None:
+                for op, x, y, amount, delay_ns in rows:
+                    late = scheduler.wait()
+                    if late is None:  # Engine was stopped
+                        break
+                    started = perf_ns()
+                    actions[op](x, y, amount)
+                    action_latency[op](perf_ns() - started)
+                    record_lateness(late)
+                    executed += 1
+                    scheduler.advance(step_times[op] + delay_ns)
             else:
-                # Perform the click
-                if click_obj.is_double_click:
-                    pyautogui.doubleClick(current_x, current_y)
-                    print(f"Double-clicked at: ({current_x}, {current_y})")
-                else:
-                    pyautogui.click(current_x, current_y)
-                    print(f"Clicked at: ({current_x}, {current_y})")
+                cycle_started = perf_ns()
+                spans = StepSpans(tracer, cycle_count)
+                scheduled = (0, 0)  # step time and delay planned after the previous instruction
+                for index, (op, x, y, amount, delay_ns) in enumerate(rows):
+                    waiting = perf_ns()
+                    late = scheduler.wait()
+                    started = perf_ns()
+                    step = step_of[index]
+                    name = op_names[op]
+                    tracer.complete('scroll settle' if name == 'scroll' else 'delay', 'schedule', waiting, started,
+                                    cycle=cycle_count, step=step, late_ms=(late or 0) / 1e6,
+                                    step_time_ms=scheduled[0] / 1e6, delay_ms=scheduled[1] / 1e6)
+                    if late is None:
+                        spans.add(step, waiting, started)
+                        break
+                    actions[op](x, y, amount)
+                    finished = perf_ns()
+                    tracer.complete(name, 'backend', started, finished, cycle=cycle_count, step=step, x=x, y=y)
+                    spans.add(step, waiting, finished)
+                    action_latency[op](finished - started)
+                    record_lateness(late)
+                    executed += 1
+                    scheduler.advance(step_times[op] + delay_ns)
+                    scheduled = (step_times[op], delay_ns)
+                spans.close()
+                tracer.complete(f"cycle {cycle_count}", 'cycle', cycle_started, perf_ns(), cycle=cycle_count)
+
+            report = scheduler.cycle_report()
+            metrics.incr('actions', executed)
+            metrics.incr('cycles')
+            metrics.incr('resyncs', report['resyncs'])
+            log.info('cycle_end', "Cycle #{cycle} lateness: p50={p50_ms:.3f}ms p99={p99_ms:.3f}ms "
+                     "max={max_ms:.3f}ms over {count} steps", cycle=cycle_count, **report)
+            if waits.count:
+                summary = waits.summary()
+                log.info('cycle_waits', "Cycle #{cycle} waits: {waits} ({timeouts} timed out), "
+                         "{saved_s:.3f}s saved vs fixed delays", cycle=cycle_count, **summary)
+                metrics.incr('waits', waits.count)
+                metrics.incr('wait_timeouts', waits.timeouts)
+                wait_report.merge(waits)
+                waits.reset()
+            notify_state(STATE_CYCLE)
 
-            # Wait for the specified delay after this click/scroll
-            if getattr(click_obj, 'delay', 0) > 0:
-                time.sleep(click_obj.delay)
+            # Optional: small delay between cycles
+            if not replay_engine.stop_requested and cycle_count < 100:  # Prevent infinite loops
+                scheduler.advance(seconds_to_ns(CYCLE_PAUSE))
+    except FailSafeError as e:
+        log.warning('replay', "Replay stopped by the failsafe: {error}", error=e)
+    finally:
+        backend.end_run()
 
-        # Optional: small delay between cycles
-        if replaying and cycle_count < 100:  # Prevent infinite loops
-            time.sleep(0.1)  # Small pause between cycles
+    if wait_report.count:
+        log.info('waits', "Waits: {met} met, {timeouts} timed out, {waited_s:.3f}s waited instead of "
+                 "{replaced_s:.3f}s ({saved_s:.3f}s saved)", **wait_report.summary())
+    log.info('replay', "Replay finished", state='finished')
 
-    print("Replay finished")
+def export_trace(path):
+    """
+    Writes the trace of the last traced replay as Chrome Trace Event JSON
+    (open it in Perfetto). Returns False if no replay was traced.
+    """
+    if last_trace is None:
+        log.warning('trace', "No traced replay to export; enable tracing and replay first")
+        return False
+    last_trace.export(path)
+    log.info('trace', "Exported {count} trace events to {path}", count=len(last_trace.events), path=path)
+    return True
 
 # not used yet
 def double_click_n_copy():
     """
     Double-clicks at the current mouse position and copies the selected text.
     """
-    global replaying
-    if not replaying:
-        print("Not in replay mode, cannot double-click and copy")
+    if not replay_engine.is_running:
+        log.warning('copy', "Not in replay mode, cannot double-click and copy")
         return
     
+    import pyautogui
     current_pos = pyautogui.position()
     pyautogui.doubleClick(current_pos)
     time.sleep(0.1)  # Small delay to ensure double-click is registered
     pyautogui.hotkey('ctrl', 'c')  # Copy the selected text
-    print(f"Double-clicked and copied text at: {current_pos}")
+    log.info('copy', "Double-clicked and copied text at: {position}", position=current_pos)
 
 if __name__ == "__main__":
     # Don't start any listeners by default when running directly
-    print("ClickNCommand module loaded. Use GUI to control listeners.")
+    log.info('startup', "ClickNCommand module loaded. Use GUI to control listeners.")
     
     try:
         # Keep the main thread alive
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        print("Interrupted by user")
+        log.info('startup', "Interrupted by user")
         stop_listeners()
 
 # implement it do other commands after a click + timed clicks
@@ -0,0 +1,675 @@
+"""
+Local control server: lets a job scheduler drive a running clickanput process.
+
+Starting the app or macro_cli for every job pays for the interpreter, Tk,
+pyautogui and pynput each time. Instead, a warm process (the GUI with
+--control, the input engine process, or `macro_cli serve`) runs a
+ControlServer, and jobs only send it a command.
+
+The protocol is JSON lines over a Unix socket, or over TCP on a loopback
+address when the address is HOST:PORT (or the platform has no Unix
+sockets). The Unix socket is only accessible to its user; any local process
+can reach a TCP port though, so there the first request of a connection must
+be {"cmd": "auth", "token": ...} with the token the server keeps in a file
+only its user can read (see token_path). Each request is one object, e.g. {"cmd": "start", "macro": "job.mvb", "cycles": 2},
+and gets one answer line, {"ok": true, "result": ...} or
+{"ok": false, "error": "..."}:
+
+  - ping: the server's pid
+  - load path [name] [force]: load and compile a macro into the cache
+  - unload name, macros: drop a cached macro, list them
+  - start macro [cycles] [backend] [step_time]: replay a cached macro (by
+    name, or by path, which loads it first); step_time is kept for later
+    replays, like the GUI's step time
+  - stop: stop the running replay
+  - status: recording/replay state, the job's macro and progress counters
+  - watch: after the answer, the connection streams progress events
+    ({"event": "replay" | "cycle" | "recording", ...}) until it is closed
+
+Macros are compiled once (see MacroCache) and replayed from their
+ReplayPlan, so starting a cached macro costs a stat() of its file and
+start_replay(). Events are queued per watcher and written by the watcher's
+own thread; the replay thread never waits on a socket, and a watcher that
+falls behind loses events (reported as `dropped`) instead.
+
+At load time this module only imports the standard library, event_log and
+replay_engine, so clients (ControlClient, `macro_cli control`) start fast;
+the server side imports macro_io, replay_plan and backends when it first
+needs them.
+"""
+import collections
+import hmac
+import ipaddress
+import json
+import os
+import queue
+import secrets
+import select
+import socket
+import socketserver
+import threading
+import time
+
+from event_log import log, metrics
+from replay_engine import IDLE
+
+
+DEFAULT_PORT = 47311  # for TCP addresses without a port and platforms without Unix sockets
+SOCKET_NAME = 'moveit-control.sock'
+TOKEN_NAME = 'moveit-control.token'
+MAX_MACROS = 32  # cached macros, least recently used are dropped first
+MAX_REQUEST = 1 << 20  # bytes per request line
+WATCH_QUEUE = 1024  # events queued per watcher before they are dropped
+HEADLESS_ACTIONS = 10000  # actions kept by a headless backend created for jobs
+CONNECT_TIMEOUT = 5.0
+
+
+class ControlError(RuntimeError):
+    """The control server refused or failed a command"""
+
+
+def default_address():
+    """A per-user socket path, or 127.0.0.1:DEFAULT_PORT without Unix sockets"""
+    if not hasattr(socket, 'AF_UNIX'):
+        return f"127.0.0.1:{DEFAULT_PORT}"
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, SOCKET_NAME)
+    return os.path.join('/tmp', f"{os.getuid()}-{SOCKET_NAME}")
+
+
+def _is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def parse_address(address):
+    """
+    (family, address) for socket(): HOST:PORT is TCP, anything else a socket
+    path. TCP hosts must be loopback addresses, the protocol isn't meant to
+    leave the machine.
+    """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and os.sep not in host:
+        host = host.strip('[]') or '127.0.0.1'
+        if not _is_loopback(host):
+            raise ValueError(f"control addresses must be on this machine (127.0.0.1, ::1): {address}")
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        return family, (host, int(port))
+    if not hasattr(socket, 'AF_UNIX'):
+        raise ValueError(f"no Unix sockets on this platform, use HOST:PORT: {address}")
+    return socket.AF_UNIX, address
+
+
+def token_path():
+    """The per-user file holding the token TCP clients authenticate with"""
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, TOKEN_NAME)
+    return os.path.join(os.path.expanduser('~'), '.' + TOKEN_NAME)
+
+
+def read_token(path=None):
+    """The token in `path` (token_path() by default); raises ControlError without one"""
+    path = path or token_path()
+    try:
+        with open(path) as f:
+            token = f.read().strip()
+    except OSError as e:
+        raise ControlError(f"can't read the control token: {e}") from None
+    if not token:
+        raise ControlError(f"the control token file is empty: {path}")
+    return token
+
+
+def _server_token(path):
+    """
+    The token in `path` if only this user can read it, otherwise a new
+    random one written there, so servers of the same user share it
+    """
+    try:
+        st = os.stat(path)
+        # Windows has no owner bits, the file is kept private by the profile's ACL
+        if not hasattr(os, 'getuid') or (st.st_uid == os.getuid() and not st.st_mode & 0o077):
+            return read_token(path)
+    except (OSError, ControlError):
+        pass
+    token = secrets.token_hex(32)
+    partial = f"{path}.{os.getpid()}"
+    try:
+        os.unlink(partial)
+    except FileNotFoundError:
+        pass
+    fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        os.write(fd, token.encode())
+    finally:
+        os.close(fd)
+    os.replace(partial, path)
+    return token
+
+
+# --- server side ---
+
+class CachedMacro:
+    """A compiled macro and the file state it was compiled from"""
+
+    def __init__(self, name, path, stamp, plan, steps, load_ms):
+        self.name = name
+        self.path = path
+        self.stamp = stamp  # (st_mtime_ns, st_size) when loaded
+        self.plan = plan
+        self.steps = steps
+        self.load_ms = load_ms
+        self.runs = 0
+
+    def info(self):
+        return {'name': self.name, 'path': self.path, 'steps': self.steps, 'instructions': len(self.plan),
+                'load_ms': self.load_ms, 'runs': self.runs}
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+class MacroCache:
+    """
+    Compiled macros by name (the path unless named otherwise). A macro file
+    is read and compiled once; binary macros are mapped just for the
+    compile. An entry is reused while its file's mtime and size are
+    unchanged, so an edited macro is picked up by the next start. With
+    `layout`, macros recorded on another screen layout are mapped to it
+    when they are compiled (see screen_layout.py).
+    """
+
+    def __init__(self, capacity=MAX_MACROS, layout=None):
+        self.capacity = capacity
+        self.layout = layout
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def names(self):
+        return list(self._entries)
+
+    def entries(self):
+        with self._lock:
+            return list(self._entries.values())
+
+    def _compile(self, name, path):
+        import macro_io
+        import replay_plan
+        started = time.perf_counter_ns()
+        stamp = _stamp(path)
+        if macro_io.is_binary(path):
+            steps = macro_io.MappedMacro(path, self.layout)
+        else:
+            steps = macro_io.load(path, self.layout)
+        try:
+            plan = replay_plan.compile_plan(steps)
+            count = len(steps)
+        finally:
+            close = getattr(steps, 'close', None)
+            if close is not None:
+                close()
+        return CachedMacro(name, path, stamp, plan, count, (time.perf_counter_ns() - started) / 1e6)
+
+    def load(self, path, name=None, force=False):
+        """Return (CachedMacro, was_cached), compiling the file if needed"""
+        path = os.path.abspath(path)
+        name = name or path
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and not force and entry.path == path and entry.stamp == _stamp(path):
+                self._entries.move_to_end(name)
+                return entry, True
+            entry = self._compile(name, path)
+            self._entries[name] = entry
+            self._entries.move_to_end(name)
+            while len(self._entries) > self.capacity:
+                dropped, _ = self._entries.popitem(last=False)
+                log.info('control', "Dropped cached macro {name}", name=dropped)
+        log.info('control', "Cached macro {name}: {steps} steps in {load_ms:.1f}ms",
+                 name=name, steps=entry.steps, load_ms=entry.load_ms)
+        return entry, False
+
+    def get(self, macro):
+        """The entry named `macro`, or the file at that path (loaded if needed)"""
+        entry = self._entries.get(macro)
+        if entry is not None:
+            return self.load(entry.path, entry.name)
+        return self.load(macro)
+
+    def remove(self, name):
+        with self._lock:
+            if self._entries.pop(name, None) is None:
+                raise KeyError(f"no cached macro {name}")
+
+
+class _Watcher:
+    """Event queue of one watching connection"""
+
+    def __init__(self):
+        self.events = queue.Queue(WATCH_QUEUE)
+        self.dropped = 0
+
+    def put(self, event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Answers request lines until the client disconnects or starts watching"""
+
+    def handle(self):
+        control = self.server.control
+        authenticated = control.token is None
+        while True:
+            line = self.rfile.readline(MAX_REQUEST + 1)
+            if not line:
+                return
+            if len(line) > MAX_REQUEST:
+                self._send({'ok': False, 'error': "request too long"})
+                return
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                cmd = request.pop('cmd')
+            except (ValueError, KeyError, AttributeError):
+                self._send({'ok': False, 'error': "expected a JSON object with a 'cmd'"})
+                continue
+            if not authenticated:
+                token = request.get('token')
+                if cmd != 'auth' or not isinstance(token, str) \
+                        or not hmac.compare_digest(token.encode(), control.token.encode()):
+                    log.warning('control', "Refused a control connection from {peer}: bad token",
+                                peer=self.client_address)
+                    self._send({'ok': False, 'error': "authentication required"})
+                    return
+                authenticated = True
+            if cmd == 'auth':
+                if not self._send({'ok': True, 'result': None}):
+                    return
+                continue
+            if cmd == 'watch':
+                self._watch(control)
+                return
+            if not self._send(control.dispatch(cmd, request)):
+                return
+
+    def _send(self, message):
+        try:
+            self.wfile.write(json.dumps(message, default=str).encode() + b'\n')
+            self.wfile.flush()
+            return True
+        except OSError:
+            return False
+
+    def _peer_closed(self):
+        """Whether the client hung up; anything it sends while watching is ignored"""
+        readable, _, _ = select.select([self.connection], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return not self.connection.recv(4096)
+        except OSError:
+            return True
+
+    def _watch(self, control):
+        watcher = control.add_watcher()
+        try:
+            if not self._send({'ok': True, 'result': control.status()}):
+                return
+            while not control.closed:
+                try:
+                    event = watcher.events.get(timeout=0.5)
+                except queue.Empty:
+                    # Without events a hang-up is only seen by looking for it
+                    if self._peer_closed():
+                        return
+                    continue
+                if watcher.dropped:
+                    event['dropped'] = watcher.dropped
+                if not self._send(event):
+                    return
+        finally:
+            control.remove_watcher(watcher)
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _TCP6Server(_TCPServer):
+    address_family = socket.AF_INET6
+
+
+class ControlServer:
+    """
+    Serves the control protocol for a clickanput module (`can`) on
+    `address` (see parse_address). start() returns once it is listening;
+    requests are handled on their own threads. On TCP, clients authenticate
+    with the token in `token_file` (token_path() by default), created if
+    needed.
+    """
+
+    def __init__(self, can, address=None, cache=None, token_file=None):
+        self.can = can
+        self.address = address or default_address()
+        self.token_file = token_file or token_path()
+        self.token = None  # required from TCP clients
+        self.cache = cache or MacroCache(layout=can.current_layout())
+        self.closed = False
+        self.current = None  # name of the macro replayed by the last job, while it runs
+        self._server = None
+        self._thread = None
+        self._watchers = ()
+        self._backends = {}
+        self._backend_lock = threading.Lock()
+        self.handlers = {
+            'ping': lambda: {'pid': os.getpid()},
+            'load': self.load,
+            'unload': self.cache.remove,
+            'macros': lambda: [entry.info() for entry in self.cache.entries()],
+            'start': self.start_job,
+            'stop': can.stop_replay,
+            'status': self.status,
+        }
+
+    # --- lifecycle ---
+
+    def start(self):
+        family, address = parse_address(self.address)
+        if family != socket.AF_UNIX:
+            self.token = _server_token(self.token_file)
+            server = (_TCP6Server if family == socket.AF_INET6 else _TCPServer)(address, _Handler)
+        else:
+            self._remove_stale_socket(address)
+            # Other users must not drive this user's input: the socket is
+            # created private instead of chmod-ed after bind(), which would
+            # leave a window where anyone can connect
+            mask = os.umask(0o077)
+            try:
+                server = _UnixServer(address, _Handler)
+            finally:
+                os.umask(mask)
+        server.control = self
+        self._server = server
+        self._thread = threading.Thread(target=server.serve_forever, name='control-server', daemon=True)
+        self._thread.start()
+        self.can.replay_engine.subscribe(self._on_replay_state)
+        self.can.subscribe_state(self._on_state)
+        log.info('control', "Control server listening on {address}", address=self.address)
+        return self
+
+    @staticmethod
+    def _remove_stale_socket(path):
+        if not os.path.exists(path):
+            return
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)  # left behind by a process that is gone
+        else:
+            raise OSError(f"a control server is already listening on {path}")
+        finally:
+            probe.close()
+
+    def close(self):
+        if self._server is None or self.closed:
+            return
+        self.closed = True
+        self.can.replay_engine.unsubscribe(self._on_replay_state)
+        self.can.unsubscribe_state(self._on_state)
+        self._server.shutdown()
+        self._server.server_close()
+        with self._backend_lock:
+            backends, self._backends = list(self._backends.values()), {}
+        if backends:
+            # Don't pull a backend from under a job that is still running
+            if self.current is not None:
+                self.can.stop_replay()
+                self.can.replay_engine.join()
+            for backend in backends:
+                backend.close()
+        family, address = parse_address(self.address)
+        if family == socket.AF_UNIX:
+            try:
+                os.unlink(address)
+            except FileNotFoundError:
+                pass
+        log.info('control', "Control server closed")
+
+    # --- commands ---
+
+    def dispatch(self, cmd, args):
+        """Run a command; returns the answer message"""
+        handler = self.handlers.get(cmd)
+        if handler is None:
+            return {'ok': False, 'error': f"unknown command: {cmd}"}
+        try:
+            return {'ok': True, 'result': handler(**args)}
+        except Exception as e:
+            log.warning('control', "{cmd} failed: {error}", cmd=cmd, error=e)
+            return {'ok': False, 'error': f"{cmd}: {type(e).__name__}: {e}"}
+
+    def load(self, path, name=None, force=False):
+        entry, cached = self.cache.load(path, name, force)
+        return dict(entry.info(), cached=cached)
+
+    def _backend(self, name):
+        """A backend shared by all jobs that ask for it by name"""
+        if name is None:
+            return None
+        with self._backend_lock:
+            backend = self._backends.get(name)
+            if backend is None:
+                import backends
+                options = {'max_actions': HEADLESS_ACTIONS} if name == backends.HeadlessBackend.name else {}
+                backend = self._backends[name] = backends.create_backend(name, **options)
+            return backend
+
+    def start_job(self, macro, cycles=None, backend=None, step_time=None):
+        entry, cached = self.cache.get(macro)
+        if not entry.steps:
+            raise ValueError(f"{entry.name} has no steps")
+        if step_time is not None:
+            if step_time < 0:
+                raise ValueError("step_time must not be negative")
+            self.can.replay_step_time = step_time
+        # Set first, so the replay's own start event names the macro
+        previous, self.current = self.current, entry.name
+        started = self.can.start_replay(backend=self._backend(backend), cycles=cycles, steps=entry.plan)
+        if started:
+            entry.runs += 1
+        else:
+            self.current = previous
+        return {'started': started, 'macro': entry.name, 'cached': cached}
+
+    def status(self):
+        can = self.can
+        return {
+            'recording': can.recording,
+            'replay': can.replay_engine.state,
+            'macro': self.current,
+            'counters': dict(metrics.counters),
+            'macros': self.cache.names(),
+            'watchers': len(self._watchers),
+        }
+
+    # --- progress events ---
+
+    def add_watcher(self):
+        watcher = _Watcher()
+        self._watchers = self._watchers + (watcher,)
+        return watcher
+
+    def remove_watcher(self, watcher):
+        self._watchers = tuple(w for w in self._watchers if w is not watcher)
+
+    def _publish(self, event):
+        event['t'] = time.time()
+        for watcher in self._watchers:
+            watcher.put(dict(event))
+
+    def _on_replay_state(self, state):
+        # Runs on the replay thread or the thread that changed the state
+        self._publish({'event': 'replay', 'state': state, 'macro': self.current})
+        if state == IDLE:
+            self.current = None
+
+    def _on_state(self, kind):
+        if kind == 'cycle':
+            counters = metrics.counters
+            self._publish({'event': 'cycle', 'cycle': counters.get('cycles', 0),
+                           'actions': counters.get('actions', 0), 'macro': self.current})
+        elif kind == 'recording':
+            self._publish({'event': 'recording', 'recording': self.can.recording})
+
+
+# --- client side ---
+
+class ControlClient:
+    """
+    Client for a ControlServer. Each method sends one command and returns
+    its result, raising ControlError when the server refuses it. TCP
+    connections authenticate with the token in `token_file`.
+    """
+
+    def __init__(self, address=None, timeout=CONNECT_TIMEOUT, token_file=None):
+        self.address = address or default_address()
+        self.timeout = timeout
+        self.token_file = token_file
+        self._sock, self._file = self._connect()
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        family, address = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(address)
+        except OSError as e:
+            sock.close()
+            raise ControlError(f"no control server on {self.address}: {e}") from None
+        file = sock.makefile('rwb')
+        if family != socket.AF_UNIX:
+            try:
+                self._exchange(file, {'cmd': 'auth', 'token': read_token(self.token_file)})
+            except ControlError:
+                file.close()
+                sock.close()
+                raise
+            except OSError as e:
+                file.close()
+                sock.close()
+                raise ControlError(f"lost the control server: {e}") from None
+        return sock, file
+
+    @staticmethod
+    def _exchange(file, message):
+        file.write(json.dumps(message).encode() + b'\n')
+        file.flush()
+        line = file.readline()
+        if not line:
+            raise ControlError("control server closed the connection")
+        answer = json.loads(line)
+        if not answer.get('ok'):
+            raise ControlError(answer.get('error', 'failed'))
+        return answer.get('result')
+
+    def call(self, cmd, **args):
+        """Run a command on the server and return its result"""
+        with self._lock:
+            try:
+                return self._exchange(self._file, dict(args, cmd=cmd))
+            except OSError as e:
+                raise ControlError(f"lost the control server: {e}") from None
+
+    def ping(self):
+        return self.call('ping')
+
+    def load(self, path, name=None, force=False):
+        # Paths are resolved here, the server may run in another directory
+        return self.call('load', path=os.path.abspath(path), name=name, force=force)
+
+    def unload(self, name):
+        return self.call('unload', name=name)
+
+    def macros(self):
+        return self.call('macros')
+
+    def start(self, macro, cycles=None, backend=None, step_time=None):
+        if os.path.exists(macro):
+            macro = os.path.abspath(macro)
+        return self.call('start', macro=macro, cycles=cycles, backend=backend, step_time=step_time)
+
+    def stop(self):
+        return self.call('stop')
+
+    def status(self):
+        return self.call('status')
+
+    def watch(self, timeout=None):
+        """
+        Yield progress events from a connection of their own, until the
+        generator is closed. The first item is the status at the time the
+        stream started. `timeout` bounds the wait for each event.
+        """
+        sock, file = self._connect()
+        sock.settimeout(timeout)
+        try:
+            yield self._exchange(file, {'cmd': 'watch'})
+            for line in file:
+                yield json.loads(line)
+        except OSError as e:
+            raise ControlError(f"lost the control server: {e}") from None
+        finally:
+            file.close()
+            sock.close()
+
+    def run(self, macro, cycles=1, backend=None, step_time=None, on_event=None, timeout=None):
+        """
+        Start a macro and wait until its replay is over, passing each
+        progress event to on_event. Returns the final status.
+        """
+        events = self.watch(timeout)
+        try:
+            next(events)  # subscribed before the start, so no event is missed
+            result = self.start(macro, cycles, backend, step_time)
+            if not result['started']:
+                raise ControlError("a replay is already running")
+            for event in events:
+                if on_event is not None:
+                    on_event(event)
+                if event['event'] == 'replay' and event['state'] == IDLE:
+                    break
+        finally:
+            events.close()
+        return self.status()
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
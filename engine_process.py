@@ -0,0 +1,643 @@
+"""
+Optional input engine process.
+
+Normally the Tk mainloop, the pynput listeners, the capture consumer and
+the replay thread share one interpreter, so a long GUI redraw holds the
+GIL while a click is being timestamped or a replay deadline passes. With
+the engine process, clickanput runs in a separate Python process and the
+GUI talks to it through an EngineProxy, which offers the part of the
+clickanput API the GUI uses:
+
+  - engine -> GUI: a SharedEventRing in shared memory. The engine pushes
+    fixed-size records for click list changes (with the step's column
+    values) and state changes (with the recording/replay/listener flags).
+    A pump thread in the GUI process drains it into a mirror ClickStore and
+    calls the subscribe_state() callbacks, like clickanput does in process.
+  - GUI -> engine: a command channel (multiprocessing.connection) for
+    requests that need an answer or carry bulk data: start/stop, edits,
+    loading a macro, snapshots, metrics.
+
+The engine process is the only owner of the click list. GUI edits are sent
+as commands and come back through the ring, so the mirror never diverges.
+After a reset (a cleared, loaded or optimized list) or when ring events
+were dropped, the pump fetches a snapshot together with the ring position
+it was taken at, and skips events older than that.
+
+The engine is started with `python engine_process.py` rather than
+multiprocessing.Process, so the child never re-imports the GUI script.
+Given a control address, the engine also runs the control server (see
+control_server.py), so jobs replay in the process that owns the input.
+"""
+import os
+import secrets
+import struct
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+from multiprocessing.connection import Client, Listener
+
+from Click import anchor_from_dict, condition_from_dict
+from screen_layout import layout_from_dict
+from ClickStore import (ClickStore, COLUMNS, FLAG_WAIT, CHANGE_APPEND, CHANGE_UPDATE, CHANGE_INSERT,
+                        CHANGE_DELETE, CHANGE_RESET)
+import event_log
+from event_log import log
+
+
+# Event kinds in the ring
+EV_STATE = 1  # state change; `state` is an index into STATE_KINDS
+EV_APPEND = 2
+EV_UPDATE = 3
+EV_INSERT = 4
+EV_DELETE = 5
+EV_RESET = 6  # the click list was cleared or replaced, fetch a snapshot
+
+# clickanput.STATE_* values, by their code in EV_STATE events
+STATE_KINDS = ('recording', 'replay', 'clicks', 'listeners', 'cycle')
+STATE_CODES = {kind: code for code, kind in enumerate(STATE_KINDS)}
+
+# State flags, sent with every event
+BIT_RECORDING = 0x01
+BIT_REPLAYING = 0x02
+BIT_PAUSED = 0x04
+BIT_KEY_LISTENER = 0x08
+BIT_MOUSE_LISTENER = 0x10
+
+# Ring header: head (next sequence to write), tail (next to read), dropped, capacity
+RING_HEADER = struct.Struct('<QQQQ')
+_U64 = struct.Struct('<Q')
+_HEAD, _TAIL, _DROPPED = 0, 8, 16
+# Event: kind, state flags, state code, pad, step index, t_ns, then the step's
+# column values in macro_io.RECORD layout
+EVENT = struct.Struct('<BBBxIQiidiiiBBH')
+_NO_ROW = (0, 0, 0.0, 0, 0, 0, 0, 0, 0)
+
+DEFAULT_CAPACITY = 8192  # events, rounded up to a power of two
+# How often the GUI side drains the ring
+PUMP_INTERVAL = 0.01
+# How long the engine gets to start and connect
+START_TIMEOUT = 10.0
+# Environment variable carrying the command channel key to the engine
+KEY_ENV = 'MOVEIT_ENGINE_KEY'
+# clickanput settings the GUI may assign
+CONFIG_NAMES = ('replay_step_time', 'record_moves', 'record_keys', 'move_tolerance', 'trace_replay',
+                'reference_window')
+# clickanput functions the GUI may call as they are
+FORWARDED = (
+    'recording_switch', 'stop_replay', 'toggle_replay', 'toggle_pause_replay',
+    'start_listeners', 'start_keyboard_listener', 'stop_keyboard_listener', 'stop_listeners',
+    'clear_clicks', 'restore_cleared_clicks', 'optimize_clicks', 'clear_button_exclusions',
+    'open_journal', 'compact_journal', 'close_journal', 'export_trace', 'metrics_snapshot', 'set_log_level',
+    'load_hotkeys', 'hotkey_bindings', 'current_layout',
+)
+
+
+class EngineError(RuntimeError):
+    """The engine process failed a command, or isn't running"""
+
+
+def _attach(name):
+    """Attach to an existing segment without this process's resource tracker owning it"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13 always tracks
+        shm = shared_memory.SharedMemory(name=name)
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class SharedEventRing:
+    """
+    Single-producer/single-consumer event ring in shared memory, between
+    two processes. Like capture.CaptureRing, each side only advances its own
+    index and the producer publishes a slot by advancing the head after
+    writing it; a full ring drops new events and counts them. Threads of
+    the producing process are serialized by `lock`.
+    Created without a name, the ring owns (and eventually unlinks) a new
+    segment; with a name it attaches to the one another process created.
+    """
+
+    def __init__(self, name=None, capacity=DEFAULT_CAPACITY):
+        self.owner = name is None
+        if self.owner:
+            size = 1
+            while size < capacity:
+                size <<= 1
+            self._shm = shared_memory.SharedMemory(create=True, size=RING_HEADER.size + size * EVENT.size)
+            RING_HEADER.pack_into(self._shm.buf, 0, 0, 0, 0, size)
+        else:
+            self._shm = _attach(name)
+        self.name = self._shm.name
+        self._buf = self._shm.buf
+        self.capacity = RING_HEADER.unpack_from(self._buf, 0)[3]
+        self._mask = self.capacity - 1
+        self.lock = threading.Lock()
+
+    def _get(self, offset):
+        return _U64.unpack_from(self._buf, offset)[0]
+
+    def _set(self, offset, value):
+        _U64.pack_into(self._buf, offset, value)
+
+    @property
+    def head(self):
+        return self._get(_HEAD)
+
+    @property
+    def dropped(self):
+        return self._get(_DROPPED)
+
+    def push(self, kind, index=0, bits=0, state=0, row=_NO_ROW, t_ns=None):
+        """Queue an event; returns its sequence number, or None if the ring was full"""
+        if t_ns is None:
+            t_ns = time.monotonic_ns()
+        with self.lock:
+            head = self._get(_HEAD)
+            if head - self._get(_TAIL) >= self.capacity:
+                self._set(_DROPPED, self._get(_DROPPED) + 1)
+                return None
+            EVENT.pack_into(self._buf, RING_HEADER.size + (head & self._mask) * EVENT.size,
+                            kind, bits, state, index, t_ns, *row)
+            self._set(_HEAD, head + 1)
+            return head
+
+    def drain(self, max_events=None):
+        """
+        Remove and return queued events as (seq, kind, bits, state, index,
+        t_ns, row) tuples; called from the consumer only.
+        """
+        tail = self._get(_TAIL)
+        head = self._get(_HEAD)
+        if max_events is not None:
+            head = min(head, tail + max_events)
+        events = []
+        for seq in range(tail, head):
+            kind, bits, state, index, t_ns, *row = EVENT.unpack_from(
+                self._buf, RING_HEADER.size + (seq & self._mask) * EVENT.size)
+            events.append((seq, kind, bits, state, index, t_ns, tuple(row)))
+        self._set(_TAIL, head)
+        return events
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+        if self.owner:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+# --- engine side ---
+
+class _Publisher:
+    """Pushes clickanput's state and click list changes into the ring"""
+
+    def __init__(self, ring, can):
+        self.ring = ring
+        self.can = can
+        self.store = None
+        self._watch(can.click_positions)
+        can.subscribe_state(self.on_state)
+
+    def bits(self):
+        can = self.can
+        bits = 0
+        if can.recording:
+            bits |= BIT_RECORDING
+        if can.replay_engine.is_running:
+            bits |= BIT_REPLAYING
+        if can.replay_engine.is_paused:
+            bits |= BIT_PAUSED
+        if can.key_listener is not None and can.key_listener.running:
+            bits |= BIT_KEY_LISTENER
+        if can.mouse_listener is not None and can.mouse_listener.running:
+            bits |= BIT_MOUSE_LISTENER
+        return bits
+
+    def _watch(self, store):
+        if self.store is not None:
+            self.store.unsubscribe(self.on_change)
+        self.store = store
+        store.subscribe(self.on_change)
+
+    def on_state(self, kind):
+        if kind == 'clicks':
+            # Row changes arrive through on_change; only a new list matters here
+            if self.can.click_positions is not self.store:
+                self._watch(self.can.click_positions)
+                self.ring.push(EV_RESET, bits=self.bits())
+            return
+        self.ring.push(EV_STATE, bits=self.bits(), state=STATE_CODES.get(kind, 0))
+
+    def on_change(self, kind, index):
+        if kind == CHANGE_RESET:
+            self.ring.push(EV_RESET, bits=self.bits())
+        elif kind == CHANGE_DELETE:
+            self.ring.push(EV_DELETE, index, bits=self.bits())
+        else:
+            store = self.store
+            row = tuple(getattr(store, name)[index] for name, _ in COLUMNS)
+            event = {CHANGE_APPEND: EV_APPEND, CHANGE_UPDATE: EV_UPDATE, CHANGE_INSERT: EV_INSERT}[kind]
+            self.ring.push(event, index, bits=self.bits(), row=row)
+
+    def layout(self):
+        layout = self.store.layout
+        return layout.to_dict() if layout is not None else None
+
+    def snapshot(self):
+        """(sequence, step dicts, layout dict): the click list as of that ring position"""
+        store = self.store
+        # A change and the event it pushes happen under the store's lock, so
+        # the snapshot holds exactly the changes published before `head`
+        with store.lock, self.ring.lock:
+            return self.ring.head, store.to_dicts(), self.layout()
+
+
+def _steps(dicts, layout=None):
+    """A ClickStore from step dicts and a ScreenLayout.to_dict() (or None)"""
+    store = ClickStore.from_dicts(dicts)
+    store.layout = layout_from_dict(layout)
+    return store
+
+
+def _step(data):
+    """A step from its Click.to_dict() form, for clickanput calls taking a click"""
+    return ClickStore.from_dicts([data])[0]
+
+
+def serve(ring_name, address, authkey, control_address=None):
+    """
+    Run the engine: apply commands from the GUI, publish events into the ring.
+    With control_address, also serve control_server requests there.
+    """
+    import backends
+    import clickanput as can
+
+    ring = SharedEventRing(ring_name)
+    conn = Client(address, authkey=authkey)
+    publisher = _Publisher(ring, can)
+    control = None
+    if control_address:
+        import control_server
+        try:
+            control = control_server.ControlServer(can, control_address).start()
+        except (OSError, ValueError) as e:
+            log.error('control', "Control server not started: {error}", error=e)
+
+    # One backend per name for the engine's lifetime, closed on the way out
+    pool = backends.BackendPool()
+    backend = pool.get
+
+    def put_step(index, data):
+        can.click_positions[index] = _step(data)
+        can.step_edited(index)
+
+    def configure(**settings):
+        for name, value in settings.items():
+            if name not in CONFIG_NAMES:
+                raise ValueError(f"not a setting: {name}")
+            setattr(can, name, value)
+
+    handlers = {name: getattr(can, name) for name in FORWARDED}
+    handlers.update(
+        hello=lambda: {'bits': publisher.bits(), 'pid': os.getpid(),
+                       'config': {name: getattr(can, name) for name in CONFIG_NAMES}},
+        configure=configure,
+        start_replay=lambda backend_name=None, cycles=None: can.start_replay(backend(backend_name), cycles),
+        anchor_step=lambda index, backend_name=None: can.anchor_step(index, backend(backend_name)),
+        add_wait_step=lambda index, kind, backend_name=None: can.add_wait_step(index, kind, backend(backend_name)),
+        add_step=lambda data: can.add_step(_step(data)),
+        put_step=put_step,
+        set_steps=lambda dicts, layout=None: can.set_click_positions(_steps(dicts, layout)),
+        snapshot=publisher.snapshot,
+        tables=lambda: ({code: a.to_dict() for code, a in publisher.store.anchors.items()},
+                        {code: c.to_dict() for code, c in publisher.store.conditions.items()},
+                        publisher.layout()),
+        set_exclusion=can.set_exclusion,
+        remove_exclusion=can.remove_exclusion,
+    )
+
+    log.info('engine', "Input engine running (pid {pid})", pid=os.getpid())
+    try:
+        while True:
+            try:
+                name, args, kwargs = conn.recv()
+            except (EOFError, OSError):
+                break
+            if name == 'quit':
+                conn.send((True, None))
+                break
+            try:
+                conn.send((True, handlers[name](*args, **kwargs)))
+            except Exception as e:
+                conn.send((False, f"{name}: {type(e).__name__}: {e}"))
+    finally:
+        if control is not None:
+            control.close()
+        can.stop_replay()
+        can.replay_engine.join()
+        pool.close()
+        can.stop_listeners()
+        can.close_journal()
+        log.flush()
+        conn.close()
+        ring.close()
+
+
+# --- GUI side ---
+
+class RemoteReplayState:
+    """replay_engine as seen from the GUI: the flags of the last event"""
+    is_running = False
+    is_paused = False
+
+
+class RemoteListener:
+    """A listener as seen from the GUI"""
+    running = False
+
+
+class EngineProxy:
+    """
+    Runs clickanput in an engine process and stands in for the module in
+    the GUI: click_positions is a mirror kept current by a pump thread, the
+    recording/replay/listener state comes with the ring events, and calls
+    are sent over the command channel. Settings in CONFIG_NAMES are
+    forwarded when assigned. With control_address, the engine also runs
+    a control server there.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, control_address=None):
+        self._started = False
+        self.click_positions = ClickStore()
+        self.recording = False
+        self.replay_engine = RemoteReplayState()
+        self.key_listener = RemoteListener()
+        self.mouse_listener = RemoteListener()
+        self.button_exclusions = set()  # keys; the areas themselves live in the engine
+        self.replay_step_time = 0.1
+        self.record_moves = False
+        self.record_keys = False
+        self.move_tolerance = 0.0
+        self.trace_replay = False
+        self.reference_window = None
+        self.process = None
+        self._capacity = capacity
+        self._control_address = control_address
+        self._ring = None
+        self._conn = None
+        self._conn_lock = threading.Lock()
+        self._state_listeners = ()
+        self._metrics = {'counters': {}, 'histograms': {}}
+        self._skip_below = 0  # ring events older than the last snapshot
+        self._dropped = 0
+        self._pump = None
+        self._stop = threading.Event()
+        self._backend = None
+
+    def __setattr__(self, name, value):
+        if name in CONFIG_NAMES and self.__dict__.get('_started'):
+            self.call('configure', **{name: value})
+        object.__setattr__(self, name, value)
+
+    def __getattr__(self, name):
+        # Only reached for names not set in __init__
+        if name in FORWARDED:
+            return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+        raise AttributeError(name)
+
+    # --- process lifecycle ---
+
+    def start(self):
+        """Start the engine process and the pump; raises EngineError if it doesn't come up"""
+        authkey = secrets.token_bytes(32)
+        self._ring = SharedEventRing(capacity=self._capacity)
+        listener = Listener(authkey=authkey)
+        env = dict(os.environ, **{KEY_ENV: authkey.hex()})
+        script = os.path.abspath(__file__)
+        args = [sys.executable, script, self._ring.name, str(listener.address)]
+        if self._control_address:
+            args.append(self._control_address)
+        self.process = subprocess.Popen(args, env=env)
+
+        accepted = []
+        acceptor = threading.Thread(target=lambda: accepted.append(listener.accept()), daemon=True)
+        acceptor.start()
+        acceptor.join(START_TIMEOUT)
+        listener.close()
+        if not accepted:
+            self.process.kill()
+            self._ring.close()
+            raise EngineError("input engine process didn't connect")
+        self._conn = accepted[0]
+
+        hello = self.call('hello')
+        for name, value in hello['config'].items():
+            object.__setattr__(self, name, value)
+        self._apply_bits(hello['bits'])
+        self._resync()
+        self._started = True
+        self._pump = threading.Thread(target=self._run_pump, name='engine-pump', daemon=True)
+        self._pump.start()
+        log.info('engine', "Input engine started in process {pid}", pid=hello['pid'])
+        return self
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def close(self, timeout=5.0):
+        """Stop the engine process (stopping replay and listeners there) and the pump"""
+        if self.process is None:
+            return
+        self._stop.set()
+        if self.alive:
+            try:
+                self.call('quit')
+            except EngineError:
+                pass
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self._pump is not None and self._pump is not threading.current_thread():
+            self._pump.join(timeout)
+        self._conn.close()
+        self._ring.close()
+        self.process = None
+
+    def call(self, name, *args, **kwargs):
+        """Run a command in the engine and return its result"""
+        with self._conn_lock:
+            if self._conn is None or not self.alive:
+                raise EngineError("input engine is not running")
+            try:
+                self._conn.send((name, args, kwargs))
+                ok, result = self._conn.recv()
+            except (EOFError, OSError) as e:
+                raise EngineError(f"lost the input engine: {e}") from None
+        if not ok:
+            raise EngineError(result)
+        return result
+
+    # --- events ---
+
+    def _apply_bits(self, bits):
+        self.recording = bool(bits & BIT_RECORDING)
+        self.replay_engine.is_running = bool(bits & BIT_REPLAYING)
+        self.replay_engine.is_paused = bool(bits & BIT_PAUSED)
+        self.key_listener.running = bool(bits & BIT_KEY_LISTENER)
+        self.mouse_listener.running = bool(bits & BIT_MOUSE_LISTENER)
+
+    def _resync(self):
+        """Replace the mirror with a snapshot of the engine's click list"""
+        self._skip_below, dicts, layout = self.call('snapshot')
+        self.click_positions = _steps(dicts, layout)
+
+    def _fetch_tables(self, store):
+        anchors, conditions, layout = self.call('tables')
+        store.layout = layout_from_dict(layout)
+        for code, data in anchors.items():
+            if code not in store.anchors:
+                store.put_anchor(code, anchor_from_dict(data))
+        for code, data in conditions.items():
+            if code not in store.conditions:
+                store.put_condition(code, condition_from_dict(data))
+
+    def _apply_row(self, kind, index, row):
+        store = self.click_positions
+        anchor, flags, amount = row[8], row[6], row[5]
+        # The first step of a recording also brings the layout it was recorded on
+        if ((anchor and anchor not in store.anchors) or (flags & FLAG_WAIT and amount not in store.conditions)
+                or (kind == EV_APPEND and not len(store))):
+            self._fetch_tables(store)
+        if kind == EV_APPEND:
+            for (name, _), value in zip(COLUMNS, row):
+                getattr(store, name).append(value)
+            store.notify(CHANGE_APPEND, len(store) - 1)
+        elif kind == EV_INSERT:
+            for (name, _), value in zip(COLUMNS, row):
+                getattr(store, name).insert(index, value)
+            store.notify(CHANGE_INSERT, index)
+        else:
+            for (name, _), value in zip(COLUMNS, row):
+                getattr(store, name)[index] = value
+            store.notify(CHANGE_UPDATE, index)
+
+    def pump(self):
+        """Apply queued engine events; returns the state kinds to report"""
+        events = self._ring.drain()
+        kinds = []
+        dropped = self._ring.dropped
+        if dropped != self._dropped:
+            self._dropped = dropped
+            log.warning('engine', "Engine events were dropped, resyncing", dropped=dropped)
+            self._resync()
+            kinds.append('clicks')
+        for seq, kind, bits, state, index, t_ns, row in events:
+            if seq < self._skip_below:
+                continue
+            self._apply_bits(bits)
+            if kind == EV_STATE:
+                state_kind = STATE_KINDS[state]
+                if state_kind in ('cycle', 'replay'):
+                    self._metrics = self.call('metrics_snapshot')
+                kinds.append(state_kind)
+            elif kind == EV_RESET:
+                self._resync()
+                kinds.append('clicks')
+            elif kind == EV_DELETE:
+                del self.click_positions[index]
+                kinds.append('clicks')
+            else:
+                self._apply_row(kind, index, row)
+                kinds.append('clicks')
+        return kinds
+
+    def _run_pump(self):
+        while not self._stop.wait(PUMP_INTERVAL):
+            try:
+                kinds = self.pump()
+            except EngineError as e:
+                if not self._stop.is_set():
+                    log.error('engine', "Input engine stopped: {error}", error=e)
+                    self._apply_bits(0)
+                    self.notify_state('listeners')
+                return
+            # One callback per kind and batch, like a burst of in-process events
+            for kind in dict.fromkeys(kinds):
+                self.notify_state(kind)
+
+    # --- the clickanput API used by the GUI ---
+
+    def subscribe_state(self, callback):
+        self._state_listeners = self._state_listeners + (callback,)
+
+    def unsubscribe_state(self, callback):
+        self._state_listeners = tuple(c for c in self._state_listeners if c != callback)
+
+    def notify_state(self, kind):
+        for callback in self._state_listeners:
+            callback(kind)
+
+    def get_input_backend(self):
+        """A local pyautogui backend, for the pointer position and the backend name"""
+        if self._backend is None:
+            import backends
+            self._backend = backends.PyAutoGuiBackend()
+        return self._backend
+
+    def start_replay(self, backend=None, cycles=None, steps=None):
+        if steps is not None:
+            raise EngineError("the engine process only replays its own click list")
+        return self.call('start_replay', backend.name if backend is not None else None, cycles)
+
+    def anchor_step(self, index, backend=None):
+        return self.call('anchor_step', index, backend.name if backend is not None else None)
+
+    def add_wait_step(self, index, kind, backend=None):
+        return self.call('add_wait_step', index, kind, backend.name if backend is not None else None)
+
+    def add_step(self, click):
+        self.call('add_step', ClickStore.from_clicks([click]).row_dict(0))
+
+    def step_edited(self, index):
+        """Send a step edited in the mirror to the engine"""
+        self.call('put_step', index, self.click_positions.row_dict(index))
+
+    def set_click_positions(self, steps):
+        layout = steps.layout.to_dict() if steps.layout is not None else None
+        self.call('set_steps', steps.to_dicts(), layout)
+
+    def set_exclusion(self, key, x, y, width, height):
+        self.call('set_exclusion', key, x, y, width, height)
+        self.button_exclusions.add(key)
+
+    def remove_exclusion(self, key):
+        self.call('remove_exclusion', key)
+        self.button_exclusions.discard(key)
+
+    def exclusion_keys(self):
+        return list(self.button_exclusions)
+
+    def metrics_snapshot(self):
+        """Replay metrics of the engine, as of the last cycle or replay state change"""
+        return self._metrics
+
+    def set_log_level(self, level):
+        event_log.set_level(level)
+        self.call('set_log_level', level)
+
+
+def main(argv):
+    ring_name, address, *control_address = argv
+    serve(ring_name, address, bytes.fromhex(os.environ.pop(KEY_ENV)), *control_address)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
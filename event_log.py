@@ -0,0 +1,265 @@
+"""
+Structured event log and metrics.
+
+log() only checks the level and appends a tuple to a bounded ring; the
+message is formatted and written by a background writer thread, so the
+replay and capture threads never wait on the console. Events below the
+log level cost a function call and a comparison, which lets the per-action
+events of the replay loop stay in place at DEBUG. If the writer falls
+behind, the oldest events are dropped (and counted) instead of growing the
+ring.
+
+The writer keeps the most recent records in `history` for tail(), and can
+write text lines (the default, like the old prints) or JSON lines.
+
+Metrics are counters and log-bucketed latency histograms, recorded
+directly by the threads doing the work. Updates aren't locked: a rare lost
+increment under contention is an accepted trade for keeping them cheap.
+snapshot() returns everything as plain data for the GUI status area and
+the command line.
+"""
+import atexit
+import json
+import sys
+import threading
+import time
+from collections import deque
+
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+LEVELS = {name: level for level, name in LEVEL_NAMES.items()}
+
+DEFAULT_CAPACITY = 8192  # queued events before the oldest are dropped
+HISTORY = 500  # written records kept for tail()
+WRITE_INTERVAL = 0.05  # how often the writer drains the ring, seconds
+
+
+def parse_level(value):
+    """A level from its name ('debug', 'INFO', ...) or number"""
+    if isinstance(value, int):
+        return value
+    try:
+        return LEVELS[str(value).upper()]
+    except KeyError:
+        raise ValueError(f"unknown log level: {value}") from None
+
+
+class EventLog:
+    """
+    Levelled events, written by a background thread.
+    Each event has a name (e.g. 'click'), a message template formatted with
+    its fields, and the fields themselves, which structured sinks keep.
+    `stream` defaults to whatever sys.stdout is when the writer runs.
+    """
+
+    def __init__(self, level=INFO, capacity=DEFAULT_CAPACITY, stream=None, json_lines=False,
+                 history=HISTORY, interval=WRITE_INTERVAL):
+        self.level = level
+        self.stream = stream
+        self.json_lines = json_lines
+        self.interval = interval
+        self.history = deque(maxlen=history)
+        self.dropped = 0  # events lost because the ring was full
+        self._ring = deque(maxlen=capacity)
+        self._wake = threading.Event()
+        self._write_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._writer = None
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, event, message, **fields):
+        if level < self.level:
+            return
+        ring = self._ring
+        if len(ring) == ring.maxlen:
+            self.dropped += 1
+        ring.append((time.time(), level, event, message, fields))
+        if self._writer is None:
+            self._start()
+        if level >= WARNING:
+            self._wake.set()
+
+    def debug(self, event, message, **fields):
+        self.log(DEBUG, event, message, **fields)
+
+    def info(self, event, message, **fields):
+        self.log(INFO, event, message, **fields)
+
+    def warning(self, event, message, **fields):
+        self.log(WARNING, event, message, **fields)
+
+    def error(self, event, message, **fields):
+        self.log(ERROR, event, message, **fields)
+
+    # --- writing ---
+
+    def _start(self):
+        with self._start_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name='event-log-writer')
+                self._writer.daemon = True
+                self._writer.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write every queued event now; safe to call from any thread"""
+        ring = self._ring
+        if not ring:
+            return
+        with self._write_lock:
+            lines = []
+            while ring:
+                try:
+                    t, level, event, message, fields = ring.popleft()
+                except IndexError:
+                    break
+                try:
+                    text = message.format(**fields) if fields else message
+                except (KeyError, IndexError, ValueError):
+                    text = message
+                record = {'time': t, 'level': LEVEL_NAMES.get(level, level), 'event': event, 'message': text}
+                record.update(fields)
+                self.history.append(record)
+                lines.append(json.dumps(record, default=str) if self.json_lines else text)
+            if lines:
+                stream = self.stream or sys.stdout
+                try:
+                    stream.write('\n'.join(lines) + '\n')
+                    stream.flush()
+                except (OSError, ValueError, AttributeError):
+                    # No console (pythonw) or it was closed; history still has them
+                    pass
+
+    def tail(self, count=20, level=DEBUG):
+        """The most recent written records at `level` or above, oldest first"""
+        name_level = LEVELS.get
+        records = [r for r in self.history if name_level(r['level'], 0) >= level]
+        return records[-count:]
+
+
+class Histogram:
+    """
+    Latency histogram in nanoseconds. Values are counted in log buckets with
+    8 sub-buckets per power of two (about 12% resolution), so recording is
+    O(1) and memory is fixed however many values come in.
+    """
+    SUB_BITS = 3
+    _LINEAR = 1 << (SUB_BITS + 1)  # values below this get a bucket each
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.buckets = [0] * (64 << self.SUB_BITS)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value_ns):
+        value = int(value_ns) if value_ns > 0 else 0
+        if value < self._LINEAR:
+            index = value
+        else:
+            shift = value.bit_length() - self.SUB_BITS - 1
+            index = (shift << self.SUB_BITS) + (value >> shift)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def _bucket_value(self, index):
+        if index < self._LINEAR:
+            return index
+        shift = (index >> self.SUB_BITS) - 1
+        mantissa = index - (shift << self.SUB_BITS)
+        # Middle of the bucket
+        return (mantissa << shift) + ((1 << shift) >> 1)
+
+    def percentile(self, fraction):
+        """Approximate value (ns) at a fraction (0..1) of the recorded values"""
+        if not self.count:
+            return 0
+        rank = max(1, int(fraction * self.count + 0.5))
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(self._bucket_value(index), self.max)
+        return self.max
+
+    def summary(self):
+        """count, mean/p50/p99/max in milliseconds"""
+        return {
+            'count': self.count,
+            'mean_ms': (self.total / self.count / 1e6) if self.count else 0.0,
+            'p50_ms': self.percentile(0.50) / 1e6,
+            'p99_ms': self.percentile(0.99) / 1e6,
+            'max_ms': self.max / 1e6,
+        }
+
+
+class Metrics:
+    """Named counters and histograms"""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def incr(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def histogram(self, name):
+        """The histogram called name, created on first use"""
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def reset(self):
+        self.counters.clear()
+        for histogram in list(self.histograms.values()):
+            histogram.reset()
+
+    def snapshot(self):
+        return {
+            'counters': dict(self.counters),
+            'histograms': {name: h.summary() for name, h in list(self.histograms.items()) if h.count},
+        }
+
+
+def format_metrics(snapshot):
+    """Human readable lines for a Metrics.snapshot()"""
+    lines = [f"{name}: {value}" for name, value in sorted(snapshot['counters'].items())]
+    for name, summary in sorted(snapshot['histograms'].items()):
+        lines.append(f"{name}: n={summary['count']} p50={summary['p50_ms']:.3f}ms "
+                     f"p99={summary['p99_ms']:.3f}ms max={summary['max_ms']:.3f}ms")
+    return lines
+
+
+# The application's log and metrics
+log = EventLog()
+metrics = Metrics()
+
+debug = log.debug
+info = log.info
+warning = log.warning
+error = log.error
+
+
+def set_level(level):
+    log.level = parse_level(level)
+
+
+atexit.register(log.flush)
@@ -0,0 +1,90 @@
+"""
+Spatial index for recording exclusion zones.
+
+Rectangles are bucketed into a uniform grid of CELL_SIZE pixel cells, so a
+hit test only looks at the few rectangles overlapping the clicked cell
+instead of scanning all of them. Every rectangle has a key (e.g. the Tk
+widget name), so a moved widget only updates its own cells.
+
+Hit tests run on the capture consumer thread (see capture.py) while
+updates come from the Tk thread (or the input engine's command thread):
+cells are immutable tuples that are swapped in whole, so a hit test never
+sees a half-updated cell.
+"""
+
+
+CELL_SIZE = 128
+
+
+class ExclusionIndex:
+    """Keyed rectangles (x, y, width, height) with fast point hit tests"""
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self._rects = {}  # key -> (x, y, width, height)
+        self._cells = {}  # (cell_x, cell_y) -> tuple of (key, x1, y1, x2, y2)
+
+    def __len__(self):
+        return len(self._rects)
+
+    def __contains__(self, key):
+        return key in self._rects
+
+    def __iter__(self):
+        """Iterate the rectangles as (x, y, width, height)"""
+        return iter(list(self._rects.values()))
+
+    def keys(self):
+        return list(self._rects)
+
+    def get(self, key):
+        return self._rects.get(key)
+
+    def _cell_range(self, rect):
+        x, y, w, h = rect
+        cs = self.cell_size
+        for cx in range(int(x) // cs, int(x + w) // cs + 1):
+            for cy in range(int(y) // cs, int(y + h) // cs + 1):
+                yield cx, cy
+
+    def _unlink(self, key, rect):
+        for cell in self._cell_range(rect):
+            entries = tuple(e for e in self._cells.get(cell, ()) if e[0] != key)
+            if entries:
+                self._cells[cell] = entries
+            else:
+                self._cells.pop(cell, None)
+
+    def set(self, key, x, y, width, height):
+        """
+        Add or move the rectangle for key. Returns False (and does nothing)
+        if the rectangle didn't change.
+        """
+        rect = (x, y, width, height)
+        old = self._rects.get(key)
+        if old == rect:
+            return False
+        if old is not None:
+            self._unlink(key, old)
+        entry = (key, x, y, x + width, y + height)
+        for cell in self._cell_range(rect):
+            self._cells[cell] = self._cells.get(cell, ()) + (entry,)
+        self._rects[key] = rect
+        return True
+
+    def remove(self, key):
+        rect = self._rects.pop(key, None)
+        if rect is not None:
+            self._unlink(key, rect)
+
+    def clear(self):
+        self._rects = {}
+        self._cells = {}
+
+    def hit(self, x, y):
+        """Return the key of a rectangle containing (x, y) (edges included), or None"""
+        cs = self.cell_size
+        for key, x1, y1, x2, y2 in self._cells.get((int(x) // cs, int(y) // cs), ()):
+            if x1 <= x <= x2 and y1 <= y <= y2:
+                return key
+        return None
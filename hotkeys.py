@@ -0,0 +1,190 @@
+"""
+Hotkey registry.
+
+Bindings map a key chord to an action name. A chord is a key, optionally
+with modifiers: "d", "Q", "ctrl+alt+r", "shift+f9". They are loaded from
+HOTKEYS_FILE, a JSON object like {"ctrl+alt+r": "toggle_recording"}; without
+the file, DEFAULT_BINDINGS apply. The defaults are modifier chords, so typing
+in other applications (or into a recording) doesn't trigger them. The old
+single-key hotkeys ("d", "y", "c", "q", "Q") are only bound if a hotkeys
+file binds them.
+
+The keyboard listener calls on_press()/on_release() for every key pressed
+anywhere on the system, so the common case is kept short: modifiers only
+update a bit mask, and a key that ends no binding is rejected with one set
+lookup. Bound chords are found in a dict keyed by (modifier mask, key)
+built when the bindings are loaded. Actions don't run on the listener
+thread: HotkeyDispatcher queues them for a thread of its own, so the OS
+hook returns right away.
+
+For printable keys the character already says whether Shift was held
+("Q" vs "q"), so Shift only counts as a modifier for named keys (f9, enter,
+...). Named keys use pynput's names; keys.SPECIAL_KEYS names are accepted
+in the file too.
+"""
+import json
+import queue
+import threading
+
+from keys import PYNPUT_NAMES
+from event_log import log
+
+
+HOTKEYS_FILE = 'hotkeys.json'
+
+# Actions a chord can be bound to, with their description for the GUI
+ACTIONS = {
+    'toggle_recording': "toggle recording",
+    'stop_recording': "stop recording",
+    'toggle_replay': "toggle replay",
+    'pause_replay': "pause/resume replay",
+    'clear': "clear",
+    'exit': "exit",
+}
+DEFAULT_BINDINGS = {
+    'ctrl+alt+r': 'toggle_recording',
+    'ctrl+alt+y': 'toggle_replay',
+    'ctrl+alt+c': 'clear',
+    'ctrl+alt+s': 'stop_recording',
+    'ctrl+alt+shift+q': 'exit',
+}
+
+MOD_CTRL = 0x1
+MOD_ALT = 0x2
+MOD_SHIFT = 0x4
+MOD_CMD = 0x8
+# Modifier names in chords
+MODIFIERS = {'ctrl': MOD_CTRL, 'control': MOD_CTRL, 'alt': MOD_ALT, 'shift': MOD_SHIFT,
+             'cmd': MOD_CMD, 'super': MOD_CMD, 'win': MOD_CMD}
+MODIFIER_ORDER = ((MOD_CTRL, 'ctrl'), (MOD_ALT, 'alt'), (MOD_SHIFT, 'shift'), (MOD_CMD, 'cmd'))
+# pynput's modifier key names
+MODIFIER_KEYS = {
+    'ctrl': MOD_CTRL, 'ctrl_l': MOD_CTRL, 'ctrl_r': MOD_CTRL,
+    'alt': MOD_ALT, 'alt_l': MOD_ALT, 'alt_r': MOD_ALT, 'alt_gr': MOD_ALT,
+    'shift': MOD_SHIFT, 'shift_l': MOD_SHIFT, 'shift_r': MOD_SHIFT,
+    'cmd': MOD_CMD, 'cmd_l': MOD_CMD, 'cmd_r': MOD_CMD,
+}
+# keys.py names -> pynput names
+_PYNPUT_KEY_NAMES = {ours: theirs for theirs, ours in PYNPUT_NAMES.items()}
+
+
+def parse_chord(chord):
+    """(modifier mask, key) of a chord like "ctrl+alt+r"; raises ValueError"""
+    *modifiers, key = chord.split('+')
+    mask = 0
+    for name in modifiers:
+        bit = MODIFIERS.get(name.strip().lower())
+        if bit is None:
+            raise ValueError(f"unknown modifier {name!r} in hotkey {chord!r}")
+        mask |= bit
+    if len(key) > 1:
+        key = key.strip()
+    if not key:
+        raise ValueError(f"hotkey {chord!r} has no key")
+    if len(key) == 1:
+        if mask & MOD_SHIFT:
+            key = key.upper()
+        return mask & ~MOD_SHIFT, key
+    key = key.lower()
+    return mask, _PYNPUT_KEY_NAMES.get(key, key)
+
+
+def format_chord(mask, key):
+    """The chord text of (modifier mask, key)"""
+    return '+'.join([name for bit, name in MODIFIER_ORDER if mask & bit] + [key])
+
+
+def load_bindings(path=HOTKEYS_FILE):
+    """The bindings in a hotkeys file, or DEFAULT_BINDINGS if there is none"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            bindings = json.load(f)
+    except FileNotFoundError:
+        return dict(DEFAULT_BINDINGS)
+    if not isinstance(bindings, dict):
+        raise ValueError(f"{path}: expected an object of chord -> action")
+    return bindings
+
+
+class HotkeyRegistry:
+    """
+    Lookup table of bound chords, and the modifiers currently held.
+    on_press() returns the action bound to a key press, or None.
+    """
+
+    def __init__(self, bindings=None):
+        self.held = 0  # MOD_* bits of the modifiers held down
+        self.bind_all(DEFAULT_BINDINGS if bindings is None else bindings)
+
+    def bind_all(self, bindings):
+        """Replace every binding; raises ValueError for bad chords or actions"""
+        table = {}
+        for chord, action in bindings.items():
+            if action not in ACTIONS:
+                raise ValueError(f"unknown action {action!r} for hotkey {chord!r}")
+            combo = parse_chord(chord)
+            if combo in table and table[combo] != action:
+                raise ValueError(f"hotkey {chord!r} is bound twice")
+            table[combo] = action
+        # Swapped in whole, the listener thread never sees a half-built table
+        self._table = table
+        self._final_keys = frozenset(key for _, key in table)
+
+    def bindings(self):
+        """(chord, action) pairs, in binding order"""
+        return [(format_chord(mask, key), action) for (mask, key), action in self._table.items()]
+
+    def on_press(self, key):
+        """Called from the listener for every key press"""
+        char = getattr(key, 'char', None)
+        if char is None:
+            name = getattr(key, 'name', None)
+            bit = MODIFIER_KEYS.get(name)
+            if bit is not None:
+                self.held |= bit
+                return None
+            if name not in self._final_keys:
+                return None
+            return self._table.get((self.held, name))
+        if char < ' ' and self.held & MOD_CTRL:
+            # Ctrl+letter arrives as a control character on some platforms,
+            # the same for both cases; Shift picks the case
+            char = chr(ord(char) + (0x40 if self.held & MOD_SHIFT else 0x60))
+        if char not in self._final_keys:
+            return None
+        return self._table.get((self.held & ~MOD_SHIFT, char))
+
+    def on_release(self, key):
+        bit = MODIFIER_KEYS.get(getattr(key, 'name', None))
+        if bit is not None:
+            self.held &= ~bit
+
+
+class HotkeyDispatcher:
+    """
+    Runs actions on a dispatch thread, in the order they were submitted.
+    `handlers` maps action names to callables; the thread starts with the
+    first submit().
+    """
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, action):
+        self._queue.put(action)
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='hotkey-dispatch', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            action = self._queue.get()
+            try:
+                self.handlers[action]()
+            except Exception as e:
+                log.error('hotkey', "Hotkey action {action} failed: {error}", action=action, error=e)
@@ -0,0 +1,313 @@
+"""
+Append-only recording journal.
+
+While recording, every change to the click list is appended to a small
+on-disk journal, so a crash (or an accidental clear) doesn't lose the
+recording. Appends only write to a buffered file; a background thread
+flushes and fsyncs in batches, so the cost per event stays constant no
+matter how long the recording gets.
+
+Journal layout: a header (magic b'MVJL', u16 version) followed by entries,
+each starting with an opcode byte:
+    APPEND      + macro_io.RECORD           a new step at the end
+    SET         + u32 index + RECORD        a step replaced in place
+    DOUBLE_LAST                             last step became a double click
+    BASE        + u16 length + utf-8 path   start from this macro file
+    ANCHOR      + u16 id + Anchor.pack()    an anchor used by later steps
+    CONDITION   + u32 id + WaitCondition.pack()  a wait condition used by later steps
+    INSERT      + u32 index + RECORD        a new step before index
+    LAYOUT      + ScreenLayout.pack()       the screen layout of the steps; after a BASE
+                                            recorded on another layout, maps the base to it
+A truncated last entry (torn write) is ignored on recovery.
+"""
+import os
+import struct
+import threading
+
+import macro_io
+from ClickStore import ClickStore, COLUMNS, FLAG_DOUBLE, FLAG_WAIT
+from anchors import Anchor
+from event_log import log
+from screen_wait import WaitCondition, CONDITION
+from screen_layout import ScreenLayout
+
+
+JOURNAL_FILE = 'recording.journal'
+# Where the journal goes when the click list is cleared, so it can be restored
+PREVIOUS_SUFFIX = '.prev'
+
+MAGIC = b'MVJL'
+VERSION = 1
+HEADER = struct.Struct('<4sH')
+
+OP_APPEND = 1
+OP_SET = 2
+OP_DOUBLE_LAST = 3
+OP_BASE = 4
+OP_ANCHOR = 5
+OP_CONDITION = 6
+OP_INSERT = 7
+OP_LAYOUT = 8
+
+_OP = struct.Struct('<B')
+_APPEND = struct.Struct('<B' + macro_io.RECORD.format[1:])
+_SET = struct.Struct('<BI' + macro_io.RECORD.format[1:])
+_PATH_LENGTH = struct.Struct('<H')
+_ANCHOR_ID = struct.Struct('<BH')
+_CONDITION_ID = struct.Struct('<BI')
+
+# Batch fsyncs: at most every FSYNC_INTERVAL seconds, sooner after FSYNC_BATCH entries
+FSYNC_INTERVAL = 0.5
+FSYNC_BATCH = 256
+
+
+class RecordingJournal:
+    """Appends click list changes to a journal file with batched fsyncs"""
+
+    def __init__(self, path=JOURNAL_FILE, fsync_interval=FSYNC_INTERVAL, fsync_batch=FSYNC_BATCH):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._file = None
+        self._anchors_written = set()  # anchor ids already in this journal
+        self._conditions_written = set()  # wait condition ids already in this journal
+        self._open()
+        self._wake = threading.Event()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_loop, name='journal-flusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _open(self):
+        """Open for appending, writing a header if the file is new or empty"""
+        self._file = open(self.path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(HEADER.pack(MAGIC, VERSION))
+
+    # --- appends (called from the recording thread) ---
+
+    def _write(self, data):
+        with self._lock:
+            self._file.write(data)
+            self._pending += 1
+            if self._pending >= self.fsync_batch:
+                self._wake.set()
+
+    def append_row(self, x, y, delay, offset_x, offset_y, scroll_amount, flags, button, anchor=0):
+        """Journal a new step, given as a ClickStore.rows() tuple"""
+        self._write(_APPEND.pack(OP_APPEND, x, y, delay, offset_x, offset_y, scroll_amount, flags, button, anchor))
+
+    def _write_anchor(self, steps, code):
+        """Journal the anchor a step refers to, the first time it is used"""
+        if code and code not in self._anchors_written:
+            self._write(_ANCHOR_ID.pack(OP_ANCHOR, code) + steps.anchors[code].pack())
+            self._anchors_written.add(code)
+
+    def _write_tables(self, steps, row):
+        """Journal the anchor and wait condition a step row refers to"""
+        self._write_anchor(steps, row[-1])
+        code = row[5]
+        if row[6] & FLAG_WAIT and code not in self._conditions_written:
+            self._write(_CONDITION_ID.pack(OP_CONDITION, code) + steps.conditions[code].pack())
+            self._conditions_written.add(code)
+
+    def append_step(self, steps, index=-1):
+        """Journal the step at `index` of a ClickStore as a new step"""
+        row = _store_row(steps, index)
+        self._write_tables(steps, row)
+        self.append_row(*row)
+
+    def set_step(self, steps, index):
+        """Journal an in-place edit of the step at `index`"""
+        index = index % len(steps)
+        row = _store_row(steps, index)
+        self._write_tables(steps, row)
+        self._write(_SET.pack(OP_SET, index, *row))
+
+    def insert_step(self, steps, index):
+        """Journal the step inserted at `index` of a ClickStore"""
+        index = index % len(steps)
+        row = _store_row(steps, index)
+        self._write_tables(steps, row)
+        self._write(_SET.pack(OP_INSERT, index, *row))
+
+    def mark_double_last(self):
+        self._write(_OP.pack(OP_DOUBLE_LAST))
+
+    def set_layout(self, layout):
+        """Journal the ScreenLayout of the click list (nothing for None)"""
+        if layout is not None:
+            self._write(_OP.pack(OP_LAYOUT) + layout.pack())
+
+    # --- flushing ---
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wake.wait(self.fsync_interval)
+            self._wake.clear()
+            self.sync()
+
+    def sync(self):
+        """Flush and fsync pending entries"""
+        with self._lock:
+            if not self._pending or self._file.closed:
+                return
+            self._file.flush()
+            fd = self._file.fileno()
+            self._pending = 0
+        try:
+            os.fsync(fd)
+        except OSError:
+            # The file was closed or replaced in between; its data is flushed
+            pass
+
+    # --- lifecycle ---
+
+    def reset(self, base_path=None, layout=None):
+        """
+        Start an empty journal, e.g. after the list was saved (compacted) to
+        base_path or loaded from it. Recovery then starts from that file,
+        mapped to `layout` (the click list's ScreenLayout) if it was loaded
+        for another screen layout.
+        """
+        with self._lock:
+            self._file.close()
+            self._anchors_written.clear()
+            self._conditions_written.clear()
+            self._file = open(self.path, 'wb')
+            self._file.write(HEADER.pack(MAGIC, VERSION))
+            if base_path:
+                encoded = os.path.abspath(base_path).encode('utf-8')
+                self._file.write(_OP.pack(OP_BASE) + _PATH_LENGTH.pack(len(encoded)) + encoded)
+            if layout is not None:
+                self._file.write(_OP.pack(OP_LAYOUT) + layout.pack())
+            self._pending += 1
+        self.sync()
+
+    def rotate(self):
+        """Move the current journal aside (see restore_previous) and start an empty one"""
+        self.sync()
+        with self._lock:
+            self._file.close()
+            os.replace(self.path, self.path + PREVIOUS_SUFFIX)
+            self._anchors_written.clear()
+            self._conditions_written.clear()
+            self._open()
+            self._pending += 1
+        self.sync()
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self.sync()
+        with self._lock:
+            self._file.close()
+
+
+def _store_row(steps, index):
+    index = index % len(steps)
+    return (steps.x[index], steps.y[index], steps.delay[index], steps.offset_x[index],
+            steps.offset_y[index], steps.scroll_amount[index], steps.flags[index], steps.button[index],
+            steps.anchor[index])
+
+
+def recover(path=JOURNAL_FILE):
+    """
+    Rebuild the click list from a journal.
+    Returns a ClickStore (empty if there is no journal or nothing in it).
+    """
+    store = ClickStore()
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return store
+    if len(data) < HEADER.size or HEADER.unpack_from(data, 0)[0] != MAGIC:
+        return store
+
+    offset = HEADER.size
+    end = len(data)
+    while offset < end:
+        op = data[offset]
+        if op == OP_APPEND:
+            if offset + _APPEND.size > end:
+                break
+            row = _APPEND.unpack_from(data, offset)[1:]
+            for (name, _), value in zip(COLUMNS, row):
+                getattr(store, name).append(value)
+            offset += _APPEND.size
+        elif op == OP_SET:
+            if offset + _SET.size > end:
+                break
+            fields = _SET.unpack_from(data, offset)
+            index, row = fields[1], fields[2:]
+            if index < len(store):
+                for (name, _), value in zip(COLUMNS, row):
+                    getattr(store, name)[index] = value
+            offset += _SET.size
+        elif op == OP_INSERT:
+            if offset + _SET.size > end:
+                break
+            fields = _SET.unpack_from(data, offset)
+            index, row = min(fields[1], len(store)), fields[2:]
+            for (name, _), value in zip(COLUMNS, row):
+                getattr(store, name).insert(index, value)
+            offset += _SET.size
+        elif op == OP_DOUBLE_LAST:
+            if len(store):
+                store.flags[-1] |= FLAG_DOUBLE
+            offset += _OP.size
+        elif op == OP_BASE:
+            start = offset + _OP.size + _PATH_LENGTH.size
+            if start > end:
+                break
+            length = _PATH_LENGTH.unpack_from(data, offset + _OP.size)[0]
+            if start + length > end:
+                break
+            base_path = data[start:start + length].decode('utf-8')
+            try:
+                store = macro_io.load(base_path)
+            except (OSError, ValueError) as e:
+                log.error('journal', "Journal base {path} could not be loaded: {error}", path=base_path, error=e)
+                store = ClickStore()
+            offset = start + length
+        elif op == OP_ANCHOR:
+            if offset + _ANCHOR_ID.size > end:
+                break
+            code = _ANCHOR_ID.unpack_from(data, offset)[1]
+            try:
+                anchor, offset = Anchor.unpack_from(data, offset + _ANCHOR_ID.size)
+            except ValueError:
+                break
+            store.put_anchor(code, anchor)
+        elif op == OP_CONDITION:
+            if offset + _CONDITION_ID.size + CONDITION.size > end:
+                break
+            code = _CONDITION_ID.unpack_from(data, offset)[1]
+            try:
+                condition, offset = WaitCondition.unpack_from(data, offset + _CONDITION_ID.size)
+            except ValueError:
+                break
+            store.put_condition(code, condition)
+        elif op == OP_LAYOUT:
+            try:
+                layout, offset = ScreenLayout.unpack_from(data, offset + _OP.size)
+            except ValueError:
+                break
+            # A base loaded from its file is in the layout it was recorded
+            # on; the ops after this one are in `layout`
+            if store.layout is None:
+                store.layout = layout
+            else:
+                store.remap(layout)
+        else:
+            # Unknown opcode: the rest of the file can't be trusted
+            break
+    return store
+
+
+def restore_previous(path=JOURNAL_FILE):
+    """Recover the journal that was moved aside by the last clear"""
+    return recover(path + PREVIOUS_SUFFIX)
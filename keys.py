@@ -0,0 +1,61 @@
+"""
+Key codes of keyboard steps.
+
+A key step stores its key as a code in the scroll_amount column, like wait
+steps store their condition id: a character is its Unicode code point, a
+named key (enter, tab, arrows, ...) is -(index + 1) into SPECIAL_KEYS.
+Names follow pyautogui's key names, so backends can pass them on.
+
+Printable characters are "text": replay merges runs of text key steps into
+one type_text() call (see replay_plan.py). Modifier keys are never recorded;
+pynput already reports the shifted character, and control combinations
+have no printable character.
+"""
+
+SPECIAL_KEYS = (
+    'enter', 'tab', 'backspace', 'delete', 'esc', 'insert',
+    'up', 'down', 'left', 'right', 'home', 'end', 'pageup', 'pagedown',
+    'f1', 'f2', 'f3', 'f4', 'f5', 'f6', 'f7', 'f8', 'f9', 'f10', 'f11', 'f12',
+)
+SPECIAL_CODES = {name: -(index + 1) for index, name in enumerate(SPECIAL_KEYS)}
+# pynput Key names that differ from ours
+PYNPUT_NAMES = {'page_up': 'pageup', 'page_down': 'pagedown', 'space': ' '}
+
+
+def key_code(key):
+    """The stored code of a key: a single character or a SPECIAL_KEYS name"""
+    if len(key) == 1:
+        return ord(key)
+    try:
+        return SPECIAL_CODES[key]
+    except KeyError:
+        raise ValueError(f"unknown key: {key!r}") from None
+
+
+def key_name(code):
+    """The key (character or name) of a stored code"""
+    if code >= 0:
+        return chr(code)
+    return SPECIAL_KEYS[-code - 1]
+
+
+def is_text(code):
+    """True for printable characters, which replay can type as text"""
+    return code >= 0 and chr(code).isprintable()
+
+
+def from_pynput(key):
+    """
+    The code of a key reported by a pynput listener, or None for keys that
+    aren't recorded (modifiers, control characters, unknown keys)
+    """
+    char = getattr(key, 'char', None)
+    if char is not None:
+        return ord(char) if len(char) == 1 and char.isprintable() else None
+    name = getattr(key, 'name', None)
+    if name is None:
+        return None
+    name = PYNPUT_NAMES.get(name, name)
+    if len(name) == 1:
+        return ord(name)
+    return SPECIAL_CODES.get(name)
@@ -0,0 +1,382 @@
+"""
+Command line runner: record, replay, convert and inspect macros without the GUI.
+
+    python -m macro_cli replay test.json --cycles 3 --speed 2
+    python -m macro_cli replay macro.mvb --backend headless --trace trace.json
+    python -m macro_cli replay form.json --window 120,80
+    python -m macro_cli record out.mvb --duration 30 --moves --keys
+    python -m macro_cli convert test.json test.mvb
+    python -m macro_cli inspect test.mvb
+    python -m macro_cli serve --preload job.mvb
+    python -m macro_cli control run job.mvb --cycles 2 --backend xtest
+
+Startup cost matters when a scheduler job runs a macro, so this module
+only imports the standard library at load time. Each command imports what
+it needs when it runs: convert and inspect never load clickanput, and
+replay only loads pynput/pyautogui when the pyautogui backend is used (or
+recording is asked for). Tk is never imported. For jobs that run often,
+`serve` keeps a warm process with a control server (see control_server.py)
+and `control` sends it commands without loading clickanput at all.
+
+IMPORT_BUDGET is the time `import macro_cli` may take and COMMAND_BUDGETS
+the import time of each command's modules. --timings reports a command's
+import time and the heavy modules it loaded; the benchmark suite measures
+both budgets in fresh interpreters and flags runs over budget.
+"""
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+
+
+# Import time budgets in seconds
+IMPORT_BUDGET = 0.05
+COMMAND_BUDGETS = {
+    'inspect': 0.25,
+    'convert': 0.25,
+    'replay': 0.5,
+    'record': 1.0,
+    'serve': 0.5,
+    'control': 0.1,
+}
+# Backends with a screen corner failsafe
+FAILSAFE_BACKENDS = ('pyautogui', 'xtest')
+# Backends that drive the desktop; macros are mapped to its screen layout
+DESKTOP_BACKENDS = ('pyautogui', 'xtest')
+# Modules a headless replay must not load
+HEAVY_MODULES = ('tkinter', 'pyautogui', 'pynput')
+
+_import_ns = 0  # time spent importing command modules, for --timings
+
+
+def _timed_import(name):
+    """Import a module by name, adding the time it took to _import_ns"""
+    global _import_ns
+    start = time.perf_counter_ns()
+    module = __import__(name)
+    _import_ns += time.perf_counter_ns() - start
+    return module
+
+
+def loaded_heavy_modules():
+    """The HEAVY_MODULES currently imported"""
+    return [name for name in HEAVY_MODULES if name in sys.modules]
+
+
+def _open_macro(path, editable=False, layout=None):
+    """
+    A binary macro is mapped instead of loaded unless it must be editable,
+    so replay and inspect start without decoding every step. With `layout`,
+    steps recorded on another screen layout are mapped to it.
+    """
+    macro_io = _timed_import('macro_io')
+    if not editable and macro_io.is_binary(path):
+        return macro_io.MappedMacro(path, layout)
+    return macro_io.load(path, layout)
+
+
+def _point(text):
+    """argparse type for X,Y"""
+    try:
+        x, y = (int(v) for v in text.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected X,Y, got {text!r}") from None
+    return x, y
+
+
+def _scale_delays(steps, speed):
+    """Divide every step delay by speed, in place"""
+    delays = steps.delay
+    for i, delay in enumerate(delays):
+        delays[i] = delay / speed
+
+
+# --- commands ---
+
+def cmd_replay(args):
+    if args.speed <= 0:
+        raise SystemExit("--speed must be positive")
+    if args.no_failsafe and args.backend not in FAILSAFE_BACKENDS:
+        raise SystemExit(f"--no-failsafe only applies to {' and '.join(FAILSAFE_BACKENDS)}")
+    can = _timed_import('clickanput')
+    backends = _timed_import('backends')
+    event_log = _timed_import('event_log')
+    options = {'failsafe': False} if args.no_failsafe else {}
+    backend = backends.create_backend(args.backend, **options)
+    can.reference_window = args.window
+    layout = None
+    if args.backend in DESKTOP_BACKENDS and not args.no_remap:
+        layout = can.current_layout(backend)
+    steps = _open_macro(args.macro, editable=args.speed != 1, layout=layout)
+    if args.speed != 1:
+        _scale_delays(steps, args.speed)
+    can.replay_step_time = args.step_time / args.speed
+    can.trace_replay = bool(args.trace)
+    cycles = args.cycles if args.cycles > 0 else None
+
+    if not can.start_replay(backend=backend, cycles=cycles, steps=steps):
+        return 1
+    try:
+        # Joined in slices so Ctrl+C gets through
+        while can.replay_engine.is_running:
+            can.replay_engine.join(0.2)
+    except KeyboardInterrupt:
+        can.stop_replay()
+        can.replay_engine.join()
+    finally:
+        close = getattr(steps, 'close', None)
+        if close is not None:
+            close()
+
+    for line in event_log.format_metrics(event_log.metrics.snapshot()):
+        event_log.info('metrics', line)
+    if getattr(backend, 'actions', None) is not None:
+        event_log.info('replay', "{count} actions sent to the {backend} backend",
+                       count=len(backend.actions), backend=backend.name)
+    if args.trace:
+        can.export_trace(args.trace)
+    return 0
+
+
+def cmd_record(args):
+    can = _timed_import('clickanput')
+    macro_io = _timed_import('macro_io')
+    event_log = _timed_import('event_log')
+    can.record_moves = args.moves
+    can.record_keys = args.keys
+    can.reference_window = args.window
+    if args.tolerance is not None:
+        can.move_tolerance = args.tolerance
+    if args.keys:
+        can.start_listeners()
+
+    can.recording_switch()
+    event_log.info('cli', "Recording, press Ctrl+C to stop")
+    try:
+        deadline = time.monotonic() + args.duration if args.duration else None
+        while can.recording and (deadline is None or time.monotonic() < deadline):
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        pass
+    if can.recording:
+        can.recording_switch()
+
+    macro_io.save(args.output, can.click_positions)
+    event_log.info('cli', "Saved {count} steps to {path}", count=len(can.click_positions), path=args.output)
+    return 0
+
+
+def cmd_convert(args):
+    macro_io = _timed_import('macro_io')
+    macro_io.convert(args.source, args.destination)
+    return 0
+
+
+def cmd_inspect(args):
+    macro_io = _timed_import('macro_io')
+    replay_plan = _timed_import('replay_plan')
+    macro_optimizer = _timed_import('macro_optimizer')
+
+    steps = _open_macro(args.macro)
+    try:
+        plan = replay_plan.compile_plan(steps) if len(steps) else None
+        kinds = collections.Counter()
+        anchored = 0
+        if plan is not None:
+            ops = plan.ops.tolist() if hasattr(plan.ops, 'tolist') else list(plan.ops)
+            step_of = plan.steps.tolist() if hasattr(plan.steps, 'tolist') else list(plan.steps)
+            amounts = plan.scroll_amount.tolist() if hasattr(plan.scroll_amount, 'tolist') else list(plan.scroll_amount)
+            # The last instruction of a step is the step's own action
+            kind_of = {}
+            for step, op, amount in zip(step_of, ops, amounts):
+                if op == replay_plan.OP_LOCATE:
+                    anchored += 1
+                elif op == replay_plan.OP_TYPE:
+                    # A merged run of key steps, counted per key
+                    kinds['key'] += len(plan.texts[amount]) - 1
+                    kind_of[step] = 'key'
+                    continue
+                kind_of[step] = replay_plan.OP_NAMES[op % replay_plan.OP_ANCHORED]
+            kinds.update(kind_of.values())
+        info = {
+            'path': args.macro,
+            'format': 'binary' if macro_io.is_binary(args.macro) else 'json',
+            'size_bytes': os.path.getsize(args.macro),
+            'steps': len(steps),
+            'instructions': len(plan) if plan is not None else 0,
+            'kinds': dict(sorted(kinds.items())),
+            'anchored_steps': anchored,
+            'anchors': len(steps.anchors),
+            'wait_conditions': len(steps.conditions),
+            'layout': steps.layout.to_dict() if steps.layout is not None else None,
+            'cycle_s': macro_optimizer.estimate_cycle_time(steps, args.step_time),
+            'step_time_s': args.step_time,
+        }
+    finally:
+        close = getattr(steps, 'close', None)
+        if close is not None:
+            close()
+
+    if args.json:
+        print(json.dumps(info, indent=2))
+    else:
+        for key, value in info.items():
+            if key == 'kinds':
+                value = ', '.join(f"{name}={n}" for name, n in value.items()) or '-'
+            elif key == 'cycle_s':
+                value = f"{value:.3f}"
+            elif key == 'layout':
+                value = steps.layout or '-'
+            print(f"{key}: {value}")
+    return 0
+
+
+def cmd_serve(args):
+    can = _timed_import('clickanput')
+    control_server = _timed_import('control_server')
+    event_log = _timed_import('event_log')
+    if args.backend:
+        can.set_input_backend(args.backend)
+    server = control_server.ControlServer(can, args.socket)
+    for path in args.preload:
+        server.load(path)
+    server.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        can.stop_replay()
+        server.close()
+    event_log.info('cli', "Control server stopped")
+    return 0
+
+
+def cmd_control(args):
+    control_server = _timed_import('control_server')
+    try:
+        with control_server.ControlClient(args.socket) as client:
+            if args.action in ('load', 'start', 'run') and not args.macro:
+                raise SystemExit(f"{args.action} needs a macro")
+            if args.action == 'load':
+                result = client.load(args.macro)
+            elif args.action == 'start':
+                result = client.start(args.macro, args.cycles or None, args.backend, args.step_time)
+            elif args.action == 'run':
+                # Progress events as JSON lines, then the final status
+                def show(event):
+                    print(json.dumps(event), flush=True)
+                result = client.run(args.macro, args.cycles or None, args.backend, args.step_time, on_event=show)
+            elif args.action == 'watch':
+                result = None
+                try:
+                    for event in client.watch():
+                        print(json.dumps(event), flush=True)
+                except KeyboardInterrupt:
+                    pass
+            else:
+                result = getattr(client, args.action)()
+    except (control_server.ControlError, ValueError) as e:  # ValueError: a bad --socket
+        raise SystemExit(str(e))
+    if result is not None:
+        print(json.dumps(result, indent=2))
+    return 0
+
+
+# --- entry point ---
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m macro_cli', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--log-level', default='INFO', help="DEBUG, INFO, WARNING or ERROR (default INFO)")
+    parser.add_argument('--json-log', action='store_true', help="write the event log as JSON lines")
+    parser.add_argument('--timings', action='store_true', help="report import times against the budgets")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    replay = commands.add_parser('replay', help="replay a macro file")
+    replay.add_argument('macro')
+    replay.add_argument('--cycles', type=int, default=1, help="cycles to run, 0 until Ctrl+C (default 1)")
+    replay.add_argument('--speed', type=float, default=1.0,
+                        help="speed factor; step time and delays are divided by it (default 1)")
+    replay.add_argument('--step-time', type=float, default=0.1, help="seconds after every action (default 0.1)")
+    replay.add_argument('--backend', default='pyautogui', choices=('pyautogui', 'xtest', 'headless', 'null'),
+                        help="input backend (default pyautogui; xtest talks to the X server directly)")
+    replay.add_argument('--no-failsafe', action='store_true',
+                        help="don't stop when the pointer is in a screen corner")
+    replay.add_argument('--trace', metavar='PATH', help="trace the replay and export it to PATH")
+    replay.add_argument('--window', type=_point, metavar='X,Y',
+                        help="origin of the reference window now; steps recorded against a window move with it")
+    replay.add_argument('--no-remap', action='store_true',
+                        help="replay the recorded coordinates as they are, even on another screen layout")
+    replay.set_defaults(run=cmd_replay)
+
+    record = commands.add_parser('record', help="record clicks into a macro file")
+    record.add_argument('output', help="file to save to; .mvb saves binary, anything else JSON")
+    record.add_argument('--duration', type=float, default=0, help="stop after this many seconds")
+    record.add_argument('--moves', action='store_true', help="also record mouse paths and drags")
+    record.add_argument('--keys', action='store_true', help="also record key presses (not the control hotkeys)")
+    record.add_argument('--tolerance', type=float, help="mouse path simplification tolerance in pixels")
+    record.add_argument('--window', type=_point, metavar='X,Y',
+                        help="origin of the window the steps are recorded against")
+    record.set_defaults(run=cmd_record)
+
+    convert = commands.add_parser('convert', help="convert between JSON and binary")
+    convert.add_argument('source')
+    convert.add_argument('destination', help=".mvb for binary, anything else JSON")
+    convert.set_defaults(run=cmd_convert)
+
+    inspect = commands.add_parser('inspect', help="summarize a macro file")
+    inspect.add_argument('macro')
+    inspect.add_argument('--step-time', type=float, default=0.1, help="step time for the cycle estimate")
+    inspect.add_argument('--json', action='store_true', help="print JSON")
+    inspect.set_defaults(run=cmd_inspect)
+
+    serve = commands.add_parser('serve', help="run a control server that replays macros on request")
+    serve.add_argument('--socket', help="socket path or 127.0.0.1:PORT (default: a per-user socket)")
+    serve.add_argument('--backend', choices=('pyautogui', 'xtest', 'headless', 'null'),
+                       help="default input backend of jobs (default pyautogui)")
+    serve.add_argument('--preload', action='append', default=[], metavar='MACRO',
+                       help="load and compile this macro before listening (repeatable)")
+    serve.set_defaults(run=cmd_serve)
+
+    control = commands.add_parser('control', help="send a command to a control server")
+    control.add_argument('action', choices=('status', 'ping', 'macros', 'load', 'start', 'run', 'stop', 'watch'),
+                         help="run starts a macro and streams its progress until it ends")
+    control.add_argument('macro', nargs='?', help="macro file, or the name of a cached macro")
+    control.add_argument('--socket', help="socket path or 127.0.0.1:PORT (default: a per-user socket)")
+    control.add_argument('--cycles', type=int, default=1, help="cycles to run, 0 until stopped (default 1)")
+    control.add_argument('--backend', choices=('pyautogui', 'xtest', 'headless', 'null'),
+                         help="input backend (default: the server's)")
+    control.add_argument('--step-time', type=float, help="seconds after every action (default: the server's)")
+    control.set_defaults(run=cmd_control)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    event_log = _timed_import('event_log')
+    try:
+        event_log.set_level(args.log_level)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    event_log.log.json_lines = args.json_log
+
+    try:
+        status = args.run(args)
+    except (OSError, ValueError) as e:
+        event_log.error('cli', "{command} failed: {error}", command=args.command, error=e)
+        status = 1
+
+    if args.timings:
+        budget = COMMAND_BUDGETS[args.command]
+        event_log.info('timings', "{command} imports: {import_s:.3f}s (budget {budget_s:.3f}s), heavy modules: {heavy}",
+                       command=args.command, import_s=_import_ns / 1e9, budget_s=budget,
+                       heavy=loaded_heavy_modules())
+    event_log.log.flush()
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,421 @@
+"""
+Reading and writing macro files.
+
+Two formats are supported:
+  - JSON (.json): a list of Click.to_dict() dictionaries, as in test.json,
+    or {"version": 2, "layout": ..., "steps": [...]} for macros that know
+    the screen layout they were recorded on
+  - binary (.mvb): a 16 byte header followed by fixed-size step records
+
+Binary layout (little endian):
+    header: magic b'MVIT', u16 version, u16 record size, u64 step count
+    record: i32 x, i32 y, f64 delay, i32 offset_x, i32 offset_y,
+            i32 scroll_amount, u8 flags, u8 button, u16 anchor id
+    anchors (optional, after the records): magic b'MVAN', u32 count, then
+            per anchor a u16 id and anchors.Anchor.pack() data
+    wait conditions (optional, after the anchors): magic b'MVWC', u32 count,
+            then per condition a u32 id and WaitCondition.pack() data
+    screen layout (optional, last): magic b'MVSL', u32 count (1), then
+            ScreenLayout.pack() data
+
+The anchor id used to be padding, so files written before anchors existed
+read as unanchored steps. Readers stop at the first table they don't
+know, so the layout is written last. A wait step keeps its condition id in the
+scroll_amount field, a key step its key code (see keys.py).
+
+Readers step through records by the record size stored in the header, so
+later versions can append fields without breaking old readers. A count of
+COUNT_UNKNOWN means the writer never finished; the count is then derived
+from the file size.
+"""
+import json
+import mmap
+import os
+import struct
+from array import array
+
+from ClickStore import (ClickStore, COLUMNS, BUTTON_NAMES, FLAG_DOUBLE, FLAG_SCROLL, FLAG_MOVE,
+                        FLAG_MOUSE_DOWN, FLAG_MOUSE_UP, FLAG_WAIT, FLAG_KEY)
+from keys import key_name
+from screen_layout import ScreenLayout, layout_from_dict, layout_transform
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, mapped files then decode with struct
+    np = None
+
+
+BINARY_EXT = '.mvb'
+MAGIC = b'MVIT'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQ')
+RECORD = struct.Struct('<iidiiiBBH')
+ANCHOR_MAGIC = b'MVAN'
+ANCHOR_TABLE = struct.Struct('<4sI')
+ANCHOR_ID = struct.Struct('<H')
+CONDITION_MAGIC = b'MVWC'
+CONDITION_ID = struct.Struct('<I')
+LAYOUT_MAGIC = b'MVSL'
+COUNT_UNKNOWN = 0xFFFFFFFFFFFFFFFF
+# Records buffered by MacroWriter before each write
+WRITE_CHUNK = 4096
+
+if np is not None:
+    RECORD_DTYPE = np.dtype({
+        'names': ['x', 'y', 'delay', 'offset_x', 'offset_y', 'scroll_amount', 'flags', 'button', 'anchor'],
+        'formats': ['<i4', '<i4', '<f8', '<i4', '<i4', '<i4', 'u1', 'u1', '<u2'],
+        'offsets': [0, 4, 8, 16, 20, 24, 28, 29, 30],
+        'itemsize': RECORD.size,
+    })
+
+
+class MacroFormatError(ValueError):
+    """Raised when a file is not a valid binary macro"""
+
+
+def _column_dtype(typecode):
+    """NumPy dtype with the same item layout as an array module typecode"""
+    return {'i': np.intc, 'd': np.double, 'B': np.ubyte, 'H': np.ushort}[typecode]
+
+
+# --- JSON ---
+
+JSON_VERSION = 2  # the wrapped form with a layout; plain lists are version 1
+
+def save_json(path, steps):
+    """Save steps (a ClickStore or a list of Click objects) as a JSON macro"""
+    if hasattr(steps, 'to_dicts'):
+        click_data = steps.to_dicts()
+    else:
+        click_data = [click_obj.to_dict() for click_obj in steps]
+    layout = getattr(steps, 'layout', None)
+    if layout is not None:
+        click_data = {'version': JSON_VERSION, 'layout': layout.to_dict(), 'steps': click_data}
+
+    with open(path, 'w+') as f:
+        json.dump(click_data, f, indent=2)
+
+
+def load_json(path, layout=None):
+    """Load a JSON macro into a ClickStore, mapped to `layout` if given"""
+    with open(path, 'r') as f:
+        click_data = json.load(f)
+    recorded = None
+    if isinstance(click_data, dict):
+        recorded = layout_from_dict(click_data.get('layout'))
+        click_data = click_data.get('steps', [])
+    store = ClickStore.from_dicts(click_data)
+    store.layout = recorded
+    store.remap(layout)
+    return store
+
+
+# --- binary ---
+
+class MacroWriter:
+    """
+    Streams step records into a binary macro file.
+    The header count is patched in close(), so steps can be written one at a
+    time without knowing the total up front. Anchors and wait conditions
+    referenced by the steps are collected in `anchors` (id -> Anchor) and
+    `conditions` (id -> WaitCondition) and written after the records, as
+    is `layout` (a ScreenLayout) when set.
+    """
+
+    def __init__(self, path, layout=None):
+        self.path = path
+        self.count = 0
+        self.anchors = {}
+        self.conditions = {}
+        self.layout = layout
+        self._buffer = bytearray()
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, COUNT_UNKNOWN))
+
+    def write_row(self, x, y, delay, offset_x, offset_y, scroll_amount, flags, button, anchor=0):
+        """Write one step given as a ClickStore.rows() tuple"""
+        self._buffer += RECORD.pack(x, y, delay, offset_x, offset_y, scroll_amount, flags, button, anchor)
+        self.count += 1
+        if len(self._buffer) >= WRITE_CHUNK * RECORD.size:
+            self.flush()
+
+    def write_steps(self, steps):
+        """Write every step of a ClickStore (or a list of Click objects)"""
+        if not isinstance(steps, ClickStore):
+            steps = ClickStore.from_clicks(steps)
+        self.anchors.update(steps.anchors)
+        self.conditions.update(steps.conditions)
+        if steps.layout is not None:
+            self.layout = steps.layout
+        for row in steps.rows():
+            self.write_row(*row)
+
+    def flush(self):
+        self._file.write(self._buffer)
+        self._buffer.clear()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        if self.anchors:
+            table = bytearray(ANCHOR_TABLE.pack(ANCHOR_MAGIC, len(self.anchors)))
+            for code, anchor in self.anchors.items():
+                table += ANCHOR_ID.pack(code) + anchor.pack()
+            self._file.write(table)
+        if self.conditions:
+            table = bytearray(ANCHOR_TABLE.pack(CONDITION_MAGIC, len(self.conditions)))
+            for code, condition in self.conditions.items():
+                table += CONDITION_ID.pack(code) + condition.pack()
+            self._file.write(table)
+        if self.layout is not None:
+            self._file.write(ANCHOR_TABLE.pack(LAYOUT_MAGIC, 1) + self.layout.pack())
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, self.count))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def save_binary(path, steps):
+    """Save steps as a binary macro"""
+    with MacroWriter(path) as writer:
+        writer.write_steps(steps)
+
+
+def _read_header(buffer, size):
+    if size < HEADER.size:
+        raise MacroFormatError("file too short for a macro header")
+    magic, version, record_size, count = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise MacroFormatError("not a binary macro file")
+    if version > VERSION:
+        raise MacroFormatError(f"unsupported macro version {version}")
+    if record_size < RECORD.size:
+        raise MacroFormatError(f"record size {record_size} too small")
+    available = (size - HEADER.size) // record_size
+    if count == COUNT_UNKNOWN:
+        count = available
+    elif count > available:
+        raise MacroFormatError(f"header says {count} steps but file holds {available}")
+    return record_size, count
+
+
+def _read_tables(buffer, offset):
+    """
+    Parse the optional anchor, wait condition and layout tables at offset;
+    returns ({id: Anchor}, {id: WaitCondition}, ScreenLayout or None)
+    """
+    anchors, conditions, layout = {}, {}, None
+    while len(buffer) >= offset + ANCHOR_TABLE.size:
+        magic, count = ANCHOR_TABLE.unpack_from(buffer, offset)
+        if magic == LAYOUT_MAGIC:
+            try:
+                layout, offset = ScreenLayout.unpack_from(buffer, offset + ANCHOR_TABLE.size)
+            except (struct.error, ValueError) as e:
+                raise MacroFormatError(f"damaged screen layout: {e}") from None
+            continue
+        if magic == ANCHOR_MAGIC:
+            from anchors import Anchor
+            table, item, id_struct, name = anchors, Anchor, ANCHOR_ID, 'anchor'
+        elif magic == CONDITION_MAGIC:
+            from screen_wait import WaitCondition
+            table, item, id_struct, name = conditions, WaitCondition, CONDITION_ID, 'wait condition'
+        else:
+            break
+        offset += ANCHOR_TABLE.size
+        try:
+            for _ in range(count):
+                code = id_struct.unpack_from(buffer, offset)[0]
+                table[code], offset = item.unpack_from(buffer, offset + id_struct.size)
+        except (struct.error, ValueError) as e:
+            raise MacroFormatError(f"damaged {name} table: {e}") from None
+    return anchors, conditions, layout
+
+
+class MappedMacro:
+    """
+    Read-only, memory-mapped view of a binary macro.
+    Steps are decoded on access; columns() exposes them to compile_plan()
+    without building a Click or ClickStore row per step.
+
+    With `layout`, steps recorded on another screen layout are mapped to it
+    (see screen_layout.py) by everything except records(), which is the
+    file's content as is.
+    """
+
+    def __init__(self, path, layout=None):
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size == 0:
+            self._file.close()
+            raise MacroFormatError("empty file")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.record_size, self.count = _read_header(self._map, size)
+        self._anchors, self.conditions, self.recorded_layout = _read_tables(
+            self._map, HEADER.size + self.count * self.record_size)
+        self._transform = layout_transform(self.recorded_layout, layout)
+        self.anchors = self._transform.anchors(self._anchors) if self._transform else self._anchors
+        self.layout = layout if self.recorded_layout is not None and layout is not None else self.recorded_layout
+
+    def __len__(self):
+        return self.count
+
+    def _row(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("MappedMacro index out of range")
+        row = RECORD.unpack_from(self._map, HEADER.size + index * self.record_size)
+        return self._map_row(row) if self._transform else row
+
+    def _recorded_rows(self):
+        if self.record_size == RECORD.size:
+            end = HEADER.size + self.count * RECORD.size
+            return RECORD.iter_unpack(memoryview(self._map)[HEADER.size:end])
+        return (RECORD.unpack_from(self._map, HEADER.size + i * self.record_size) for i in range(self.count))
+
+    def _map_row(self, row):
+        x, y, delay, offset_x, offset_y, *rest = row
+        return (*self._transform.point(x, y), delay, *self._transform.offset(x, y, offset_x, offset_y), *rest)
+
+    def row_dict(self, index):
+        x, y, delay, offset_x, offset_y, scroll_amount, flags, button, anchor = self._row(index)
+        data = {
+            'x': x,
+            'y': y,
+            'button': BUTTON_NAMES[button],
+            'delay': delay,
+            'is_double_click': bool(flags & FLAG_DOUBLE),
+            'offset_x': offset_x,
+            'offset_y': offset_y,
+            'is_scroll': bool(flags & FLAG_SCROLL),
+            'scroll_amount': 0 if flags & (FLAG_WAIT | FLAG_KEY) else scroll_amount,
+            'is_move': bool(flags & FLAG_MOVE),
+            'is_mouse_down': bool(flags & FLAG_MOUSE_DOWN),
+            'is_mouse_up': bool(flags & FLAG_MOUSE_UP),
+        }
+        if anchor in self.anchors:
+            data['anchor'] = self.anchors[anchor].to_dict()
+        if flags & FLAG_WAIT and scroll_amount in self.conditions:
+            data['wait'] = self.conditions[scroll_amount].to_dict()
+        if flags & FLAG_KEY:
+            data['key'] = key_name(scroll_amount)
+        return data
+
+    def __getitem__(self, index):
+        return self.row_dict(index)
+
+    def rows(self):
+        """Iterate ClickStore.rows() style tuples straight from the map"""
+        rows = self._recorded_rows()
+        return map(self._map_row, rows) if self._transform else rows
+
+    def records(self):
+        """The records as a NumPy structured array backed by the map"""
+        dtype = RECORD_DTYPE
+        if self.record_size != RECORD.size:
+            dtype = np.dtype({'names': dtype.names, 'formats': [dtype.fields[n][0] for n in dtype.names],
+                              'offsets': [dtype.fields[n][1] for n in dtype.names], 'itemsize': self.record_size})
+        return np.frombuffer(self._map, dtype=dtype, count=self.count, offset=HEADER.size)
+
+    def columns(self):
+        """Step columns by name, as used by replay_plan.compile_plan()"""
+        if np is not None:
+            records = self.records()
+            columns = {name: records[name] for name, _ in COLUMNS}
+            # One vectorized pass over the whole macro
+            return self._transform.columns(columns) if self._transform else columns
+        names = [name for name, _ in COLUMNS]
+        columns = {name: [] for name in names}
+        for row in self.rows():
+            for name, value in zip(names, row):
+                columns[name].append(value)
+        return columns
+
+    def to_store(self):
+        """Copy every step into an editable ClickStore"""
+        store = ClickStore()
+        for code, anchor in self._anchors.items():
+            store.put_anchor(code, anchor)
+        for code, condition in self.conditions.items():
+            store.put_condition(code, condition)
+        store.layout = self.recorded_layout
+        if np is not None:
+            records = self.records()
+            for name, typecode in COLUMNS:
+                column = array(typecode)
+                column.frombytes(records[name].astype(_column_dtype(typecode)).tobytes())
+                setattr(store, name, column)
+        else:
+            for row in self._recorded_rows():
+                for (name, _), value in zip(COLUMNS, row):
+                    getattr(store, name).append(value)
+        store.remap(self.layout)
+        return store
+
+    def to_dicts(self):
+        return [self.row_dict(i) for i in range(self.count)]
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # NumPy views from columns() are still alive; the map is
+            # released when they are garbage collected
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_binary(path, layout=None):
+    """Load a binary macro into an editable ClickStore, mapped to `layout` if given"""
+    with MappedMacro(path, layout) as macro:
+        return macro.to_store()
+
+
+# --- format dispatch ---
+
+def is_binary(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load(path, layout=None):
+    """
+    Load a macro of either format into a ClickStore; with `layout` (the
+    current ScreenLayout), steps recorded on another layout are mapped to it
+    """
+    if is_binary(path):
+        return load_binary(path, layout)
+    return load_json(path, layout)
+
+
+def save(path, steps):
+    """Save steps, choosing the format from the file extension"""
+    if path.endswith(BINARY_EXT):
+        save_binary(path, steps)
+    else:
+        save_json(path, steps)
+
+
+def convert(src, dst):
+    """Convert a macro between formats (chosen by the destination extension)"""
+    if is_binary(src):
+        with MappedMacro(src) as macro:
+            if dst.endswith(BINARY_EXT):
+                save_binary(dst, macro.to_store())
+            else:
+                save_json(dst, macro)
+    else:
+        save(dst, load_json(src))
@@ -0,0 +1,190 @@
+"""
+Optimizer pass over a recorded step list.
+
+Recordings carry waste that replay pays for on every cycle. optimize()
+returns a smaller ClickStore that replays the same way, plus a report:
+
+  - delays are rounded to DELAY_RESOLUTION and negative ones clamped to 0
+  - a scroll of 0 is only a pointer move, so it becomes a path move (no
+    settle time, no step time)
+  - adjacent scrolls at the same place, in the same direction and less than
+    `max_scroll_gap` apart, become one scroll of the summed amount
+  - two plain clicks with the same button within `double_click_distance`
+    pixels and `double_click_time` of each other (step time included) are
+    what the OS reads as a double click; they become a double click step.
+    Recording only folds clicks at exactly the same position.
+  - path moves to where the pointer already is are dropped, and outside of
+    drags a move that is immediately (zero delay) followed by another
+    pointer action is dropped too, since it's overridden before anything
+    can react to it. Inside drags only duplicates go, the path is the drag.
+
+When a step is dropped its delay is kept by the step before it, so the
+timing of everything else is unchanged. Anchored steps, wait steps and key
+steps are never merged or dropped (runs of text keys are merged when the
+plan is compiled instead).
+
+The estimated cycle time comes from the compiled replay plan: step time
+after every timed instruction plus all delays (waits count as 0).
+"""
+import math
+
+from ClickStore import (ClickStore, COLUMNS, FLAG_DOUBLE, FLAG_SCROLL, FLAG_MOVE, FLAG_MOUSE_DOWN,
+                        FLAG_MOUSE_UP, FLAG_WAIT, FLAG_KEY)
+from replay_plan import compile_plan, OP_ANCHORED, UNTIMED_OPS
+
+
+DELAY_RESOLUTION = 0.001  # seconds
+MAX_SCROLL_GAP = 0.1  # scrolls further apart than this stay separate, seconds
+DOUBLE_CLICK_TIME = 0.4  # below the usual 500 ms OS double click time, seconds
+DOUBLE_CLICK_DISTANCE = 2  # pixels, in x and y
+DEFAULT_STEP_TIME = 0.1
+
+# Row fields, in ClickStore.rows() order
+X, Y, DELAY, OFFSET_X, OFFSET_Y, AMOUNT, FLAGS, BUTTON, ANCHOR = range(9)
+
+
+class OptimizeReport:
+    """What optimize() changed, and the estimated cycle time before and after"""
+
+    def __init__(self, steps_before):
+        self.steps_before = steps_before
+        self.steps_after = steps_before
+        self.merged_scrolls = 0
+        self.folded_double_clicks = 0
+        self.dropped_moves = 0
+        self.converted_noops = 0
+        self.normalized_delays = 0
+        self.cycle_s_before = 0.0
+        self.cycle_s_after = 0.0
+
+    @property
+    def removed(self):
+        return self.steps_before - self.steps_after
+
+    @property
+    def changed(self):
+        return bool(self.removed or self.converted_noops or self.normalized_delays)
+
+    @property
+    def saved_s(self):
+        return self.cycle_s_before - self.cycle_s_after
+
+    def summary(self):
+        return {
+            'steps_before': self.steps_before,
+            'steps_after': self.steps_after,
+            'removed': self.removed,
+            'merged_scrolls': self.merged_scrolls,
+            'folded_double_clicks': self.folded_double_clicks,
+            'dropped_moves': self.dropped_moves,
+            'converted_noops': self.converted_noops,
+            'normalized_delays': self.normalized_delays,
+            'cycle_s_before': self.cycle_s_before,
+            'cycle_s_after': self.cycle_s_after,
+            'saved_s': self.saved_s,
+        }
+
+    def __str__(self):
+        return (f"{self.steps_before} -> {self.steps_after} steps ({self.merged_scrolls} scrolls merged, "
+                f"{self.folded_double_clicks} double clicks folded, {self.dropped_moves} moves dropped, "
+                f"{self.converted_noops} no-op scrolls made moves, {self.normalized_delays} delays normalized); "
+                f"cycle {self.cycle_s_before:.3f}s -> {self.cycle_s_after:.3f}s")
+
+
+def estimate_cycle_time(steps, step_time=DEFAULT_STEP_TIME):
+    """Seconds one replay cycle of steps takes, not counting wait steps"""
+    if not len(steps):
+        return 0.0
+    plan = compile_plan(steps)
+    ops = plan.ops.tolist() if hasattr(plan.ops, 'tolist') else plan.ops
+    delays = plan.delay_ns.tolist() if hasattr(plan.delay_ns, 'tolist') else plan.delay_ns
+    timed = sum(1 for op in ops if op % OP_ANCHORED not in UNTIMED_OPS)
+    # Replay can't wait a negative time
+    return sum(d for d in delays if d > 0) / 1e9 + timed * step_time
+
+
+def _pointer_step(row):
+    """True for steps that put the pointer at their position when replayed"""
+    return not row[FLAGS] & (FLAG_WAIT | FLAG_KEY) and not row[ANCHOR]
+
+
+def _same_place(a, b):
+    return (a[X], a[Y], a[OFFSET_X], a[OFFSET_Y], a[ANCHOR]) == (b[X], b[Y], b[OFFSET_X], b[OFFSET_Y], b[ANCHOR])
+
+
+def optimize(steps, step_time=DEFAULT_STEP_TIME, max_scroll_gap=MAX_SCROLL_GAP,
+             double_click_time=DOUBLE_CLICK_TIME, double_click_distance=DOUBLE_CLICK_DISTANCE,
+             resolution=DELAY_RESOLUTION):
+    """
+    Optimize a ClickStore (or anything with rows(), anchors and conditions).
+    Returns (optimized ClickStore, OptimizeReport); `steps` isn't modified.
+    `step_time` is the replay step time the double click window and the
+    cycle estimate are based on.
+    """
+    report = OptimizeReport(len(steps))
+    out = []
+    in_drag = False
+    digits = max(0, round(-math.log10(resolution))) if resolution < 1 else 0
+
+    for row in steps.rows():
+        row = list(row)
+        delay = round(round(max(row[DELAY], 0.0) / resolution) * resolution, digits)
+        if delay != row[DELAY]:
+            report.normalized_delays += 1
+            row[DELAY] = delay
+        flags = row[FLAGS]
+
+        if flags == FLAG_SCROLL and row[AMOUNT] == 0:
+            row[FLAGS] = flags = FLAG_MOVE
+            report.converted_noops += 1
+
+        prev = out[-1] if out else None
+        if prev is not None and not flags & FLAG_WAIT:
+            # Scrolls in a row at the same place
+            if (flags == FLAG_SCROLL and prev[FLAGS] == FLAG_SCROLL and _same_place(prev, row)
+                    and prev[DELAY] <= max_scroll_gap and (prev[AMOUNT] > 0) == (row[AMOUNT] > 0)):
+                prev[AMOUNT] += row[AMOUNT]
+                prev[DELAY] = row[DELAY]
+                report.merged_scrolls += 1
+                continue
+            # Two quick clicks on (nearly) the same spot
+            if (flags == 0 and prev[FLAGS] == 0 and prev[BUTTON] == row[BUTTON]
+                    and (prev[OFFSET_X], prev[OFFSET_Y], prev[ANCHOR]) == (row[OFFSET_X], row[OFFSET_Y], row[ANCHOR])
+                    and abs(prev[X] - row[X]) <= double_click_distance
+                    and abs(prev[Y] - row[Y]) <= double_click_distance
+                    and prev[DELAY] + step_time <= double_click_time):
+                prev[FLAGS] = FLAG_DOUBLE
+                prev[DELAY] = row[DELAY]
+                report.folded_double_clicks += 1
+                continue
+            # A move to where the pointer already is
+            if flags == FLAG_MOVE and _pointer_step(prev) and _same_place(prev, row):
+                prev[DELAY] += row[DELAY]
+                report.dropped_moves += 1
+                continue
+            # Zero delay moves overridden by this pointer action
+            if not in_drag and _pointer_step(row):
+                while out and out[-1][FLAGS] == FLAG_MOVE and out[-1][DELAY] == 0 and _pointer_step(out[-1]):
+                    out.pop()
+                    report.dropped_moves += 1
+
+        if flags & FLAG_MOUSE_DOWN:
+            in_drag = True
+        elif flags & FLAG_MOUSE_UP:
+            in_drag = False
+        out.append(row)
+
+    optimized = ClickStore()
+    for code, anchor in getattr(steps, 'anchors', {}).items():
+        optimized.put_anchor(code, anchor)
+    for code, condition in getattr(steps, 'conditions', {}).items():
+        optimized.put_condition(code, condition)
+    optimized.layout = getattr(steps, 'layout', None)
+    for row in out:
+        for (name, _), value in zip(COLUMNS, row):
+            getattr(optimized, name).append(value)
+
+    report.steps_after = len(optimized)
+    report.cycle_s_before = estimate_cycle_time(steps, step_time)
+    report.cycle_s_after = estimate_cycle_time(optimized, step_time)
+    return optimized, report
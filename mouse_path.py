@@ -0,0 +1,112 @@
+"""
+Streaming simplification of recorded mouse paths.
+
+A mouse reports motion hundreds of times per second, so recording every
+point would turn a few seconds of movement into thousands of steps.
+PathSimplifier keeps only the points needed to stay within `tolerance`
+pixels of the real path (Ramer-Douglas-Peucker). It works on a window of
+at most `window` buffered points, so memory and the cost per point stay
+bounded however long the mouse keeps moving; the last kept point of each
+window starts the next one.
+
+Points are (t_ns, x, y); the timestamps of kept points are preserved so
+replay can move along the path with the recorded timing.
+"""
+
+
+MOVE_TOLERANCE = 2.0  # pixels
+PATH_WINDOW = 256  # buffered points before a window is simplified
+
+
+def _distance_sq(point, start, end):
+    """Squared distance from point to the segment start-end"""
+    _, px, py = point
+    _, ax, ay = start
+    _, bx, by = end
+    dx = bx - ax
+    dy = by - ay
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        return (px - ax) ** 2 + (py - ay) ** 2
+    t = ((px - ax) * dx + (py - ay) * dy) / length_sq
+    t = max(0.0, min(1.0, t))
+    cx = ax + t * dx - px
+    cy = ay + t * dy - py
+    return cx * cx + cy * cy
+
+
+def simplify(points, tolerance=MOVE_TOLERANCE):
+    """
+    Ramer-Douglas-Peucker over a list of (t_ns, x, y) points.
+    The first and last points are always kept.
+    """
+    if len(points) < 3:
+        return list(points)
+    tolerance_sq = tolerance * tolerance
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        max_sq = -1.0
+        index = first
+        start, end = points[first], points[last]
+        for i in range(first + 1, last):
+            d = _distance_sq(points[i], start, end)
+            if d > max_sq:
+                max_sq = d
+                index = i
+        if max_sq > tolerance_sq:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+class PathSimplifier:
+    """
+    Incremental simplifier for one stream of mouse positions.
+    add() and flush() return the points that became final, in order.
+    """
+
+    def __init__(self, tolerance=MOVE_TOLERANCE, window=PATH_WINDOW):
+        self.tolerance = tolerance
+        self.window = max(3, window)
+        self._points = []
+
+    def reset(self, anchor=None):
+        """
+        Start a new path. `anchor` is a point that was already emitted (e.g.
+        where a click happened); it anchors the path but isn't returned again.
+        """
+        self._points = [anchor] if anchor is not None else []
+
+    @property
+    def last(self):
+        """The most recent point, or None"""
+        return self._points[-1] if self._points else None
+
+    def add(self, t_ns, x, y):
+        points = self._points
+        if points and points[-1][1] == x and points[-1][2] == y:
+            return []  # no movement
+        point = (t_ns, x, y)
+        if not points:
+            # The first point of a path is final right away
+            points.append(point)
+            return [point]
+        points.append(point)
+        if len(points) < self.window:
+            return []
+        kept = simplify(points, self.tolerance)
+        self._points = [kept[-1]]
+        return kept[1:]
+
+    def flush(self):
+        """Finish the path, returning its remaining points"""
+        points = self._points
+        if len(points) < 2:
+            return []
+        kept = simplify(points, self.tolerance)
+        self._points = [kept[-1]]
+        return kept[1:]
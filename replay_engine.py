@@ -0,0 +1,167 @@
+"""
+Replay engine: owns the replay thread and its run state.
+
+Only one run can be active at a time. All waiting during a run goes through
+ReplayEngine.wait_until(), which blocks on a condition variable, so stop()
+and pause() take effect immediately instead of after the current delay.
+
+State changes are reported to subscribers (see subscribe()) after the lock
+is released, so a listener may safely call back into the engine.
+"""
+import threading
+import time
+
+from scheduler import SPIN_THRESHOLD_NS
+
+
+IDLE = 'idle'
+RUNNING = 'running'
+PAUSED = 'paused'
+STOPPING = 'stopping'
+
+
+class ReplayEngine:
+    """Start/pause/resume/stop control for a single replay thread"""
+
+    def __init__(self, spin_threshold_ns=SPIN_THRESHOLD_NS):
+        self.spin_threshold_ns = spin_threshold_ns
+        self._cond = threading.Condition()
+        self._state = IDLE
+        self._thread = None
+        self._listeners = ()  # callbacks taking the new state
+
+    # --- state ---
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def is_running(self):
+        """True while a run is active, including while it is paused"""
+        return self._state in (RUNNING, PAUSED)
+
+    @property
+    def is_paused(self):
+        return self._state == PAUSED
+
+    @property
+    def stop_requested(self):
+        return self._state == STOPPING
+
+    # --- change notifications ---
+
+    def subscribe(self, callback):
+        """Call callback(state) after every state change"""
+        self._listeners = self._listeners + (callback,)
+
+    def unsubscribe(self, callback):
+        self._listeners = tuple(c for c in self._listeners if c != callback)
+
+    def _notify(self, state):
+        for callback in self._listeners:
+            callback(state)
+
+    # --- control ---
+
+    def start(self, target, *args):
+        """
+        Run target(*args) on a new replay thread.
+        Returns False if another run is still active.
+        """
+        with self._cond:
+            if self._state == STOPPING and self._thread is not None:
+                previous = self._thread
+            else:
+                previous = None
+        if previous is not None:
+            # A stopped run is finishing its last action, give it a moment
+            previous.join(timeout=0.5)
+
+        with self._cond:
+            if self._state != IDLE:
+                return False
+            self._state = RUNNING
+            self._thread = threading.Thread(target=self._run, args=(target, args))
+            self._thread.daemon = True
+            self._thread.start()
+        self._notify(RUNNING)
+        return True
+
+    def _run(self, target, args):
+        try:
+            target(*args)
+        finally:
+            with self._cond:
+                self._state = IDLE
+                self._thread = None
+                self._cond.notify_all()
+            self._notify(IDLE)
+
+    def stop(self):
+        """Ask the active run to stop, waking it from any wait"""
+        with self._cond:
+            if self._state not in (RUNNING, PAUSED):
+                return
+            self._state = STOPPING
+            self._cond.notify_all()
+        self._notify(STOPPING)
+
+    def pause(self):
+        with self._cond:
+            if self._state != RUNNING:
+                return
+            self._state = PAUSED
+            self._cond.notify_all()
+        self._notify(PAUSED)
+
+    def resume(self):
+        with self._cond:
+            if self._state != PAUSED:
+                return
+            self._state = RUNNING
+            self._cond.notify_all()
+        self._notify(RUNNING)
+
+    def join(self, timeout=None):
+        """Wait for the active run (if any) to finish"""
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    # --- waiting, called from the replay thread ---
+
+    def wait_until(self, deadline_ns):
+        """
+        Interruptible deadline wait used as the DeadlineScheduler waiter.
+        Returns (late_ns, paused_ns), or None if the run was stopped.
+        Time spent paused pushes the deadline back by the same amount.
+        """
+        paused_ns = 0
+        cond = self._cond
+        with cond:
+            while True:
+                if self._state == STOPPING:
+                    return None
+                if self._state == PAUSED:
+                    pause_start = time.monotonic_ns()
+                    while self._state == PAUSED:
+                        cond.wait()
+                    paused_ns += time.monotonic_ns() - pause_start
+                    continue
+                remaining = deadline_ns + paused_ns - time.monotonic_ns()
+                if remaining <= self.spin_threshold_ns:
+                    break
+                cond.wait((remaining - self.spin_threshold_ns) / 1_000_000_000)
+
+        # Spin the last stretch without the lock, still watching for stop/pause
+        deadline = deadline_ns + paused_ns
+        now = time.monotonic_ns()
+        while now < deadline:
+            if self._state != RUNNING:
+                if self._state != PAUSED:
+                    return None
+                result = self.wait_until(deadline)
+                return None if result is None else (result[0], paused_ns + result[1])
+            now = time.monotonic_ns()
+        return now - deadline, paused_ns
@@ -0,0 +1,364 @@
+"""
+Compile stage for replay.
+
+compile_plan() turns the recorded steps into a flat instruction table
+(opcode, base coordinates, per-cycle offsets, scroll amount, delay). The
+coordinates for a cycle are then computed for all steps at once, using
+NumPy when it is installed, so the replay loop only has to dispatch.
+
+A scroll step compiles to a move followed by the scroll, so the settle time
+between them is scheduled like any other delay. Recorded mouse paths
+compile to OP_PATH_MOVE, and drags to OP_MOUSE_DOWN ... OP_MOUSE_UP around them.
+
+An anchored step starts with an OP_LOCATE instruction (the anchor id is its
+amount operand) that finds the anchor on screen; the step's own
+instructions get OP_ANCHORED added, so replay shifts them by how far the
+anchor moved. Unanchored macros never pay for the shift.
+
+A wait step compiles to OP_WAIT with its condition id as the amount
+operand; replay polls the screen instead of acting.
+
+A key step compiles to OP_KEY with its key code as the amount. Runs of
+unanchored text key steps (printable characters, see keys.py) are then
+merged into one OP_TYPE instruction whose amount indexes plan.texts, so
+typing goes to the backend as one call instead of one step per key. The
+merged run keeps the delay of its last key; recorded pauses longer than
+TEXT_RUN_GAP end a run.
+"""
+from ClickStore import (FLAG_DOUBLE, FLAG_SCROLL, FLAG_MOVE, FLAG_MOUSE_DOWN, FLAG_MOUSE_UP, FLAG_WAIT, FLAG_KEY,
+                        click_flags)
+from keys import is_text, key_code
+from scheduler import seconds_to_ns
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, the plan falls back to plain lists
+    np = None
+
+
+# Opcodes, also used as indexes into the replay dispatch table
+OP_CLICK = 0
+OP_DOUBLE_CLICK = 1
+OP_SCROLL = 2
+OP_MOVE = 3
+OP_MOUSE_DOWN = 4
+OP_MOUSE_UP = 5
+OP_PATH_MOVE = 6
+OP_LOCATE = 7
+OP_WAIT = 8
+OP_KEY = 9
+OP_TYPE = 10
+# Added to the opcodes of an anchored step's instructions
+OP_ANCHORED = 16
+# Names of the base opcodes, e.g. for per-action metrics
+OP_NAMES = ('click', 'double_click', 'scroll', 'move', 'mouse_down', 'mouse_up', 'path_move', 'locate', 'wait',
+            'key', 'type')
+# Opcodes that are part of a recorded path: replay keeps their recorded
+# timing instead of adding the step time after them
+PATH_OPS = (OP_PATH_MOVE, OP_MOUSE_DOWN)
+# Opcodes never followed by the step time (anchored ones included)
+UNTIMED_OPS = PATH_OPS + (OP_LOCATE, OP_WAIT)
+
+# Time the pointer gets to settle between the move and the scroll
+SCROLL_SETTLE = 0.02
+# Text key steps recorded further apart than this (seconds) aren't merged
+TEXT_RUN_GAP = 0.5
+
+# Number of cycles computed together by ReplayPlan.iter_cycles
+DEFAULT_BLOCK = 32
+# Plans longer than this are streamed in chunks instead of whole cycles,
+# so huge macros never hold a full cycle of row tuples in memory
+STREAM_THRESHOLD = 65536
+CHUNK_SIZE = 4096
+
+
+def _opcode(flags):
+    """Scroll wins over double click, matching the old replay loop"""
+    if flags & FLAG_WAIT:
+        return OP_WAIT
+    if flags & FLAG_KEY:
+        return OP_KEY
+    if flags & FLAG_SCROLL:
+        return OP_SCROLL
+    if flags & FLAG_DOUBLE:
+        return OP_DOUBLE_CLICK
+    if flags & FLAG_MOVE:
+        return OP_PATH_MOVE
+    if flags & FLAG_MOUSE_DOWN:
+        return OP_MOUSE_DOWN
+    if flags & FLAG_MOUSE_UP:
+        return OP_MOUSE_UP
+    return OP_CLICK
+
+
+def _tolist(column):
+    return column.tolist() if hasattr(column, 'tolist') else list(column)
+
+
+class ReplayPlan:
+    """
+    Flat instruction table produced by compile_plan().
+    Columns are NumPy arrays when NumPy is installed, lists otherwise.
+    """
+
+    def __init__(self, ops, x, y, offset_x, offset_y, scroll_amount, delay_ns, steps, anchors=None,
+                 conditions=None, texts=None):
+        if np is not None:
+            as_column = lambda values: np.asarray(values, dtype=np.int64)
+        else:
+            as_column = list
+        self.ops = as_column(ops)
+        self.x = as_column(x)
+        self.y = as_column(y)
+        self.offset_x = as_column(offset_x)
+        self.offset_y = as_column(offset_y)
+        self.scroll_amount = as_column(scroll_amount)
+        # Delays in nanoseconds, as used by the deadline scheduler
+        self.delay_ns = as_column(delay_ns)
+        # Index of the recorded step each instruction came from
+        self.steps = as_column(steps)
+        # Anchor id -> anchors.Anchor, for OP_LOCATE
+        self.anchors = anchors or {}
+        # Condition id -> screen_wait.WaitCondition, for OP_WAIT
+        self.conditions = conditions or {}
+        # Merged key runs, indexed by the amount of OP_TYPE
+        self.texts = texts or []
+        if np is not None:
+            self.has_offsets = bool(self.offset_x.any() or self.offset_y.any())
+        else:
+            self.has_offsets = any(self.offset_x) or any(self.offset_y)
+        self._static_rows = None
+        self._row_lists = None
+
+    def __len__(self):
+        return len(self.ops)
+
+    def coords_block(self, first_cycle, count, start=0, end=None):
+        """
+        Return (xs, ys) for `count` cycles starting at `first_cycle` (1-based),
+        for instructions start:end. Each is a list with one row per cycle.
+        """
+        end = len(self.ops) if end is None else end
+        if np is not None:
+            k = np.arange(first_cycle - 1, first_cycle - 1 + count, dtype=np.int64)[:, None]
+            xs = self.x[None, start:end] + self.offset_x[None, start:end] * k
+            ys = self.y[None, start:end] + self.offset_y[None, start:end] * k
+            return xs.tolist(), ys.tolist()
+
+        xs, ys = [], []
+        for k in range(first_cycle - 1, first_cycle - 1 + count):
+            xs.append([x + ox * k for x, ox in zip(self.x[start:end], self.offset_x[start:end])])
+            ys.append([y + oy * k for y, oy in zip(self.y[start:end], self.offset_y[start:end])])
+        return xs, ys
+
+    def _static_columns(self):
+        """ops, scroll amounts and delays as plain lists, cached"""
+        if self._row_lists is None:
+            self._row_lists = (_tolist(self.ops), _tolist(self.scroll_amount), _tolist(self.delay_ns))
+        return self._row_lists
+
+    def cycle_rows(self, cycle):
+        """Instruction rows (op, x, y, scroll_amount, delay_ns) for one cycle"""
+        ops, amounts, delays = self._static_columns()
+        xs, ys = self.coords_block(cycle, 1)
+        return list(zip(ops, xs[0], ys[0], amounts, delays))
+
+    def stream_rows(self, cycle, chunk=CHUNK_SIZE):
+        """Like cycle_rows, but generated lazily chunk by chunk"""
+        for start in range(0, len(self.ops), chunk):
+            end = min(start + chunk, len(self.ops))
+            xs, ys = self.coords_block(cycle, 1, start, end)
+            yield from zip(_tolist(self.ops[start:end]), xs[0], ys[0],
+                           _tolist(self.scroll_amount[start:end]), _tolist(self.delay_ns[start:end]))
+
+    def iter_cycles(self, first_cycle=1, block=DEFAULT_BLOCK):
+        """
+        Yield (cycle, rows) forever, computing coordinates lazily in blocks.
+        Plans without offsets reuse the same rows every cycle; plans longer
+        than STREAM_THRESHOLD yield a row generator instead of a list.
+        """
+        cycle = first_cycle
+        if len(self.ops) > STREAM_THRESHOLD:
+            while True:
+                yield cycle, self.stream_rows(cycle)
+                cycle += 1
+
+        if not self.has_offsets:
+            if self._static_rows is None:
+                self._static_rows = self.cycle_rows(1)
+            while True:
+                yield cycle, self._static_rows
+                cycle += 1
+
+        ops, amounts, delays = self._static_columns()
+        while True:
+            xs, ys = self.coords_block(cycle, block)
+            for row_x, row_y in zip(xs, ys):
+                yield cycle, list(zip(ops, row_x, row_y, amounts, delays))
+                cycle += 1
+
+
+def _step_columns(steps):
+    """
+    Return the step columns (x, y, delay, offset_x, offset_y, scroll_amount,
+    flags, anchor) as a dict, and the anchors and wait conditions they refer
+    to. Columnar sources (ClickStore, mapped macro files) provide them
+    directly; lists of Click objects are converted.
+    """
+    if hasattr(steps, 'columns'):
+        return steps.columns(), getattr(steps, 'anchors', {}), getattr(steps, 'conditions', {})
+
+    anchors, anchor_ids = {}, {}
+    conditions, condition_ids = {}, {}
+    columns = {name: [] for name in ('x', 'y', 'delay', 'offset_x', 'offset_y', 'scroll_amount', 'flags', 'anchor')}
+    for step in steps:
+        columns['x'].append(int(step.x))
+        columns['y'].append(int(step.y))
+        columns['delay'].append(getattr(step, 'delay', 0))
+        columns['offset_x'].append(int(getattr(step, 'offset_x', 0)))
+        columns['offset_y'].append(int(getattr(step, 'offset_y', 0)))
+        condition = getattr(step, 'condition', None)
+        if condition is not None:
+            if condition not in condition_ids:
+                condition_ids[condition] = len(condition_ids) + 1
+                conditions[condition_ids[condition]] = condition
+            columns['scroll_amount'].append(condition_ids[condition])
+        elif getattr(step, 'key', None) is not None:
+            columns['scroll_amount'].append(key_code(step.key))
+        else:
+            columns['scroll_amount'].append(int(getattr(step, 'scroll_amount', 0)))
+        columns['flags'].append(click_flags(step))
+        anchor = getattr(step, 'anchor', None)
+        if anchor is not None and anchor not in anchor_ids:
+            anchor_ids[anchor] = len(anchor_ids) + 1
+            anchors[anchor_ids[anchor]] = anchor
+        columns['anchor'].append(anchor_ids[anchor] if anchor is not None else 0)
+    return columns, anchors, conditions
+
+
+def _anchor_column(columns, n):
+    if 'anchor' in columns:
+        return columns['anchor']
+    return [0] * n
+
+
+def _compile_numpy(columns, anchors, conditions):
+    flags = np.asarray(columns['flags'], dtype=np.uint8)
+    n = len(flags)
+    anchor = np.asarray(_anchor_column(columns, n), dtype=np.int64)
+    anchored = anchor != 0
+    # Same precedence as _opcode()
+    bits = (FLAG_WAIT, FLAG_KEY, FLAG_SCROLL, FLAG_DOUBLE, FLAG_MOVE, FLAG_MOUSE_DOWN, FLAG_MOUSE_UP)
+    op = np.select([(flags & bit) != 0 for bit in bits],
+                   [OP_WAIT, OP_KEY, OP_SCROLL, OP_DOUBLE_CLICK, OP_PATH_MOVE, OP_MOUSE_DOWN, OP_MOUSE_UP],
+                   OP_CLICK).astype(np.int64)
+    is_scroll = op == OP_SCROLL
+    counts = 1 + is_scroll.astype(np.int64) + anchored.astype(np.int64)
+    index = np.repeat(np.arange(n, dtype=np.int64), counts)
+    starts = np.cumsum(counts) - counts
+
+    shift = np.where(anchored, OP_ANCHORED, 0)
+    ops = (op + shift)[index]
+    amounts = np.asarray(columns['scroll_amount'], dtype=np.int64)[index]
+    delay_ns = np.rint(np.asarray(columns['delay'], dtype=np.float64) * 1e9).astype(np.int64)[index]
+    # Anchored steps start by locating their anchor
+    locate_positions = starts[anchored]
+    ops[locate_positions] = OP_LOCATE
+    amounts[locate_positions] = anchor[anchored]
+    delay_ns[locate_positions] = 0
+    # Then every scroll step moves to its position
+    move_positions = (starts + anchored)[is_scroll]
+    ops[move_positions] = OP_MOVE + shift[is_scroll]
+    amounts[move_positions] = 0
+    delay_ns[move_positions] = seconds_to_ns(SCROLL_SETTLE)
+
+    return ReplayPlan(
+        ops,
+        np.asarray(columns['x'], dtype=np.int64)[index],
+        np.asarray(columns['y'], dtype=np.int64)[index],
+        np.asarray(columns['offset_x'], dtype=np.int64)[index],
+        np.asarray(columns['offset_y'], dtype=np.int64)[index],
+        amounts,
+        delay_ns,
+        index,
+        anchors,
+        conditions,
+    )
+
+
+def _compile_python(columns, anchors, conditions):
+    ops, xs, ys, oxs, oys, amounts, delays, indexes = [], [], [], [], [], [], [], []
+
+    def emit(op, x, y, ox, oy, amount, delay, index):
+        ops.append(op)
+        xs.append(x)
+        ys.append(y)
+        oxs.append(ox)
+        oys.append(oy)
+        amounts.append(amount)
+        delays.append(seconds_to_ns(delay))
+        indexes.append(index)
+
+    rows = zip(columns['flags'], columns['x'], columns['y'], columns['offset_x'],
+               columns['offset_y'], columns['scroll_amount'], columns['delay'],
+               _anchor_column(columns, len(columns['flags'])))
+    for index, (flags, x, y, ox, oy, amount, delay, anchor) in enumerate(rows):
+        op = _opcode(flags)
+        shift = 0
+        if anchor:
+            emit(OP_LOCATE, x, y, ox, oy, anchor, 0, index)
+            shift = OP_ANCHORED
+        if op == OP_SCROLL:
+            # Some platforms ignore x/y in scroll, so move there first
+            emit(OP_MOVE + shift, x, y, ox, oy, 0, SCROLL_SETTLE, index)
+        emit(op + shift, x, y, ox, oy, amount, delay, index)
+    return ReplayPlan(ops, xs, ys, oxs, oys, amounts, delays, indexes, anchors, conditions)
+
+
+def _coalesce_text(plan):
+    """Merge runs of text OP_KEY instructions into OP_TYPE, see the module docstring"""
+    ops, amounts, delays = plan._static_columns()
+    xs, ys, oxs, oys, steps = (_tolist(column) for column in
+                               (plan.x, plan.y, plan.offset_x, plan.offset_y, plan.steps))
+    gap_ns = seconds_to_ns(TEXT_RUN_GAP)
+    keep, new_ops, new_amounts, new_delays, texts = [], [], [], [], []
+    n = len(ops)
+    i = 0
+    while i < n:
+        end = i
+        if ops[i] == OP_KEY and is_text(amounts[i]):
+            while (end + 1 < n and ops[end + 1] == OP_KEY and is_text(amounts[end + 1])
+                   and delays[end] <= gap_ns):
+                end += 1
+        keep.append(i)
+        if end > i:
+            new_ops.append(OP_TYPE)
+            new_amounts.append(len(texts))
+            new_delays.append(delays[end])
+            texts.append(''.join(chr(code) for code in amounts[i:end + 1]))
+        else:
+            new_ops.append(ops[i])
+            new_amounts.append(amounts[i])
+            new_delays.append(delays[i])
+        i = end + 1
+    return ReplayPlan(new_ops, [xs[i] for i in keep], [ys[i] for i in keep], [oxs[i] for i in keep],
+                      [oys[i] for i in keep], new_amounts, new_delays, [steps[i] for i in keep],
+                      plan.anchors, plan.conditions, texts)
+
+
+def compile_plan(steps, coalesce_text=True):
+    """
+    Compile recorded steps into a ReplayPlan. Accepts a ClickStore, a mapped
+    macro file or any list of Click-like objects.
+    With coalesce_text, runs of text key steps become OP_TYPE instructions.
+    """
+    columns, anchors, conditions = _step_columns(steps)
+    if np is not None:
+        plan = _compile_numpy(columns, anchors, conditions)
+        has_keys = bool((plan.ops == OP_KEY).any())
+    else:
+        plan = _compile_python(columns, anchors, conditions)
+        has_keys = OP_KEY in plan.ops
+    if coalesce_text and has_keys:
+        plan = _coalesce_text(plan)
+    return plan
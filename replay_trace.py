@@ -0,0 +1,110 @@
+"""
+Opt-in per-step replay tracing, exported as Chrome Trace Event JSON.
+
+A traced replay records a complete ('X') event for every cycle, every
+recorded step and every phase of a step:
+  - delay:         the scheduled wait before an instruction (step time plus
+                   the previous step's delay)
+  - scroll settle: the wait between the pre-scroll move and the scroll
+  - the backend call itself, named after the opcode (click, scroll, ...)
+Events are tagged with the cycle number and the step's index in the click
+list, so a slow step can be found in the editor. Open the exported file in
+Perfetto (ui.perfetto.dev) or chrome://tracing.
+
+Tracing is off unless asked for; the untraced replay loop doesn't change.
+"""
+import json
+import os
+import threading
+import time
+
+
+# Events kept per trace; further events are counted as dropped
+MAX_EVENTS = 1_000_000
+
+
+class ReplayTracer:
+    """Collects trace events of one replay run"""
+
+    def __init__(self, max_events=MAX_EVENTS):
+        self.max_events = max_events
+        self.events = []
+        self.dropped = 0
+        self.metadata = {}
+        self.pid = os.getpid()
+        self.tid = threading.get_ident()
+        self.origin_ns = time.perf_counter_ns()
+
+    def complete(self, name, category, start_ns, end_ns, **args):
+        """A span from start_ns to end_ns (time.perf_counter_ns() values)"""
+        if len(self.events) >= self.max_events:
+            self.dropped += 1
+            return
+        self.events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (start_ns - self.origin_ns) / 1000,
+            'dur': (end_ns - start_ns) / 1000,
+            'pid': self.pid,
+            'tid': self.tid,
+            'args': args,
+        })
+
+    def instant(self, name, category, t_ns, **args):
+        if len(self.events) >= self.max_events:
+            self.dropped += 1
+            return
+        self.events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'i',
+            's': 't',
+            'ts': (t_ns - self.origin_ns) / 1000,
+            'pid': self.pid,
+            'tid': self.tid,
+            'args': args,
+        })
+
+    def to_json(self):
+        """The trace as a Chrome Trace Event Format object"""
+        names = [
+            {'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'tid': self.tid, 'args': {'name': 'replay'}},
+            {'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': self.tid, 'args': {'name': 'replay engine'}},
+        ]
+        other = dict(self.metadata)
+        other['dropped_events'] = self.dropped
+        return {'traceEvents': names + self.events, 'displayTimeUnit': 'ms', 'otherData': other}
+
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_json(), f)
+        return path
+
+
+class StepSpans:
+    """
+    Turns the instruction stream of a traced cycle into per-step spans:
+    instructions of the same recorded step (e.g. locate, move, scroll) are
+    grouped under one 'step N' event.
+    """
+
+    def __init__(self, tracer, cycle):
+        self.tracer = tracer
+        self.cycle = cycle
+        self.step = None
+        self.start_ns = 0
+        self.end_ns = 0
+
+    def add(self, step, start_ns, end_ns):
+        if step != self.step:
+            self.close()
+            self.step = step
+            self.start_ns = start_ns
+        self.end_ns = end_ns
+
+    def close(self):
+        if self.step is not None:
+            self.tracer.complete(f"step {self.step + 1}", 'step', self.start_ns, self.end_ns,
+                                 cycle=self.cycle, step=self.step)
+            self.step = None
@@ -0,0 +1,129 @@
+"""
+Deadline based timing for replay.
+
+Every action is planned against an absolute time.monotonic_ns() deadline
+instead of chaining relative sleeps, so errors don't accumulate over long
+loops. Waits sleep until shortly before the deadline and spin for the rest,
+which gives sub-millisecond accuracy without burning a core.
+"""
+import math
+import time
+
+
+# Spin (instead of sleeping) for the last part of every wait
+SPIN_THRESHOLD_NS = 1_500_000
+# If we fall further behind than this, re-base the schedule instead of bursting
+RESYNC_THRESHOLD_NS = 50_000_000
+
+
+def seconds_to_ns(seconds):
+    return int(round(seconds * 1_000_000_000))
+
+
+def wait_until(deadline_ns, spin_threshold_ns=SPIN_THRESHOLD_NS):
+    """
+    Block until monotonic_ns() reaches deadline_ns.
+    Returns how late we were in nanoseconds (0 or more).
+    """
+    now = time.monotonic_ns()
+    remaining = deadline_ns - now
+    if remaining > spin_threshold_ns:
+        time.sleep((remaining - spin_threshold_ns) / 1_000_000_000)
+        now = time.monotonic_ns()
+    while now < deadline_ns:
+        now = time.monotonic_ns()
+    return now - deadline_ns
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class LatenessStats:
+    """Collects per-step lateness samples (ns) and summarizes them"""
+
+    def __init__(self):
+        self.samples = []
+
+    def record(self, late_ns):
+        self.samples.append(late_ns)
+
+    def reset(self):
+        self.samples = []
+
+    def summary(self):
+        """Return count and p50/p99/max lateness in milliseconds"""
+        values = sorted(self.samples)
+        return {
+            'count': len(values),
+            'p50_ms': percentile(values, 0.50) / 1e6,
+            'p99_ms': percentile(values, 0.99) / 1e6,
+            'max_ms': (values[-1] if values else 0) / 1e6,
+        }
+
+
+class DeadlineScheduler:
+    """
+    Keeps the absolute deadline of the next action.
+    Call start() once, then wait() before and advance() after each action.
+
+    waiter(deadline_ns) does the actual waiting and returns (late_ns, paused_ns),
+    or None to abort; the default blocks uninterruptibly with wait_until().
+    """
+
+    def __init__(self, spin_threshold_ns=SPIN_THRESHOLD_NS, resync_threshold_ns=RESYNC_THRESHOLD_NS, waiter=None):
+        self.spin_threshold_ns = spin_threshold_ns
+        self.resync_threshold_ns = resync_threshold_ns
+        self.waiter = waiter or self._blocking_wait
+        self.next_deadline_ns = None
+        self.stats = LatenessStats()
+        self.resyncs = 0
+
+    def _blocking_wait(self, deadline_ns):
+        return wait_until(deadline_ns, self.spin_threshold_ns), 0
+
+    def start(self):
+        self.next_deadline_ns = time.monotonic_ns()
+        self.stats.reset()
+        self.resyncs = 0
+
+    def wait(self):
+        """
+        Wait for the next deadline and record how late we were.
+        Returns the lateness in ns, or None if the waiter aborted.
+        """
+        result = self.waiter(self.next_deadline_ns)
+        if result is None:
+            return None
+        late, paused = result
+        # Time spent paused shifts the rest of the schedule
+        self.next_deadline_ns += paused
+        self.stats.record(late)
+        if late > self.resync_threshold_ns:
+            # An action overran badly: plan the rest from now on
+            self.next_deadline_ns += late
+            self.resyncs += 1
+        return late
+
+    def advance(self, delta_ns):
+        """Move the next deadline forward by delta_ns"""
+        self.next_deadline_ns += delta_ns
+
+    def rebase(self):
+        """
+        Plan the rest from now on, after an action whose length isn't known
+        in advance (a wait step); the time it took doesn't count as lateness.
+        """
+        self.next_deadline_ns = time.monotonic_ns()
+
+    def cycle_report(self):
+        """Summarize lateness since the last report and start a new window"""
+        report = self.stats.summary()
+        report['resyncs'] = self.resyncs
+        self.stats.reset()
+        self.resyncs = 0
+        return report
@@ -0,0 +1,309 @@
+"""
+Screen layouts and load-time coordinate mapping.
+
+Steps hold raw screen pixels, so a macro only replays where it was recorded
+if the monitors are the same. A recording therefore keeps the ScreenLayout
+it was made on: the monitor rectangles (primary first), the desktop scale
+factor and, optionally, the origin of a reference window the steps were
+recorded against.
+
+When a macro is loaded for a different layout, LayoutTransform maps every
+step once, before replay, with an affine map (scale + translate) per
+monitor:
+  - without reference windows, a step on source monitor i is stretched onto
+    target monitor i (the primary if the target has fewer monitors), so it
+    keeps its relative position on the screen; steps outside every monitor
+    use the primary's map
+  - when both layouts have a window origin, steps are moved with the window
+    and scaled by the ratio of the scale factors only, since a window's
+    content keeps its pixel size unless the desktop scaling changes
+Offsets are scaled (not moved), and anchor reference points move with the
+steps. The columns are mapped in one NumPy pass; without NumPy, step by
+step. Pointer coordinates and screen sizes are both in the input backend's
+(logical) pixels, so a change of scaling factor shows up as a different
+monitor size and is covered by the per-monitor map.
+
+Monitors come from RandR when python-xlib and an X server are available,
+otherwise from the backend's screen size (the primary monitor only).
+"""
+import struct
+from array import array
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, columns are then mapped step by step
+    np = None
+
+
+DEFAULT_DPI = 96.0  # Xft.dpi of a scale factor of 1
+
+# Serialized form used by binary macros: f64 scale, u8 has window,
+# i32 window x, i32 window y, u16 monitor count, then per monitor
+# i32 x, i32 y, i32 width, i32 height
+LAYOUT_HEADER = struct.Struct('<dBiiH')
+MONITOR = struct.Struct('<iiii')
+
+
+class ScreenLayout:
+    """
+    Monitor rectangles (x, y, width, height), primary first, plus the scale
+    factor and the reference window origin (x, y) or None.
+    """
+    __slots__ = ('monitors', 'window', 'scale')
+
+    def __init__(self, monitors, window=None, scale=1.0):
+        monitors = tuple(tuple(int(v) for v in monitor) for monitor in monitors)
+        if not monitors:
+            raise ValueError("a screen layout needs at least one monitor")
+        for monitor in monitors:
+            if len(monitor) != 4 or monitor[2] <= 0 or monitor[3] <= 0:
+                raise ValueError(f"bad monitor rectangle {monitor}")
+        if scale <= 0:
+            raise ValueError(f"bad scale factor {scale}")
+        self.monitors = monitors
+        self.window = None if window is None else (int(window[0]), int(window[1]))
+        self.scale = float(scale)
+
+    def _fields(self):
+        return self.monitors, self.window, self.scale
+
+    def __eq__(self, other):
+        return isinstance(other, ScreenLayout) and self._fields() == other._fields()
+
+    def __hash__(self):
+        return hash(self._fields())
+
+    def __repr__(self):
+        return f"ScreenLayout({self})"
+
+    def __str__(self):
+        text = ', '.join(f"{w}x{h}+{x}+{y}" for x, y, w, h in self.monitors)
+        if self.scale != 1.0:
+            text += f" @{self.scale:g}x"
+        if self.window is not None:
+            text += f" window {self.window[0]},{self.window[1]}"
+        return text
+
+    def with_window(self, window):
+        """The same monitors with another reference window origin"""
+        return ScreenLayout(self.monitors, window, self.scale)
+
+    def monitor_at(self, x, y):
+        """Index of the monitor holding (x, y); the primary (0) if none does"""
+        for i, (left, top, width, height) in enumerate(self.monitors):
+            if left <= x < left + width and top <= y < top + height:
+                return i
+        return 0
+
+    # --- serialization ---
+
+    def to_dict(self):
+        return {
+            'monitors': [list(monitor) for monitor in self.monitors],
+            'window': None if self.window is None else list(self.window),
+            'scale': self.scale,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['monitors'], data.get('window'), data.get('scale', 1.0))
+
+    def pack(self):
+        window_x, window_y = self.window or (0, 0)
+        data = LAYOUT_HEADER.pack(self.scale, self.window is not None, window_x, window_y, len(self.monitors))
+        return data + b''.join(MONITOR.pack(*monitor) for monitor in self.monitors)
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        """Returns (layout, offset after it); raises ValueError if truncated"""
+        if offset + LAYOUT_HEADER.size > len(buffer):
+            raise ValueError("truncated screen layout")
+        scale, has_window, window_x, window_y, count = LAYOUT_HEADER.unpack_from(buffer, offset)
+        offset += LAYOUT_HEADER.size
+        if offset + count * MONITOR.size > len(buffer):
+            raise ValueError("truncated screen layout")
+        monitors = [MONITOR.unpack_from(buffer, offset + i * MONITOR.size) for i in range(count)]
+        window = (window_x, window_y) if has_window else None
+        return cls(monitors, window, scale), offset + count * MONITOR.size
+
+
+def layout_from_dict(data):
+    return ScreenLayout.from_dict(data) if data else None
+
+
+# --- detection ---
+
+def _xft_scale(display, root):
+    """Desktop scale factor from the Xft.dpi resource, 1.0 if it isn't set"""
+    from Xlib import X
+    prop = root.get_full_property(display.intern_atom('RESOURCE_MANAGER'), X.AnyPropertyType)
+    if prop is None:
+        return 1.0
+    value = prop.value.decode('utf-8', 'replace') if isinstance(prop.value, bytes) else str(prop.value)
+    for line in value.splitlines():
+        name, _, setting = line.partition(':')
+        if name.strip() == 'Xft.dpi':
+            try:
+                return float(setting) / DEFAULT_DPI
+            except ValueError:
+                break
+    return 1.0
+
+
+def _x_layout(display_name=None):
+    """The X server's layout: RandR monitors, or the whole screen as one"""
+    from Xlib import display as xdisplay
+    display = xdisplay.Display(display_name)
+    try:
+        screen = display.screen()
+        root = screen.root
+        monitors = []
+        if display.has_extension('RANDR'):
+            for monitor in root.xrandr_get_monitors(is_active=True).monitors:
+                monitors.append((not monitor.primary, monitor.x, monitor.y,
+                                 monitor.width_in_pixels, monitor.height_in_pixels))
+        monitors = [rect for _, *rect in sorted(monitors)]
+        if not monitors:
+            monitors = [(0, 0, screen.width_in_pixels, screen.height_in_pixels)]
+        return ScreenLayout(monitors, scale=_xft_scale(display, root))
+    finally:
+        display.close()
+
+
+def detect_layout(screen_size=None, window=None):
+    """
+    The current ScreenLayout, or None if it can't be found out.
+    `screen_size` is a callable returning (width, height), used when there
+    is no X server to ask (typically an InputBackend's screen_size); it is
+    only called then, so a backend can be created lazily.
+    """
+    try:
+        layout = _x_layout()
+    except Exception:  # no python-xlib, no X server, or it refused us
+        layout = None
+    if layout is None and screen_size is not None:
+        try:
+            width, height = screen_size()
+        except Exception:  # no display at all
+            width = height = 0
+        if width > 0 and height > 0:
+            layout = ScreenLayout([(0, 0, width, height)])
+    if layout is not None and window is not None:
+        layout = layout.with_window(window)
+    return layout
+
+
+# --- mapping ---
+
+def _column(values, like):
+    """Mapped values in the container type of the column they replace"""
+    if isinstance(like, array):
+        column = array(like.typecode)
+        if np is not None:
+            column.frombytes(values.astype(np.dtype(like.typecode)).tobytes())
+        else:
+            column.extend(values)
+        return column
+    if np is not None and not isinstance(like, np.ndarray):
+        return values.tolist()
+    return values
+
+
+class LayoutTransform:
+    """
+    Maps coordinates recorded on `source` to `target`. `maps` holds one
+    (scale x, translate x, scale y, translate y) per source monitor, or a
+    single one in window mode.
+    """
+
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.window_mode = source.window is not None and target.window is not None
+        if self.window_mode:
+            k = target.scale / source.scale
+            (sx, sy), (tx, ty) = source.window, target.window
+            self.maps = ((k, tx - sx * k, k, ty - sy * k),)
+            return
+        maps = []
+        for i, (sx, sy, sw, sh) in enumerate(source.monitors):
+            tx, ty, tw, th = target.monitors[i if i < len(target.monitors) else 0]
+            ax, ay = tw / sw, th / sh
+            maps.append((ax, tx - sx * ax, ay, ty - sy * ay))
+        self.maps = tuple(maps)
+
+    @property
+    def is_identity(self):
+        return all(m == (1.0, 0.0, 1.0, 0.0) for m in self.maps)
+
+    def _map_of(self, x, y):
+        return self.maps[0] if len(self.maps) == 1 else self.maps[self.source.monitor_at(x, y)]
+
+    def point(self, x, y):
+        ax, bx, ay, by = self._map_of(x, y)
+        return int(round(x * ax + bx)), int(round(y * ay + by))
+
+    def offset(self, x, y, offset_x, offset_y):
+        """A per-cycle offset of a step at (x, y)"""
+        ax, _, ay, _ = self._map_of(x, y)
+        return int(round(offset_x * ax)), int(round(offset_y * ay))
+
+    def anchors(self, anchors):
+        """Anchors (id -> Anchor) with their reference points mapped"""
+        from anchors import Anchor
+        mapped = {}
+        for code, anchor in anchors.items():
+            ref_x, ref_y = self.point(anchor.ref_x, anchor.ref_y)
+            mapped[code] = Anchor(ref_x, ref_y, anchor.width, anchor.height, anchor.pixels)
+        return mapped
+
+    def columns(self, columns):
+        """
+        A copy of a step columns dict (see ClickStore.columns) with x, y and
+        the offsets mapped; other columns are shared, not copied.
+        """
+        mapped = dict(columns)
+        if np is None:
+            xs, ys = [], []
+            offsets_x, offsets_y = [], []
+            for x, y, offset_x, offset_y in zip(columns['x'], columns['y'],
+                                                columns['offset_x'], columns['offset_y']):
+                new_x, new_y = self.point(x, y)
+                new_ox, new_oy = self.offset(x, y, offset_x, offset_y)
+                xs.append(new_x)
+                ys.append(new_y)
+                offsets_x.append(new_ox)
+                offsets_y.append(new_oy)
+            for name, values in (('x', xs), ('y', ys), ('offset_x', offsets_x), ('offset_y', offsets_y)):
+                mapped[name] = _column(values, columns[name])
+            return mapped
+
+        x = np.asarray(columns['x'], dtype=np.float64)
+        y = np.asarray(columns['y'], dtype=np.float64)
+        maps = np.array(self.maps, dtype=np.float64)
+        if len(maps) == 1:
+            ax, bx, ay, by = maps[0]
+        else:
+            monitor = np.zeros(len(x), dtype=np.intp)
+            # Assigned last to first, so the first monitor holding a step wins
+            for i in range(len(self.source.monitors) - 1, -1, -1):
+                left, top, width, height = self.source.monitors[i]
+                monitor[(x >= left) & (x < left + width) & (y >= top) & (y < top + height)] = i
+            ax, bx, ay, by = maps[monitor].T
+        values = {
+            'x': x * ax + bx,
+            'y': y * ay + by,
+            'offset_x': np.asarray(columns['offset_x'], dtype=np.float64) * ax,
+            'offset_y': np.asarray(columns['offset_y'], dtype=np.float64) * ay,
+        }
+        for name, value in values.items():
+            mapped[name] = _column(np.rint(value).astype(np.int32), columns[name])
+        return mapped
+
+
+def layout_transform(source, target):
+    """The LayoutTransform from source to target, or None if there is nothing to map"""
+    if source is None or target is None or source == target:
+        return None
+    transform = LayoutTransform(source, target)
+    return None if transform.is_identity else transform
@@ -0,0 +1,271 @@
+"""
+Wait-for-screen-condition steps.
+
+A wait step replaces a fixed delay: replay holds at the step until a small
+screen region changes, shows a color, or looks exactly like it did when the
+step was made (hash), then goes on at once. A timeout bounds the wait.
+
+Only the step's region is captured. Polling starts fast and backs off
+geometrically; once a condition has been waited for, ScreenWaiter remembers
+roughly how long it took and sleeps through most of that before polling
+again, so long waits cost a handful of captures instead of hundreds.
+
+The region's top-left corner is the step's x/y, so per-cycle offsets and
+anchors move it like any other step.
+"""
+import hashlib
+import struct
+import time
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, wait steps then can't be replayed
+    np = None
+
+
+CHANGE = 'change'  # region differs from how it looked when the wait started
+COLOR = 'color'  # region's mean color is within tolerance of a color
+HASH = 'hash'  # region is pixel-identical to when the step was made
+KINDS = (CHANGE, COLOR, HASH)
+
+WAIT_REGION = 16  # default region side, pixels
+WAIT_TIMEOUT = 10.0  # default timeout, seconds
+CHANGE_TOLERANCE = 2.0  # mean absolute difference (0-255) that counts as a change
+COLOR_TOLERANCE = 10.0  # distance from the target color (0-255 per channel)
+
+POLL_MIN = 0.005  # first poll interval, seconds
+POLL_MAX = 0.25  # polling backs off up to this interval
+POLL_BACKOFF = 1.5
+# Sleep through this fraction of the expected wait before polling
+EXPECTED_FRACTION = 0.8
+
+# Serialized form used by binary macros and the journal:
+# u8 kind, u16 width, u16 height, f64 timeout, f64 tolerance,
+# f64 replaced delay, 3 x u8 color, 8 byte digest
+CONDITION = struct.Struct('<BHHddd3s8s')
+
+
+class WaitCondition:
+    """
+    What a wait step waits for, on a width x height region.
+    `replaced_delay` is the fixed delay the wait stands in for; replay
+    reports the time saved against it.
+    """
+    __slots__ = ('kind', 'width', 'height', 'timeout', 'tolerance', 'color', 'digest', 'replaced_delay')
+
+    def __init__(self, kind, width=WAIT_REGION, height=WAIT_REGION, timeout=WAIT_TIMEOUT, tolerance=None,
+                 color=(0, 0, 0), digest=b'', replaced_delay=0.0):
+        if kind not in KINDS:
+            raise ValueError(f"unknown wait condition: {kind}")
+        if tolerance is None:
+            tolerance = COLOR_TOLERANCE if kind == COLOR else CHANGE_TOLERANCE
+        self.kind = kind
+        self.width = max(1, int(width))
+        self.height = max(1, int(height))
+        self.timeout = float(timeout)
+        self.tolerance = float(tolerance)
+        self.color = tuple(int(c) for c in color)
+        self.digest = bytes(digest) if kind == HASH else b''  # only hash conditions have one
+        self.replaced_delay = float(replaced_delay)
+
+    def _fields(self):
+        return (self.kind, self.width, self.height, self.timeout, self.tolerance, self.color,
+                self.digest, self.replaced_delay)
+
+    def __eq__(self, other):
+        return isinstance(other, WaitCondition) and self._fields() == other._fields()
+
+    def __hash__(self):
+        return hash(self._fields())
+
+    def __repr__(self):
+        return f"WaitCondition({self.kind}, {self.width}x{self.height}, timeout={self.timeout}s)"
+
+    def label(self):
+        """Short text for the editor table"""
+        return f"Wait: {self.kind}"
+
+    # --- serialization ---
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'width': self.width,
+            'height': self.height,
+            'timeout': self.timeout,
+            'tolerance': self.tolerance,
+            'color': list(self.color),
+            'digest': self.digest.hex(),
+            'replaced_delay': self.replaced_delay,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['kind'], data.get('width', WAIT_REGION), data.get('height', WAIT_REGION),
+                   data.get('timeout', WAIT_TIMEOUT), data.get('tolerance'), data.get('color', (0, 0, 0)),
+                   bytes.fromhex(data.get('digest', '')), data.get('replaced_delay', 0.0))
+
+    def pack(self):
+        return CONDITION.pack(KINDS.index(self.kind), self.width, self.height, self.timeout, self.tolerance,
+                              self.replaced_delay, bytes(self.color), self.digest.ljust(8, b'\0')[:8])
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        """Returns (condition, offset after it); raises ValueError if truncated"""
+        if offset + CONDITION.size > len(buffer):
+            raise ValueError("truncated wait condition")
+        kind, width, height, timeout, tolerance, replaced, color, digest = CONDITION.unpack_from(buffer, offset)
+        if kind >= len(KINDS):
+            raise ValueError(f"unknown wait condition {kind}")
+        return cls(KINDS[kind], width, height, timeout, tolerance, tuple(color), digest, replaced), \
+            offset + CONDITION.size
+
+
+# --- region tests ---
+
+def _pixels(image):
+    """Screenshot (PIL image or array) as a float array, (H, W) or (H, W, 3)"""
+    image = np.asarray(image)
+    if image.ndim == 3:
+        image = image[..., :3]
+    return image.astype(np.float64, copy=False)
+
+
+def region_digest(image):
+    """8 byte hash of a region's pixels"""
+    pixels = np.ascontiguousarray(np.asarray(image, dtype=np.uint8))
+    return hashlib.blake2b(pixels.tobytes(), digest_size=8,
+                           key=struct.pack('<' + 'I' * pixels.ndim, *pixels.shape)).digest()
+
+
+def mean_color(image):
+    """Mean (r, g, b) of a region; gray regions give r == g == b"""
+    pixels = _pixels(image)
+    if pixels.ndim == 2:
+        value = float(pixels.mean())
+        return value, value, value
+    return tuple(float(c) for c in pixels.reshape(-1, pixels.shape[-1]).mean(axis=0))
+
+
+def condition_met(condition, image, baseline=None):
+    """Test one capture of the region against the condition"""
+    if condition.kind == HASH:
+        return region_digest(image) == condition.digest
+    if condition.kind == COLOR:
+        distance = max(abs(a - b) for a, b in zip(mean_color(image), condition.color))
+        return distance <= condition.tolerance
+    # CHANGE
+    if baseline is None:
+        return False
+    current = _pixels(image)
+    if current.shape != baseline.shape:
+        return True
+    return float(np.abs(current - baseline).mean()) > condition.tolerance
+
+
+def make_condition(kind, image, **options):
+    """A condition for `kind` whose target is taken from the region as it is now"""
+    if kind == COLOR:
+        options.setdefault('color', tuple(round(c) for c in mean_color(image)))
+    elif kind == HASH:
+        options['digest'] = region_digest(image)
+    height, width = np.asarray(image).shape[:2]
+    return WaitCondition(kind, width, height, **options)
+
+
+# --- waiting ---
+
+class ScreenWaiter:
+    """
+    Polls conditions with adaptive backoff.
+    grab(left, top, width, height, color) captures a region; sleep(deadline_ns)
+    blocks until then and returns False if the wait should be abandoned
+    (e.g. replay was stopped).
+    """
+
+    def __init__(self, poll_min=POLL_MIN, poll_max=POLL_MAX, backoff=POLL_BACKOFF):
+        if np is None:
+            raise RuntimeError("wait steps need NumPy")
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.backoff = backoff
+        self._expected = {}  # condition -> typical wait, ns
+        self.polls = 0
+
+    def wait(self, condition, x, y, grab, sleep):
+        """
+        Wait until the condition holds on the region at (x, y).
+        Returns (met, waited_ns); met is None if sleep() abandoned the wait.
+        """
+        start = time.monotonic_ns()
+        deadline = start + int(condition.timeout * 1e9)
+        color = condition.kind == COLOR
+
+        def capture():
+            self.polls += 1
+            return grab(x, y, condition.width, condition.height, color)
+
+        baseline = _pixels(capture()) if condition.kind == CHANGE else None
+        if baseline is None and condition_met(condition, capture()):
+            return True, time.monotonic_ns() - start
+
+        interval = self.poll_min
+        expected = self._expected.get(condition)
+        next_poll = start + int(interval * 1e9)
+        if expected:
+            next_poll = max(next_poll, start + int(expected * EXPECTED_FRACTION))
+        while True:
+            if not sleep(min(next_poll, deadline)):
+                return None, time.monotonic_ns() - start
+            if condition_met(condition, capture(), baseline):
+                waited = time.monotonic_ns() - start
+                # Smooth the expectation, so one slow wait doesn't stall the next ones
+                self._expected[condition] = waited if not expected else (expected + waited) // 2
+                return True, waited
+            now = time.monotonic_ns()
+            if now >= deadline:
+                self._expected.pop(condition, None)
+                return False, now - start
+            interval = min(interval * self.backoff, self.poll_max)
+            next_poll = now + int(interval * 1e9)
+
+
+class WaitReport:
+    """Time spent in wait steps vs the fixed delays they replaced"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.met = 0
+        self.timeouts = 0
+        self.waited_ns = 0
+        self.replaced_ns = 0
+
+    def record(self, condition, met, waited_ns):
+        self.count += 1
+        if met:
+            self.met += 1
+        else:
+            self.timeouts += 1
+        self.waited_ns += waited_ns
+        self.replaced_ns += int(condition.replaced_delay * 1e9)
+
+    def merge(self, other):
+        """Add another report's totals to this one"""
+        self.count += other.count
+        self.met += other.met
+        self.timeouts += other.timeouts
+        self.waited_ns += other.waited_ns
+        self.replaced_ns += other.replaced_ns
+
+    def summary(self):
+        return {
+            'waits': self.count,
+            'met': self.met,
+            'timeouts': self.timeouts,
+            'waited_s': self.waited_ns / 1e9,
+            'replaced_s': self.replaced_ns / 1e9,
+            'saved_s': (self.replaced_ns - self.waited_ns) / 1e9,
+        }
@@ -0,0 +1,74 @@
+"""
+Anchor matching on synthetic screenshots, through HeadlessBackend(screen=...).
+
+    python -m pytest test_anchors.py
+"""
+import unittest
+
+from anchors import TemplateMatcher, capture_anchor, pyramid_search, to_gray, np
+from backends import HeadlessBackend
+
+
+def synthetic_screen(seed, width=640, height=400):
+    """Blocky random texture, so every patch is distinct and has contrast"""
+    rng = np.random.default_rng(seed)
+    blocks = rng.uniform(0, 255, (height // 8 + 1, width // 8 + 1))
+    screen = np.kron(blocks, np.ones((8, 8)))[:height, :width]
+    return np.clip(screen + rng.normal(0, 4, screen.shape), 0, 255).astype(np.uint8)
+
+
+def shifted(screen, dx, dy):
+    """The screen with its content moved by (dx, dy); uncovered pixels are black"""
+    moved = np.zeros_like(screen)
+    height, width = screen.shape
+    moved[max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0)] = \
+        screen[max(-dy, 0):height - max(dy, 0), max(-dx, 0):width - max(dx, 0)]
+    return moved
+
+
+@unittest.skipIf(np is None, "anchor matching needs NumPy")
+class AnchorMatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.screen = synthetic_screen(1)
+        self.anchor = capture_anchor(self.screen, 300, 200)
+        self.assertIsNotNone(self.anchor)
+
+    def locate(self, matcher, screen):
+        backend = HeadlessBackend(screen=screen)
+        return matcher.locate(self.anchor, backend.screenshot, backend.screen_size())
+
+    def test_pyramid_search_finds_shifted_patch(self):
+        dx, dy = 37, -21
+        found = pyramid_search(to_gray(shifted(self.screen, dx, dy)), self.anchor.array())
+        self.assertIsNotNone(found)
+        x, y, score = found
+        self.assertEqual((x, y), (self.anchor.ref_x + dx, self.anchor.ref_y + dy))
+        self.assertGreater(score, 0.99)
+
+    def test_matcher_finds_patch_near_and_far(self):
+        matcher = TemplateMatcher()
+        # Within the region of interest around the recorded position
+        x, y, _ = self.locate(matcher, shifted(self.screen, 20, 15))
+        self.assertEqual((x, y), (self.anchor.ref_x + 20, self.anchor.ref_y + 15))
+        self.assertEqual(matcher.stats['roi'], 1)
+        # Moved farther than the region of interest: whole screen search
+        far = shifted(self.screen, -150, 90)
+        x, y, _ = self.locate(matcher, far)
+        self.assertEqual((x, y), (self.anchor.ref_x - 150, self.anchor.ref_y + 90))
+        self.assertEqual(matcher.stats['screen'], 1)
+        # Unchanged since: found at the remembered location
+        self.assertEqual(self.locate(matcher, far)[:2], (x, y))
+        self.assertEqual(matcher.stats['cache'], 1)
+
+    def test_missing_patch_is_not_found(self):
+        matcher = TemplateMatcher()
+        self.assertIsNone(self.locate(matcher, synthetic_screen(2)))
+        self.assertEqual(matcher.stats['miss'], 1)
+
+    def test_flat_patch_is_not_captured(self):
+        self.assertIsNone(capture_anchor(np.full((100, 100), 128, dtype=np.uint8), 50, 50))
+
+
+if __name__ == '__main__':
+    unittest.main()
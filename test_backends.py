@@ -0,0 +1,65 @@
+"""
+Input backends: pyautogui's failsafe reaches replay as FailSafeError.
+
+    python -m pytest test_backends.py
+"""
+import types
+import unittest
+
+import clickanput as can
+from backends import FailSafeError, PyAutoGuiBackend
+from ClickStore import ClickStore
+
+
+class FailSafeException(Exception):
+    pass
+
+
+def cornered_pyautogui():
+    """A pyautogui stand-in whose pointer sits in the failsafe corner"""
+    def trip(*args, **kwargs):
+        module.calls += 1
+        raise FailSafeException("mouse moved to a corner")
+    module = types.SimpleNamespace(PAUSE=0.1, FAILSAFE=True, FailSafeException=FailSafeException, calls=0)
+    for name in ('moveTo', 'click', 'doubleClick', 'scroll', 'mouseDown', 'mouseUp', 'press', 'write'):
+        setattr(module, name, trip)
+    return module
+
+
+def cornered_backend():
+    backend = PyAutoGuiBackend.__new__(PyAutoGuiBackend)
+    backend.pyautogui = cornered_pyautogui()
+    backend.failsafe = True
+    backend._saved = None
+    return backend
+
+
+class FailSafeTest(unittest.TestCase):
+
+    def test_actions_raise_failsafe_error(self):
+        backend = cornered_backend()
+        for action, args in (('move', (1, 2)), ('click', (1, 2)), ('double_click', (1, 2)),
+                             ('scroll', (3,)), ('mouse_down', (1, 2)), ('mouse_up', (1, 2)),
+                             ('press_key', ('a',)), ('type_text', ('abc',))):
+            with self.assertRaises(FailSafeError, msg=action):
+                getattr(backend, action)(*args)
+
+    def test_replay_stops_on_the_failsafe(self):
+        steps = ClickStore()
+        steps.add(10, 10, is_move=True)
+        steps.add(20, 20, button='left')
+        backend = cornered_backend()
+        step_time = can.replay_step_time
+        can.replay_step_time = 0
+        try:
+            self.assertTrue(can.start_replay(backend=backend, cycles=3, steps=steps))
+            can.replay_engine.join()
+        finally:
+            can.replay_step_time = step_time
+        # The move's error handler used to log the failsafe and go on to the click
+        self.assertEqual(backend.pyautogui.calls, 1)
+        self.assertEqual(backend.pyautogui.PAUSE, 0.1)  # end_run restored it
+
+
+if __name__ == '__main__':
+    unittest.main()
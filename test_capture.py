@@ -0,0 +1,29 @@
+"""
+Capture ring: overflow drops and how the consumer side reports them.
+
+    python -m pytest test_capture.py
+"""
+import unittest
+
+from capture import EV_CLICK, EV_MOVE, CaptureRing
+
+
+class CaptureRingTest(unittest.TestCase):
+
+    def test_overflow_is_counted_once(self):
+        ring = CaptureRing(4)
+        pushed = [ring.push(EV_MOVE, i, i, t_ns=i) for i in range(6)]
+        self.assertEqual(pushed, [True] * 4 + [False] * 2)
+        self.assertEqual([event[2] for event in ring.drain()], [0, 1, 2, 3])
+        self.assertEqual(ring.new_drops(), 2)
+        self.assertEqual(ring.new_drops(), 0)
+        # The producer's count only grows; later drops are reported as new ones
+        for i in range(5):
+            ring.push(EV_CLICK, i, i, 'left', t_ns=i)
+        self.assertEqual((ring.dropped, ring.new_drops()), (3, 1))
+        self.assertEqual(len(ring.drain(limit=3)), 3)
+        self.assertEqual(len(ring), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
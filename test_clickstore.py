@@ -0,0 +1,131 @@
+"""
+ClickStore: typed step columns, the ClickView proxies over them and the
+change notifications.
+
+    python -m pytest test_clickstore.py
+"""
+import unittest
+
+from anchors import Anchor
+from Click import Click
+from ClickStore import (ClickStore, COLUMNS, CHANGE_APPEND, CHANGE_DELETE, CHANGE_INSERT, CHANGE_RESET,
+                        CHANGE_UPDATE, FLAG_DOUBLE, FLAG_KEY, FLAG_MOUSE_DOWN, FLAG_SCROLL, FLAG_WAIT)
+from keys import key_code
+from screen_wait import COLOR, WaitCondition
+
+
+PATCH = Anchor(40, 50, 4, 4, bytes(range(16)))
+RED = WaitCondition(COLOR, color=(255, 0, 0), replaced_delay=1.5)
+
+
+def sample_store():
+    store = ClickStore()
+    store.add(10, 20, button='left', delay=0.25, offset_x=3, offset_y=-1)
+    store.add(30, 40, button='right', is_double_click=True)
+    store.add(50, 60, is_scroll=True, scroll_amount=-3, delay=0.1)
+    store.add(70, 80, button='left', is_mouse_down=True, anchor=PATCH)
+    store.add(0, 0, condition=RED)
+    store.add(0, 0, key='a', anchor=PATCH)
+    return store
+
+
+def columns_lengths(store):
+    return {len(column) for column in store.columns().values()}
+
+
+class ColumnsTest(unittest.TestCase):
+
+    def test_columns_are_typed_arrays(self):
+        store = sample_store()
+        columns = store.columns()
+        self.assertEqual([(name, column.typecode) for name, column in columns.items()], list(COLUMNS))
+        self.assertEqual(columns_lengths(store), {6})
+        self.assertEqual(list(store.x), [10, 30, 50, 70, 0, 0])
+        self.assertEqual(list(store.button), [1, 2, 0, 1, 0, 0])
+        self.assertEqual(list(store.flags), [0, FLAG_DOUBLE, FLAG_SCROLL, FLAG_MOUSE_DOWN, FLAG_WAIT, FLAG_KEY])
+        self.assertEqual(store.delay[0], 0.25)
+        self.assertEqual((store.offset_x[0], store.offset_y[0]), (3, -1))
+
+    def test_shared_tables(self):
+        store = sample_store()
+        # Steps with the same anchor share its id; wait and key steps keep
+        # their condition id or key code in scroll_amount
+        self.assertEqual(store.anchors, {1: PATCH})
+        self.assertEqual(list(store.anchor), [0, 0, 0, 1, 0, 1])
+        self.assertEqual(store.conditions, {1: RED})
+        self.assertEqual(store.scroll_amount[4], 1)
+        self.assertEqual(store.scroll_amount[5], key_code('a'))
+        self.assertIs(store[4].condition, RED)
+        self.assertEqual((store[5].key, store[5].anchor), ('a', PATCH))
+        self.assertIsNone(store[3].key)
+        self.assertEqual((store[4].to_dict()['scroll_amount'], store[2].to_dict()['scroll_amount']), (0, -3))
+
+    def test_dict_round_trip(self):
+        store = sample_store()
+        copy = ClickStore.from_dicts(store.to_dicts())
+        self.assertEqual(list(copy.rows()), list(store.rows()))
+        self.assertEqual(copy.anchors, store.anchors)
+        self.assertEqual(copy.conditions, store.conditions)
+
+    def test_clicks_round_trip(self):
+        store = sample_store()
+        clicks = [view.to_click() for view in store]
+        self.assertIsInstance(clicks[0], Click)
+        self.assertEqual(list(ClickStore.from_clicks(clicks).rows()), list(store.rows()))
+
+    def test_nbytes(self):
+        store = sample_store()
+        per_step = sum(getattr(store, name).itemsize for name, _ in COLUMNS)
+        self.assertEqual(store.nbytes(), 6 * per_step)
+
+
+class ViewsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = sample_store()
+        self.changes = []
+        self.store.subscribe(lambda kind, index: self.changes.append((kind, index)))
+
+    def test_views_write_through(self):
+        view = self.store[-1]
+        view.x = 99
+        view.is_scroll = True
+        view.key = None
+        view.button = 'middle'
+        self.assertEqual(self.store.x[5], 99)
+        self.assertEqual(self.store.flags[5], FLAG_SCROLL)
+        self.assertEqual((self.store.scroll_amount[5], self.store.button[5]), (0, 3))
+        self.assertEqual(self.changes, [(CHANGE_UPDATE, 5)] * 4)
+
+    def test_views_are_positional(self):
+        view = self.store[1]
+        del self.store[0]
+        self.assertEqual((view.x, view.y), (50, 60))
+        self.assertEqual(columns_lengths(self.store), {5})
+        with self.assertRaises(IndexError):
+            self.store[5]
+
+    def test_changes_keep_columns_aligned(self):
+        store = self.store
+        store.add(1, 2)
+        store.insert(0, Click(5, 6, button='right', delay=0.5))
+        store[1] = Click(7, 8, is_scroll=True, scroll_amount=2)
+        del store[2]
+        popped = store.pop()
+        del store[1:3]
+        self.assertEqual(self.changes, [(CHANGE_APPEND, 6), (CHANGE_INSERT, 0), (CHANGE_UPDATE, 1),
+                                        (CHANGE_DELETE, 2), (CHANGE_DELETE, 6), (CHANGE_RESET, None)])
+        self.assertEqual((popped.x, popped.y), (1, 2))
+        self.assertEqual(columns_lengths(store), {4})
+        self.assertEqual([(step.x, step.y) for step in store], [(5, 6), (70, 80), (0, 0), (0, 0)])
+        self.assertEqual(store[0].delay, 0.5)
+
+    def test_clear(self):
+        self.store.clear()
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual((self.store.anchors, self.store.conditions), ({}, {}))
+        self.assertEqual(self.changes, [(CHANGE_RESET, None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+Control protocol end to end: ControlClient against a ControlServer that
+replays with the null backend.
+
+    python -m pytest test_control_server.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import clickanput as can
+import macro_io
+from ClickStore import ClickStore
+from control_server import ControlClient, ControlError, ControlServer
+from replay_engine import IDLE, RUNNING
+
+
+def save_macro(path, count=3, delay=0.01):
+    steps = ClickStore()
+    for i in range(count):
+        steps.add(100 + i * 10, 200, button='left', delay=delay)
+    macro_io.save(path, steps)
+    return path
+
+
+def next_replay(events, state):
+    """The next replay event in `state`, skipping the others"""
+    for event in events:
+        if event['event'] == 'replay' and event['state'] == state:
+            return event
+    raise AssertionError(f"no {state} event")
+
+
+class ControlServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.macro = save_macro(os.path.join(self.dir, 'job.mvb'))
+        self.step_time = can.replay_step_time
+        self.server = ControlServer(can, os.path.join(self.dir, 'control.sock')).start()
+        self.client = ControlClient(self.server.address)
+
+    def tearDown(self):
+        self.client.close()
+        can.stop_replay()
+        can.replay_engine.join()
+        self.server.close()
+        can.replay_step_time = self.step_time
+        shutil.rmtree(self.dir)
+
+    def test_load_is_cached(self):
+        first = self.client.load(self.macro)
+        self.assertEqual((first['steps'], first['cached']), (3, False))
+        second = self.client.load(self.macro)
+        self.assertTrue(second['cached'])
+        self.assertEqual(self.client.macros()[0]['name'], os.path.abspath(self.macro))
+
+    def test_bad_path_is_an_error(self):
+        with self.assertRaises(ControlError) as raised:
+            self.client.load(os.path.join(self.dir, 'missing.mvb'))
+        self.assertIn('FileNotFoundError', str(raised.exception))
+        # The connection still answers after a failed command
+        self.assertEqual(self.client.ping()['pid'], os.getpid())
+
+    def test_start_status_stop(self):
+        slow = save_macro(os.path.join(self.dir, 'slow.mvb'), delay=0.05)
+        events = self.client.watch(timeout=5)
+        self.assertEqual(next(events)['replay'], IDLE)
+        try:
+            result = self.client.start(slow, backend='null', step_time=0)
+            self.assertEqual(result, {'started': True, 'macro': os.path.abspath(slow), 'cached': False})
+            next_replay(events, RUNNING)
+            status = self.client.status()
+            self.assertEqual((status['replay'], status['macro']), (RUNNING, os.path.abspath(slow)))
+            self.assertFalse(self.client.start(slow, backend='null')['started'])
+            self.client.stop()
+            self.assertEqual(next_replay(events, IDLE)['macro'], os.path.abspath(slow))
+        finally:
+            events.close()
+        status = self.client.status()
+        self.assertEqual((status['replay'], status['macro']), (IDLE, None))
+
+    def test_run_streams_progress(self):
+        events = []
+        status = self.client.run(self.macro, cycles=2, backend='null', step_time=0, on_event=events.append)
+        self.assertEqual(status['replay'], IDLE)
+        states = [event['state'] for event in events if event['event'] == 'replay']
+        self.assertEqual((states[0], states[-1]), (RUNNING, IDLE))
+        cycles = [event for event in events if event['event'] == 'cycle']
+        self.assertEqual(len(cycles), 2)
+        self.assertTrue(all(event['macro'] == os.path.abspath(self.macro) for event in cycles))
+
+
+class TokenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.token_file = os.path.join(self.dir, 'token')
+        self.server = ControlServer(can, '127.0.0.1:0', token_file=self.token_file).start()
+        self.address = f"127.0.0.1:{self.server._server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.dir)
+
+    def test_tcp_needs_the_token(self):
+        self.assertEqual(os.stat(self.token_file).st_mode & 0o777, 0o600)
+        with ControlClient(self.address, token_file=self.token_file) as client:
+            self.assertEqual(client.ping()['pid'], os.getpid())
+        wrong = os.path.join(self.dir, 'wrong')
+        with open(wrong, 'w') as f:
+            f.write('0' * 64)
+        with self.assertRaises(ControlError):
+            ControlClient(self.address, token_file=wrong)
+
+    def test_remote_hosts_are_refused(self):
+        with self.assertRaises(ValueError):
+            ControlServer(can, '0.0.0.0:47311').start()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+"""
+Recording journal: recovery of what was journaled, torn tails and bases.
+
+    python -m pytest test_journal.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import journal
+import macro_io
+from anchors import Anchor
+from ClickStore import ClickStore
+from screen_layout import ScreenLayout
+from screen_wait import COLOR, WaitCondition
+
+
+RECORDED = ScreenLayout([(0, 0, 1920, 1080)])
+CURRENT = ScreenLayout([(0, 0, 3840, 2160)])
+PATCH = Anchor(5, 5, 2, 2, b'\x00\x10\x20\x30')
+GREEN = WaitCondition(COLOR, color=(0, 255, 0))
+
+
+def rows(store):
+    return [tuple(row) for row in store.rows()]
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, journal.JOURNAL_FILE)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_recover_remapped_load(self):
+        # A macro recorded on another layout, loaded (and mapped) for this one
+        recorded = ClickStore()
+        recorded.add(100, 200, button='left', delay=0.5)
+        recorded.add(960, 540, button='right', offset_x=4)
+        recorded.layout = RECORDED
+        base = os.path.join(self.dir, 'macro.mvb')
+        macro_io.save(base, recorded)
+        store = macro_io.load(base, layout=CURRENT)
+        self.assertEqual(store.layout, CURRENT)
+
+        # The app compacts the journal onto the file it loaded, then edits
+        log = journal.RecordingJournal(self.path)
+        log.reset(base, store.layout)
+        store[0].x = 210
+        log.set_step(store, 0)
+        store.add(3000, 2000, button='left')
+        log.append_step(store)
+        log.close()
+
+        recovered = journal.recover(self.path)
+        self.assertEqual(recovered.layout, CURRENT)
+        self.assertEqual(rows(recovered), rows(store))
+        self.assertEqual((recovered[1].x, recovered[1].y, recovered[1].offset_x), (1920, 1080, 8))
+
+    def test_truncated_tail_record(self):
+        store = ClickStore()
+        log = journal.RecordingJournal(self.path)
+        edits = [
+            lambda: log.set_layout(RECORDED),
+            lambda: (store.add(10, 20, button='left', delay=0.5), log.append_step(store)),
+            lambda: (store.add(30, 40, button='right', anchor=PATCH), log.append_step(store)),
+            lambda: (store.add(0, 0, condition=GREEN), log.append_step(store)),
+            lambda: (setattr(store[-1], 'is_double_click', True), log.mark_double_last()),
+            lambda: (setattr(store[0], 'x', 11), log.set_step(store, 0)),
+            lambda: (store.insert(1, store[0].to_click()), log.insert_step(store, 1)),
+        ]
+        # File size and recoverable state after each edit
+        log.sync()
+        sizes, states = [os.path.getsize(self.path)], [([], None)]
+        for edit in edits:
+            edit()
+            log.sync()
+            sizes.append(os.path.getsize(self.path))
+            states.append((rows(store), RECORDED))
+        log.close()
+        with open(self.path, 'rb') as f:
+            data = f.read()
+
+        recovered = journal.recover(self.path)
+        self.assertEqual((rows(recovered), recovered.layout), states[-1])
+        self.assertEqual((recovered.anchors, recovered.conditions), (store.anchors, store.conditions))
+        # A torn write of any edit recovers everything before it
+        for before, after, state in zip(sizes, sizes[1:], states):
+            for cut in range(before + 1, after):
+                with open(self.path, 'wb') as f:
+                    f.write(data[:cut])
+                recovered = journal.recover(self.path)
+                self.assertEqual((rows(recovered), recovered.layout), state, f"cut at {cut}")
+        # So does a tail that isn't an entry at all, and a torn header
+        with open(self.path, 'wb') as f:
+            f.write(data + b'\xff garbage')
+        self.assertEqual(rows(journal.recover(self.path)), states[-1][0])
+        with open(self.path, 'wb') as f:
+            f.write(data[:3])
+        self.assertEqual(len(journal.recover(self.path)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+"""
+Macro files: binary save and memory-mapped read round trips, optional
+tables, forward compatible records, and JSON macros.
+
+    python -m pytest test_macro_io.py
+"""
+import json
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+import macro_io
+import screen_layout
+from anchors import Anchor
+from ClickStore import ClickStore
+from macro_io import HEADER, RECORD, MacroFormatError, MappedMacro
+from replay_plan import compile_plan
+from screen_layout import ScreenLayout
+from screen_wait import HASH, WaitCondition
+
+
+RECORDED = ScreenLayout([(0, 0, 1920, 1080)])
+CURRENT = ScreenLayout([(0, 0, 2560, 1440)])
+PATCH = Anchor(100, 200, 3, 2, b'\x01\x02\x03\x04\x05\x06')
+SAME = WaitCondition(HASH, digest=b'12345678', replaced_delay=2.0)
+
+
+def full_store():
+    store = ClickStore()
+    store.add(10, 20, button='left', delay=0.125, offset_x=4, offset_y=-2)
+    store.add(30, 40, button='right', is_double_click=True, anchor=PATCH)
+    store.add(50, 60, is_scroll=True, scroll_amount=-5)
+    store.add(0, 0, condition=SAME)
+    store.add(0, 0, key='enter', delay=0.5)
+    store.layout = RECORDED
+    return store
+
+
+def plain_store():
+    store = ClickStore()
+    store.add(1, 2, button='left', delay=0.1)
+    store.add(3, 4, is_move=True)
+    return store
+
+
+def plan_rows(steps):
+    return compile_plan(steps).cycle_rows(2)
+
+
+class BinaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'macro.mvb')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        store = full_store()
+        macro_io.save(self.path, store)
+        self.assertTrue(macro_io.is_binary(self.path))
+        with MappedMacro(self.path) as macro:
+            self.assertEqual(len(macro), 5)
+            self.assertEqual(list(macro.rows()), list(store.rows()))
+            self.assertEqual((macro.anchors, macro.conditions, macro.layout), ({1: PATCH}, {1: SAME}, RECORDED))
+            self.assertEqual(macro.to_dicts(), store.to_dicts())
+            self.assertEqual(plan_rows(macro), plan_rows(store))
+        loaded = macro_io.load(self.path)
+        self.assertEqual(list(loaded.rows()), list(store.rows()))
+        self.assertEqual((loaded.anchors, loaded.conditions, loaded.layout), (store.anchors, store.conditions, RECORDED))
+
+    def test_mapped_to_another_layout(self):
+        store = full_store()
+        macro_io.save(self.path, store)
+        store.remap(CURRENT)
+        with MappedMacro(self.path, CURRENT) as macro:
+            self.assertEqual(macro.layout, CURRENT)
+            self.assertEqual(list(macro.rows()), list(store.rows()))
+            self.assertEqual(macro.anchors, store.anchors)
+            self.assertEqual(plan_rows(macro), plan_rows(store))
+            # records() is the file as is
+            self.assertEqual(int(macro.records()['x'][1]), 30)
+        self.assertEqual(list(macro_io.load(self.path, CURRENT).rows()), list(store.rows()))
+
+    def test_missing_optional_tables(self):
+        # No anchors, conditions or layout: the file ends after the records
+        store = plain_store()
+        macro_io.save(self.path, store)
+        self.assertEqual(os.path.getsize(self.path), HEADER.size + 2 * RECORD.size)
+        with MappedMacro(self.path, CURRENT) as macro:
+            self.assertEqual((macro.anchors, macro.conditions, macro.layout), ({}, {}, None))
+            self.assertEqual(list(macro.rows()), list(store.rows()))  # nothing to map from
+            self.assertEqual(plan_rows(macro), plan_rows(store))
+        # Only some of the tables
+        store.add(5, 6, anchor=PATCH)
+        macro_io.save(self.path, store)
+        with MappedMacro(self.path) as macro:
+            self.assertEqual((macro.anchors, macro.conditions, macro.layout), ({1: PATCH}, {}, None))
+        store = plain_store()
+        store.layout = RECORDED
+        macro_io.save(self.path, store)
+        loaded = macro_io.load(self.path)
+        self.assertEqual((loaded.anchors, loaded.conditions, loaded.layout), ({}, {}, RECORDED))
+
+    def test_unknown_table_ends_the_read(self):
+        macro_io.save(self.path, full_store())
+        with open(self.path, 'r+b') as f:
+            data = f.read()
+            start = data.index(macro_io.CONDITION_MAGIC)
+            f.seek(start)
+            f.write(b'MVXX')  # a table from a later version
+        with MappedMacro(self.path) as macro:
+            self.assertEqual((macro.anchors, macro.conditions, macro.layout), ({1: PATCH}, {}, None))
+
+    def test_damaged_tables(self):
+        macro_io.save(self.path, full_store())
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+        with self.assertRaises(MacroFormatError):
+            MappedMacro(self.path)
+
+    def test_unfinished_and_bad_headers(self):
+        store = plain_store()
+        macro_io.save(self.path, store)
+        with open(self.path, 'r+b') as f:
+            f.write(HEADER.pack(macro_io.MAGIC, macro_io.VERSION, RECORD.size, macro_io.COUNT_UNKNOWN))
+        with MappedMacro(self.path) as macro:
+            self.assertEqual(list(macro.rows()), list(store.rows()))
+        for header in (HEADER.pack(b'NOPE', 1, RECORD.size, 2), HEADER.pack(macro_io.MAGIC, 99, RECORD.size, 2),
+                       HEADER.pack(macro_io.MAGIC, 1, RECORD.size, 3)):
+            with open(self.path, 'r+b') as f:
+                f.write(header)
+            with self.assertRaises(MacroFormatError):
+                MappedMacro(self.path)
+
+    def test_longer_records(self):
+        # A later version appending a field to every record
+        store = plain_store()
+        size = RECORD.size + 4
+        with open(self.path, 'wb') as f:
+            f.write(HEADER.pack(macro_io.MAGIC, macro_io.VERSION, size, len(store)))
+            for row in store.rows():
+                f.write(RECORD.pack(*row) + struct.pack('<i', -1))
+        with MappedMacro(self.path) as macro:
+            self.assertEqual(list(macro.rows()), list(store.rows()))
+            self.assertEqual(plan_rows(macro), plan_rows(store))
+        self.assertEqual(list(macro_io.load(self.path).rows()), list(store.rows()))
+
+
+@mock.patch.object(screen_layout, 'np', None)
+@mock.patch.object(macro_io, 'np', None)
+class PythonBinaryTest(BinaryTest):
+    """The same files decoded without NumPy"""
+
+    def test_mapped_to_another_layout(self):
+        store = full_store()
+        macro_io.save(self.path, store)
+        store.remap(CURRENT)
+        with MappedMacro(self.path, CURRENT) as macro:
+            self.assertEqual(list(macro.rows()), list(store.rows()))
+            self.assertEqual(macro.columns()['x'], list(store.x))
+
+
+class JsonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'macro.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip_with_layout(self):
+        store = full_store()
+        macro_io.save(self.path, store)
+        with open(self.path) as f:
+            self.assertEqual(json.load(f)['version'], 2)
+        loaded = macro_io.load(self.path)
+        self.assertEqual(list(loaded.rows()), list(store.rows()))
+        self.assertEqual(loaded.layout, RECORDED)
+        store.remap(CURRENT)
+        self.assertEqual(list(macro_io.load(self.path, CURRENT).rows()), list(store.rows()))
+
+    def test_plain_list(self):
+        store = plain_store()
+        macro_io.save(self.path, store)
+        with open(self.path) as f:
+            self.assertIsInstance(json.load(f), list)
+        loaded = macro_io.load(self.path, CURRENT)
+        self.assertEqual((list(loaded.rows()), loaded.layout), (list(store.rows()), None))
+
+    def test_convert(self):
+        binary = os.path.join(self.dir, 'macro.mvb')
+        store = full_store()
+        macro_io.save(self.path, store)
+        macro_io.convert(self.path, binary)
+        back = os.path.join(self.dir, 'back.json')
+        macro_io.convert(binary, back)
+        loaded = macro_io.load(back)
+        self.assertEqual((list(loaded.rows()), loaded.layout), (list(store.rows()), RECORDED))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+Optimizer pass: the compiled plan replays the same actions at the same
+times, except where a fold or merge is meant to save time.
+
+    python -m pytest test_macro_optimizer.py
+"""
+import unittest
+
+from ClickStore import ClickStore
+from macro_optimizer import optimize
+from replay_plan import OP_ANCHORED, OP_NAMES, UNTIMED_OPS, compile_plan
+from scheduler import seconds_to_ns
+
+
+def timeline(steps, step_time):
+    """(action, x, y, amount, start ms) of one replayed cycle, timed like replay_clicks"""
+    actions = []
+    t = 0
+    step_ns = seconds_to_ns(step_time)
+    for op, x, y, amount, delay_ns in compile_plan(steps).cycle_rows(1):
+        actions.append((OP_NAMES[op % OP_ANCHORED], x, y, amount, round(t / 1e6, 3)))
+        t += delay_ns + (0 if op % OP_ANCHORED in UNTIMED_OPS else step_ns)
+    return actions
+
+
+def two_clicks(delay, dx=0, dy=0):
+    steps = ClickStore()
+    steps.add(100, 100, button='left', delay=delay)
+    steps.add(100 + dx, 100 + dy, button='left', delay=0.25)
+    steps.add(400, 300, button='right', delay=0.5)
+    return steps
+
+
+class DoubleClickFoldTest(unittest.TestCase):
+
+    def assert_folds(self, steps, step_time, folds):
+        optimized, report = optimize(steps, step_time=step_time)
+        before, after = timeline(steps, step_time), timeline(optimized, step_time)
+        if not folds:
+            self.assertEqual(report.folded_double_clicks, 0)
+            self.assertEqual(after, before)
+            return
+        self.assertEqual(report.folded_double_clicks, 1)
+        self.assertEqual(after[0], ('double_click', 100, 100, 0, 0.0))
+        # The second click's time is saved, the rest keeps its spacing
+        saved_ms = before[1][-1]
+        self.assertEqual(after[1:], [action[:-1] + (round(action[-1] - saved_ms, 3),) for action in before[2:]])
+        self.assertAlmostEqual(report.saved_s, saved_ms / 1e3)
+
+    def test_time_window_boundary(self):
+        self.assert_folds(two_clicks(0.3), 0.1, True)  # 0.3 + 0.1 is exactly the window
+        self.assert_folds(two_clicks(0.301), 0.1, False)
+        self.assert_folds(two_clicks(0.4), 0, True)
+
+    def test_step_time_prevents_fold(self):
+        self.assert_folds(two_clicks(0.35), 0, True)
+        self.assert_folds(two_clicks(0.35), 0.1, False)
+
+    def test_distance_boundary(self):
+        self.assert_folds(two_clicks(0.1, dx=2, dy=-2), 0.1, True)
+        self.assert_folds(two_clicks(0.1, dx=3), 0.1, False)
+        self.assert_folds(two_clicks(0.1, dy=-3), 0.1, False)
+
+    def test_other_button_is_not_folded(self):
+        steps = two_clicks(0.1)
+        steps[1].button = 'right'
+        self.assert_folds(steps, 0.1, False)
+
+
+class MoveAndScrollTest(unittest.TestCase):
+
+    def test_dropped_moves_keep_the_timing(self):
+        steps = ClickStore()
+        steps.add(10, 10, button='left', delay=0.1)
+        steps.add(10, 10, is_move=True, delay=0.2)  # already there
+        steps.add(50, 50, is_move=True, delay=0)  # overridden by the next move
+        steps.add(60, 60, is_move=True, delay=0)  # and that one by the click
+        steps.add(70, 70, button='left', delay=0.3)
+        optimized, report = optimize(steps, step_time=0.1)
+        self.assertEqual(report.dropped_moves, 3)
+        before = [action for action in timeline(steps, 0.1) if action[0] != 'path_move']
+        self.assertEqual(timeline(optimized, 0.1), before)
+        self.assertEqual(before, [('click', 10, 10, 0, 0.0), ('click', 70, 70, 0, 400.0)])
+
+    def test_drag_path_is_kept(self):
+        steps = ClickStore()
+        steps.add(10, 10, is_mouse_down=True, delay=0)
+        steps.add(20, 20, is_move=True, delay=0)
+        steps.add(20, 20, is_move=True, delay=0.05)  # a duplicate, the only move that goes
+        steps.add(30, 30, is_move=True, delay=0)
+        steps.add(40, 40, is_mouse_up=True, delay=0.2)
+        optimized, report = optimize(steps, step_time=0.1)
+        self.assertEqual(report.dropped_moves, 1)
+        self.assertEqual(timeline(optimized, 0.1),
+                         [action for i, action in enumerate(timeline(steps, 0.1)) if i != 2])
+
+    def test_scrolls_merge(self):
+        steps = ClickStore()
+        steps.add(5, 5, is_scroll=True, scroll_amount=3, delay=0.05)
+        steps.add(5, 5, is_scroll=True, scroll_amount=2, delay=0.1)  # the gap is at most 0.1 s
+        steps.add(5, 5, is_scroll=True, scroll_amount=4, delay=0.2)
+        steps.add(5, 5, is_scroll=True, scroll_amount=1, delay=0)  # more than 0.1 s later
+        steps.add(5, 5, is_scroll=True, scroll_amount=-1, delay=0)  # the other direction
+        steps.add(6, 5, is_scroll=True, scroll_amount=-2, delay=0)  # another place
+        optimized, report = optimize(steps, step_time=0.1)
+        self.assertEqual(report.merged_scrolls, 2)
+        scrolls = [action for action in timeline(optimized, 0.1) if action[0] == 'scroll']
+        self.assertEqual([action[1:4] for action in scrolls],
+                         [(5, 5, 9), (5, 5, 1), (5, 5, -1), (6, 5, -2)])
+        # The merged scroll waits what the last of its run waited
+        self.assertEqual(optimized[0].delay, 0.2)
+
+    def test_zero_scroll_becomes_a_move(self):
+        steps = ClickStore()
+        steps.add(5, 5, is_scroll=True, scroll_amount=0, delay=0.1)
+        steps.add(9, 9, button='left', delay=0)
+        optimized, report = optimize(steps, step_time=0.1)
+        self.assertEqual(report.converted_noops, 1)
+        self.assertEqual(timeline(optimized, 0.1), [('path_move', 5, 5, 0, 0.0), ('click', 9, 9, 0, 100.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Replay plan compiler: opcodes per step kind, anchored steps, per-cycle
+offsets and text key coalescing, with and without NumPy.
+
+    python -m pytest test_replay_plan.py
+"""
+import unittest
+from unittest import mock
+
+import replay_plan
+from anchors import Anchor
+from ClickStore import ClickStore
+from keys import key_code
+from replay_plan import (OP_ANCHORED, OP_CLICK, OP_DOUBLE_CLICK, OP_KEY, OP_LOCATE, OP_MOUSE_DOWN, OP_MOUSE_UP,
+                         OP_MOVE, OP_PATH_MOVE, OP_SCROLL, OP_TYPE, OP_WAIT, SCROLL_SETTLE, TEXT_RUN_GAP,
+                         compile_plan)
+from scheduler import seconds_to_ns
+from screen_wait import CHANGE, WaitCondition
+
+
+PATCH = Anchor(0, 0, 2, 2, b'\x00\x40\x80\xff')
+
+
+def ms(seconds):
+    return seconds_to_ns(seconds)
+
+
+def instructions(plan, cycle=1):
+    """(op, x, y, amount, delay_ns, step) per instruction"""
+    rows = plan.cycle_rows(cycle)
+    return [row + (step,) for row, step in zip(rows, replay_plan._tolist(plan.steps))]
+
+
+def mouse_steps():
+    steps = ClickStore()
+    steps.add(1, 2, button='left', delay=0.1)
+    steps.add(3, 4, button='left', is_double_click=True)
+    steps.add(5, 6, is_scroll=True, scroll_amount=-2, delay=0.05)
+    steps.add(7, 8, is_mouse_down=True)
+    steps.add(9, 10, is_move=True, delay=0.01)
+    steps.add(11, 12, is_mouse_up=True)
+    steps.add(13, 14, button='left', anchor=PATCH, delay=0.2)
+    steps.add(15, 16, is_scroll=True, scroll_amount=1, anchor=PATCH)
+    steps.add(0, 0, condition=WaitCondition(CHANGE))
+    return steps
+
+
+class CompileTest(unittest.TestCase):
+    """Run against the NumPy compiler when it is installed; see PythonCompileTest"""
+
+    def test_opcodes(self):
+        plan = compile_plan(mouse_steps())
+        self.assertEqual(instructions(plan), [
+            (OP_CLICK, 1, 2, 0, ms(0.1), 0),
+            (OP_DOUBLE_CLICK, 3, 4, 0, 0, 1),
+            # A scroll moves there first and lets the pointer settle
+            (OP_MOVE, 5, 6, 0, ms(SCROLL_SETTLE), 2),
+            (OP_SCROLL, 5, 6, -2, ms(0.05), 2),
+            (OP_MOUSE_DOWN, 7, 8, 0, 0, 3),
+            (OP_PATH_MOVE, 9, 10, 0, ms(0.01), 4),
+            (OP_MOUSE_UP, 11, 12, 0, 0, 5),
+            # Anchored steps locate their anchor (by id) first
+            (OP_LOCATE, 13, 14, 1, 0, 6),
+            (OP_CLICK + OP_ANCHORED, 13, 14, 0, ms(0.2), 6),
+            (OP_LOCATE, 15, 16, 1, 0, 7),
+            (OP_MOVE + OP_ANCHORED, 15, 16, 0, ms(SCROLL_SETTLE), 7),
+            (OP_SCROLL + OP_ANCHORED, 15, 16, 1, 0, 7),
+            (OP_WAIT, 0, 0, 1, 0, 8),
+        ])
+        self.assertEqual(plan.anchors, {1: PATCH})
+        self.assertEqual(list(plan.conditions), [1])
+
+    def test_offsets_per_cycle(self):
+        steps = ClickStore()
+        steps.add(100, 200, button='left', offset_x=5, offset_y=-2)
+        steps.add(10, 10, button='left')
+        plan = compile_plan(steps)
+        self.assertTrue(plan.has_offsets)
+        self.assertEqual([row[1:3] for row in plan.cycle_rows(3)], [(110, 196), (10, 10)])
+        cycles = plan.iter_cycles(first_cycle=2, block=2)
+        self.assertEqual([(cycle, rows[0][1:3]) for cycle, rows in (next(cycles) for _ in range(3))],
+                         [(2, (105, 198)), (3, (110, 196)), (4, (115, 194))])
+
+    def test_text_runs_become_type(self):
+        steps = ClickStore()
+        for key in 'hi':
+            steps.add(0, 0, key=key, delay=0.05)
+        steps.add(0, 0, key='enter', delay=0.1)  # special keys aren't text
+        steps.add(0, 0, key='a', delay=TEXT_RUN_GAP + 0.1)  # a pause ends the run
+        steps.add(0, 0, key='b', delay=0.01)
+        steps.add(0, 0, key='c', delay=0.3)
+        steps.add(0, 0, key='d', anchor=PATCH)  # anchored keys stay on their own
+        plan = compile_plan(steps)
+        self.assertEqual(plan.texts, ['hi', 'bc'])
+        self.assertEqual(instructions(plan), [
+            (OP_TYPE, 0, 0, 0, ms(0.05), 0),
+            (OP_KEY, 0, 0, key_code('enter'), ms(0.1), 2),
+            (OP_KEY, 0, 0, key_code('a'), ms(TEXT_RUN_GAP + 0.1), 3),
+            # The merged run keeps the delay of its last key
+            (OP_TYPE, 0, 0, 1, ms(0.3), 4),
+            (OP_LOCATE, 0, 0, 1, 0, 6),
+            (OP_KEY + OP_ANCHORED, 0, 0, key_code('d'), 0, 6),
+        ])
+
+    def test_text_coalescing_can_be_off(self):
+        steps = ClickStore()
+        for key in 'abc':
+            steps.add(0, 0, key=key)
+        plan = compile_plan(steps, coalesce_text=False)
+        self.assertEqual([row[0] for row in plan.cycle_rows(1)], [OP_KEY] * 3)
+        self.assertEqual(plan.texts, [])
+
+    def test_click_objects(self):
+        steps = mouse_steps()
+        clicks = [view.to_click() for view in steps]
+        self.assertEqual(instructions(compile_plan(clicks)), instructions(compile_plan(steps)))
+
+
+@mock.patch.object(replay_plan, 'np', None)
+class PythonCompileTest(CompileTest):
+    """The same plans from the compiler used without NumPy"""
+
+
+if __name__ == '__main__':
+    unittest.main()
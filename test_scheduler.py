@@ -0,0 +1,127 @@
+"""
+Deadline scheduler: deadlines, lateness accounting, pauses and resyncs,
+and real waits that are never early.
+
+    python -m pytest test_scheduler.py
+"""
+import time
+import unittest
+
+from scheduler import (RESYNC_THRESHOLD_NS, DeadlineScheduler, LatenessStats, percentile, seconds_to_ns,
+                       wait_until)
+
+
+MS = 1_000_000
+
+
+class ScriptedWaiter:
+    """Records the deadlines asked for and answers (late_ns, paused_ns) from a script"""
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.deadlines = []
+
+    def __call__(self, deadline_ns):
+        self.deadlines.append(deadline_ns)
+        return self.answers.pop(0)
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def run_script(self, delays_ms, *answers):
+        waiter = ScriptedWaiter(*answers)
+        scheduler = DeadlineScheduler(waiter=waiter)
+        scheduler.start()
+        start = scheduler.next_deadline_ns
+        lateness = []
+        for delay in delays_ms:
+            lateness.append(scheduler.wait())
+            scheduler.advance(delay * MS)
+        return scheduler, [(d - start) // MS for d in waiter.deadlines], lateness
+
+    def test_deadlines_are_absolute(self):
+        # Lateness doesn't push later deadlines back, so errors don't add up
+        scheduler, deadlines, lateness = self.run_script([10, 0, 25, 5], (2 * MS, 0), (0, 0), (3 * MS, 0), (0, 0))
+        self.assertEqual(deadlines, [0, 10, 10, 35])
+        self.assertEqual(lateness, [2 * MS, 0, 3 * MS, 0])
+        self.assertEqual(scheduler.stats.samples, lateness)
+
+    def test_pause_shifts_the_schedule(self):
+        scheduler, deadlines, _ = self.run_script([10, 10, 10], (0, 0), (0, 500 * MS), (0, 0))
+        self.assertEqual(deadlines, [0, 10, 520])
+        self.assertEqual(scheduler.stats.samples, [0, 0, 0])
+
+    def test_overrun_resyncs(self):
+        late = RESYNC_THRESHOLD_NS + 10 * MS
+        scheduler, deadlines, _ = self.run_script([10, 10, 10], (0, 0), (late, 0), (0, 0))
+        self.assertEqual(deadlines, [0, 10, 20 + late // MS])
+        self.assertEqual(scheduler.resyncs, 1)
+        # Up to the threshold, the schedule catches up instead
+        scheduler, deadlines, _ = self.run_script([10, 10, 10], (0, 0), (RESYNC_THRESHOLD_NS, 0), (0, 0))
+        self.assertEqual((deadlines, scheduler.resyncs), ([0, 10, 20], 0))
+
+    def test_abort(self):
+        scheduler = DeadlineScheduler(waiter=ScriptedWaiter(None))
+        scheduler.start()
+        self.assertIsNone(scheduler.wait())
+        self.assertEqual(scheduler.stats.samples, [])
+
+    def test_cycle_report_starts_a_new_window(self):
+        scheduler, _, _ = self.run_script([1, 1], (RESYNC_THRESHOLD_NS + 1, 0), (MS, 0))
+        report = scheduler.cycle_report()
+        self.assertEqual((report['count'], report['resyncs'], report['p50_ms']), (2, 1, 1.0))
+        self.assertEqual(scheduler.cycle_report()['count'], 0)
+
+
+class LatenessTest(unittest.TestCase):
+
+    def test_percentiles(self):
+        values = list(range(1, 101))
+        self.assertEqual((percentile(values, 0.5), percentile(values, 0.99), percentile(values, 1.0)), (50, 99, 100))
+        self.assertEqual((percentile([7], 0.99), percentile([], 0.5)), (7, 0))
+        stats = LatenessStats()
+        for late in (3 * MS, MS, 2 * MS):
+            stats.record(late)
+        self.assertEqual(stats.summary(), {'count': 3, 'p50_ms': 2.0, 'p99_ms': 3.0, 'max_ms': 3.0})
+
+    def test_seconds_to_ns(self):
+        self.assertEqual((seconds_to_ns(0.1), seconds_to_ns(0.001), seconds_to_ns(0)), (100 * MS, MS, 0))
+
+
+class RealWaitTest(unittest.TestCase):
+    """With the default waiter, against the real clock"""
+
+    def test_waits_are_never_early(self):
+        scheduler = DeadlineScheduler()
+        scheduler.start()
+        started = scheduler.next_deadline_ns
+        for _ in range(10):
+            late = scheduler.wait()
+            self.assertGreaterEqual(time.monotonic_ns(), scheduler.next_deadline_ns)
+            self.assertGreaterEqual(late, 0)
+            scheduler.advance(2 * MS)
+        scheduler.wait()
+        self.assertGreaterEqual(time.monotonic_ns() - started, 20 * MS)
+
+    def test_zero_delay_run(self):
+        # Back to back actions: no sleeping, no resync, lateness is just the work done
+        scheduler = DeadlineScheduler()
+        started = time.monotonic_ns()
+        scheduler.start()
+        for _ in range(1000):
+            scheduler.wait()
+            scheduler.advance(0)
+        elapsed = time.monotonic_ns() - started
+        self.assertLess(elapsed, RESYNC_THRESHOLD_NS)
+        self.assertEqual(scheduler.resyncs, 0)
+        samples = scheduler.stats.samples
+        self.assertEqual(len(samples), 1000)
+        self.assertTrue(0 <= samples[0] <= samples[-1] <= elapsed)
+
+    def test_wait_until_past_deadline(self):
+        deadline = time.monotonic_ns() - 5 * MS
+        self.assertGreaterEqual(wait_until(deadline), 5 * MS)
+
+
+if __name__ == '__main__':
+    unittest.main()